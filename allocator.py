@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+import argparse
+import json
+import re
+import time
+from collections import OrderedDict
+
+from registry import BoardRegistry
+
+#Last run of digits of an SN, the part that is counted
+SN_NUMBER = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+class AllocatorError(RuntimeError):
+    pass
+
+class IdentityAllocator(object):
+    """ hands out the SN, MAC and deploy IP of each board from leases kept in the registry database
+
+    Each station reserves a block of block_size consecutive SN/MAC pairs at a
+    time and its boards are leased from it, so stations sharing a database
+    never get the same identity. The deploy IP is the next rack slot of
+    ip_pool not held by another lease. A lease is confirmed once its board
+    got the identity stored in FeRAM, pass or fail, the identity is then used
+    for good. The row is kept as 'used' until the station leases its next
+    board, so a board tested again gets the same identity back. A lease is
+    released when the board never reached the FeRAM store (the test couldn't
+    start, crashed or was aborted before), the SN and MAC then go back to a
+    free list that every station draws from before its own block, so such a
+    board leaves no gap. Leases not confirmed or released within lease_time,
+    and reserved blocks left unused for block_time, are reclaimed into the
+    free list, used rows left for lease_time are dropped.
+
+    The leases table only holds the identities in flight, every call costs
+    the same however many boards the registry holds.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS alloc_counters (
+            kind TEXT PRIMARY KEY,
+            next INTEGER NOT NULL,
+            fmt TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sn_num INTEGER NOT NULL,
+            mac_num INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            station TEXT,
+            ip TEXT,
+            expires REAL
+        );
+        CREATE INDEX IF NOT EXISTS leases_station ON leases(station, state, sn_num);
+        CREATE INDEX IF NOT EXISTS leases_free ON leases(state, sn_num);
+        CREATE INDEX IF NOT EXISTS leases_expires ON leases(state, expires);
+    '''
+
+    #Identity of the first board of an empty registry
+    FIRST = ('CN00001', '20000000001')
+
+    def __init__(self, registry, ip_pool, block_size=16, lease_time=3600.0, block_time=8*3600.0):
+        self.registry = registry
+        self.conn = registry.conn
+        self.lock = registry.lock
+        self.ip_pool = list(ip_pool)
+        self.block_size = block_size
+        self.lease_time = lease_time
+        self.block_time = block_time
+        with self.lock:
+            self.conn.executescript(self.SCHEMA)
+
+    def transaction(self, fn, *args):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                res = fn(*args)
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return res
+
+    def counters(self):
+        """ {kind: (next, fmt)}, set up from the last registered board the first time """
+        rows = dict((r['kind'], (r['next'], r['fmt'])) for r in self.conn.execute('SELECT * FROM alloc_counters'))
+        if len(rows) == 3:
+            return rows
+        last = self.conn.execute('SELECT sn, ip, mac FROM boards ORDER BY seq DESC LIMIT 1').fetchone()
+        sn, mac = (last['sn'], last['mac'].replace(':', '')) if last is not None else self.FIRST
+        m = SN_NUMBER.match(sn)
+        if m is None:
+            raise AllocatorError('cannot count on from SN "{}"'.format(sn))
+        prefix, num, suffix = m.groups()
+        sn_fmt = prefix.replace('{', '{{').replace('}', '}}')+'{:0'+str(len(num))+'d}'+suffix.replace('{', '{{').replace('}', '}}')
+        mac_num = int(mac, 16)
+        ip = self.ip_pool.index(last['ip']) + 1 if last is not None and last['ip'] in self.ip_pool else 0
+        if last is not None:
+            num, mac_num = int(num) + 1, mac_num + 1
+        rows = {'sn': (int(num), sn_fmt), 'mac': (mac_num, '{:012X}'), 'ip': (ip, '')}
+        self.conn.executemany('INSERT OR IGNORE INTO alloc_counters (kind, next, fmt) VALUES (?,?,?)', [(k, n, fmt) for k, (n, fmt) in rows.items()])
+        return rows
+
+    def reclaim(self, now=None):
+        """ put the expired leases and reservations back into the free list, returns how many """
+        now = time.time() if now is None else now
+        return self.transaction(self.reclaim_expired, now)
+
+    def reclaim_expired(self, now):
+        cur = self.conn.execute("UPDATE leases SET state = 'free', station = NULL, expires = NULL "
+                                "WHERE state IN ('leased', 'reserved') AND expires < ?", (now,))
+        self.conn.execute("DELETE FROM leases WHERE state = 'used' AND expires < ?", (now,))
+        return cur.rowcount
+
+    def reserve(self, station, now):
+        """ a new block for station, from the free list first and then from the counters """
+        ids = [r['id'] for r in self.conn.execute("SELECT id FROM leases WHERE state = 'free' ORDER BY sn_num LIMIT ?", (self.block_size,))]
+        self.conn.executemany("UPDATE leases SET state = 'reserved', station = ?, expires = ? WHERE id = ?", [(station, now + self.block_time, i) for i in ids])
+        n = self.block_size - len(ids)
+        if n:
+            counters = self.counters()
+            sn, mac = counters['sn'][0], counters['mac'][0]
+            self.conn.executemany("INSERT INTO leases (sn_num, mac_num, state, station, expires) VALUES (?,?,'reserved',?,?)",
+                                  [(sn + i, mac + i, station, now + self.block_time) for i in range(n)])
+            self.conn.execute("UPDATE alloc_counters SET next = next + ? WHERE kind IN ('sn', 'mac')", (n,))
+
+    def next_ip(self, advance, prefer=None):
+        counters = self.counters()
+        start = counters['ip'][0]
+        used = set(r['ip'] for r in self.conn.execute("SELECT ip FROM leases WHERE state = 'leased' AND ip IS NOT NULL"))
+        if prefer is not None and prefer not in used:
+            return prefer
+        for i in range(len(self.ip_pool)):
+            slot = (start + i) % len(self.ip_pool)
+            if self.ip_pool[slot] not in used:
+                if advance:
+                    self.conn.execute("UPDATE alloc_counters SET next = ? WHERE kind = 'ip'", (slot + 1,))
+                return self.ip_pool[slot]
+        raise AllocatorError('all {} rack slot IPs are leased'.format(len(self.ip_pool)))
+
+    def lease_row(self, row):
+        formats = dict((kind, fmt) for kind, (n, fmt) in self.counters().items())
+        return OrderedDict([('id', row['id']), ('station', row['station']), ('sn', formats['sn'].format(row['sn_num'])),
+                            ('ip', row['ip']), ('mac', formats['mac'].format(row['mac_num'])), ('expires', row['expires'])])
+
+    def take(self, station, repeat, now):
+        self.reclaim_expired(now)
+        row = None
+        if repeat is not None:
+            #A board tested again keeps its identity, unless it was handed out again in the meantime
+            row = self.conn.execute("SELECT * FROM leases WHERE id = ? AND (state = 'free' OR station = ?)", (repeat, station)).fetchone()
+        #The identity of the previous board of the station is only kept for a repeat
+        self.conn.execute("DELETE FROM leases WHERE station = ? AND state = 'used' AND id != ?", (station, row['id'] if row is not None else -1))
+        if row is None:
+            row = self.conn.execute("SELECT * FROM leases WHERE state = 'free' ORDER BY sn_num LIMIT 1").fetchone()
+        if row is None:
+            query = "SELECT * FROM leases WHERE station = ? AND state = 'reserved' ORDER BY sn_num LIMIT 1"
+            row = self.conn.execute(query, (station,)).fetchone()
+            if row is None:
+                self.reserve(station, now)
+                row = self.conn.execute(query, (station,)).fetchone()
+        if row['state'] in ('leased', 'used'):
+            ip = row['ip']
+        else:
+            #A repeated board is put back in its rack slot when nobody took it
+            ip = self.next_ip(True, row['ip'] if repeat is not None and row['id'] == repeat else None)
+        self.conn.execute("UPDATE leases SET state = 'leased', station = ?, ip = ?, expires = ? WHERE id = ?", (station, ip, now + self.lease_time, row['id']))
+        #Reserved pairs of the station are kept alive as long as it keeps testing
+        self.conn.execute("UPDATE leases SET expires = ? WHERE station = ? AND state = 'reserved'", (now + self.block_time, station))
+        return self.lease_row(self.conn.execute('SELECT * FROM leases WHERE id = ?', (row['id'],)).fetchone())
+
+    def lease(self, station, repeat=None):
+        """ lease the identity of the next board of station, repeat is the lease id of a board tested again """
+        return self.transaction(self.take, str(station), repeat, time.time())
+
+    def peek(self, station):
+        """ the identity lease() would hand out now, nothing is reserved """
+        def look():
+            row = self.conn.execute("SELECT * FROM leases WHERE state = 'free' ORDER BY sn_num LIMIT 1").fetchone()
+            if row is None:
+                row = self.conn.execute("SELECT * FROM leases WHERE station = ? AND state = 'reserved' ORDER BY sn_num LIMIT 1", (str(station),)).fetchone()
+            if row is None:
+                counters = self.counters()
+                row = {'id': None, 'station': None, 'sn_num': counters['sn'][0], 'mac_num': counters['mac'][0], 'ip': None, 'expires': None}
+            res = self.lease_row(row)
+            res['ip'] = self.next_ip(False)
+            return res
+        return self.transaction(look)
+
+    def settle(self, lease_id, confirm):
+        if confirm:
+            cur = self.conn.execute("UPDATE leases SET state = 'used', expires = ? WHERE id = ? AND state = 'leased'", (time.time() + self.lease_time, lease_id))
+        else:
+            cur = self.conn.execute("UPDATE leases SET state = 'free', station = NULL, expires = NULL WHERE id = ? AND state = 'leased'", (lease_id,))
+        return cur.rowcount == 1
+
+    def confirm(self, lease_id):
+        """ the board got its identity stored, it is used for good. False when the lease had expired and was reclaimed """
+        return self.transaction(self.settle, lease_id, True)
+
+    def release(self, lease_id):
+        """ the identity never reached the board, its SN and MAC are handed out again """
+        return self.transaction(self.settle, lease_id, False)
+
+    def status(self):
+        with self.lock:
+            res = OrderedDict((r['state'], r['n']) for r in self.conn.execute('SELECT state, COUNT(*) AS n FROM leases GROUP BY state'))
+            res['stations'] = OrderedDict((r['station'], r['n']) for r in self.conn.execute(
+                "SELECT station, COUNT(*) AS n FROM leases WHERE state = 'leased' GROUP BY station"))
+        return res
+
+def main():
+    #rffe_test imports the daemon, which imports this module
+    import rffe_test
+    parser = argparse.ArgumentParser(description='RFFEuC SN/MAC/IP leases')
+    parser.add_argument('--db', default=str(rffe_test.registry_path), help='Registry database')
+    parser.add_argument('--reclaim', action='store_true', help='Reclaim the expired leases now')
+    parser.add_argument('--peek', metavar='STATION', help='Show the identity the next board of a station would get')
+    args = parser.parse_args()
+
+    reg = BoardRegistry(args.db)
+    alloc = IdentityAllocator(reg, rffe_test.ip_pool)
+    if args.reclaim:
+        print('Reclaimed {} leases'.format(alloc.reclaim()))
+    if args.peek:
+        print(json.dumps(alloc.peek(args.peek)))
+    print(json.dumps(alloc.status()))
+    reg.close()
+
+if __name__ == '__main__':
+    main()
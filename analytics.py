@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import pathlib
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+TESTS = ('led', 'gpio', 'powerSupply', 'ethernet', 'feram')
+LED_CHANNELS = 4
+RAILS = ('3.3', '5.0')
+
+def record(path, mtime, test_results):
+    """ one row of the store, missing values are NaN/-1 """
+    res = test_results
+    leds = [np.nan]*LED_CHANNELS
+    for k, v in res.get('led', {}).items():
+        if isinstance(v, dict) and k.isdigit() and int(k) < LED_CHANNELS:
+            leds[int(k)] = v['value']
+    rails = [res.get('powerSupply', {}).get(r, {}).get('value', np.nan) for r in RAILS]
+    gpio_fail = sum(1 for v in res.get('gpio', {}).values() if isinstance(v, dict) and not v['result'])
+    return (str(path), mtime, res.get('date', '').replace(' ', 'T')[:19] or 'NaT',
+            res.get('boardSN', ''), res.get('manufSN', ''), res.get('testBoardSN', ''), str(res.get('lot', res.get('date', '')[:10])),
+            res.get('result', 0), [res[t]['result'] if isinstance(res.get(t), dict) and 'result' in res[t] else -1 for t in TESTS],
+            leds, rails, gpio_fail)
+
+class ResultStore(object):
+    """ columnar store of the archived test results, for yield and drift analysis
+
+    Every dump() JSON found under the scanned directories becomes one row.
+    Each column is kept in its own .npy file of store_dir and is memory mapped
+    on load, and update() only reads the dumps that are new or changed since
+    the last update. 'lot' is the "lot" entry of the results when present,
+    the test date otherwise.
+    """
+
+    COLUMNS = OrderedDict([('path', 'U'), ('mtime', 'f8'), ('date', 'datetime64[s]'),
+                           ('boardSN', 'U'), ('manufSN', 'U'), ('testBoardSN', 'U'), ('lot', 'U'),
+                           ('result', 'i1'), ('tests', 'i1'), ('led', 'f4'), ('rails', 'f4'), ('gpioFail', 'i2')])
+
+    def __init__(self, store_dir='./analytics/'):
+        self.store_dir = pathlib.Path(store_dir)
+        self.cols = self.load()
+
+    def empty(self):
+        shapes = {'tests': (0, len(TESTS)), 'led': (0, LED_CHANNELS), 'rails': (0, len(RAILS))}
+        return OrderedDict((name, np.zeros(shapes.get(name, (0,)), dtype=dt)) for name, dt in self.COLUMNS.items())
+
+    def load(self):
+        if not (self.store_dir / 'path.npy').is_file():
+            return self.empty()
+        return OrderedDict((name, np.load(str(self.store_dir / (name+'.npy')), mmap_mode='r')) for name in self.COLUMNS)
+
+    def save(self, cols):
+        #Columns are written next to the store and swapped in one by one, readers only see whole files
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        for name, col in cols.items():
+            tmp = self.store_dir / ('.'+name+'.npy')
+            np.save(str(tmp), np.ascontiguousarray(col))
+            os.replace(str(tmp), str(self.store_dir / (name+'.npy')))
+        self.cols = self.load()
+
+    def __len__(self):
+        return len(self.cols['path'])
+
+    def update(self, dump_dirs):
+        """ add the new and changed dumps found under dump_dirs, returns the number of rows read """
+        files = OrderedDict()
+        for d in dump_dirs:
+            for f in pathlib.Path(d).rglob('*.json'):
+                files[str(f.resolve())] = f.stat().st_mtime
+        known = dict(zip(self.cols['path'].tolist(), self.cols['mtime'].tolist()))
+        changed = [p for p, m in files.items() if known.get(p) != m]
+        rows = []
+        for p in changed:
+            try:
+                with open(p) as dump_f:
+                    res = json.loads(dump_f.read())
+            except (OSError, ValueError):
+                continue
+            if isinstance(res, dict) and 'boardSN' in res:
+                rows.append(record(p, files[p], res))
+        if not rows:
+            return 0
+        new = OrderedDict()
+        for i, (name, dt) in enumerate(self.COLUMNS.items()):
+            new[name] = np.array([r[i] for r in rows], dtype=dt)
+        keep = ~np.isin(self.cols['path'], np.array([r[0] for r in rows]))
+        self.save(OrderedDict((name, np.concatenate([np.asarray(self.cols[name])[keep], new[name]]).astype(self.promote(name, new[name])))
+                              for name in self.COLUMNS))
+        return len(rows)
+
+    def promote(self, name, new):
+        #Fixed width strings grow to the longest value seen
+        old = self.cols[name]
+        return np.promote_types(old.dtype, new.dtype) if old.dtype.kind == 'U' else old.dtype
+
+    def select(self, since=None, until=None, testBoardSN=None):
+        """ boolean mask of the rows in the date range and test board """
+        mask = np.ones(len(self), dtype=bool)
+        if since is not None:
+            mask &= self.cols['date'] >= np.datetime64(since)
+        if until is not None:
+            mask &= self.cols['date'] < np.datetime64(until)
+        if testBoardSN is not None:
+            mask &= self.cols['testBoardSN'] == testBoardSN
+        return mask
+
+    def keys(self, key):
+        #'day' groups by test date
+        if key == 'day':
+            return np.asarray(self.cols['date']).astype('datetime64[D]')
+        return np.asarray(self.cols[key])
+
+    def group(self, key, mask=None):
+        keys = self.keys(key) if mask is None else self.keys(key)[mask]
+        return np.unique(keys, return_inverse=True)
+
+    def yield_by(self, key='lot', mask=None):
+        """ {key value: (boards, passed, yield)}, key is a string column or 'day' """
+        groups, inv = self.group(key, mask)
+        result = self.cols['result'] if mask is None else self.cols['result'][mask]
+        boards = np.bincount(inv, minlength=len(groups))
+        passed = np.bincount(inv, weights=(result > 0), minlength=len(groups)).astype(int)
+        return OrderedDict((str(g), (int(b), int(p), float(p)/b if b else float('nan'))) for g, b, p in zip(groups, boards, passed))
+
+    def pareto(self, mask=None):
+        """ [(test, failures, share of all failures)], most frequent failure first """
+        tests = self.cols['tests'] if mask is None else self.cols['tests'][mask]
+        fails = (np.asarray(tests) == 0).sum(axis=0)
+        total = fails.sum()
+        order = np.argsort(-fails, kind='stable')
+        return [(TESTS[i], int(fails[i]), float(fails[i])/total if total else 0.0) for i in order]
+
+    def distribution(self, column, labels, bins=20, mask=None):
+        """ summary statistics and histogram of each channel of a measurement column """
+        data = np.asarray(self.cols[column] if mask is None else self.cols[column][mask], dtype='f8')
+        stats = OrderedDict()
+        for i, label in enumerate(labels):
+            v = data[:, i]
+            v = v[~np.isnan(v)]
+            if not len(v):
+                continue
+            counts, edges = np.histogram(v, bins=bins)
+            p1, p50, p99 = np.percentile(v, (1, 50, 99))
+            stats[label] = OrderedDict([('n', len(v)), ('mean', v.mean()), ('std', v.std()), ('min', v.min()), ('p1', p1), ('p50', p50),
+                                        ('p99', p99), ('max', v.max()), ('hist', counts.tolist()), ('edges', edges.tolist())])
+        return stats
+
+    def rails(self, bins=20, mask=None):
+        return self.distribution('rails', RAILS, bins, mask)
+
+    def leds(self, bins=20, mask=None):
+        return self.distribution('led', [str(i) for i in range(LED_CHANNELS)], bins, mask)
+
+    def drift(self, period='W', mask=None):
+        """ mean rail and LED readings of each test board per period (numpy datetime unit: D, W, M)
+
+        A test board whose readings move while the boards under test don't change
+        needs to be recalibrated. Returns {testBoardSN: [(period start, boards, rail means, LED means)]}.
+        """
+        sel = ~np.isnat(self.cols['date'])
+        if mask is not None:
+            sel &= mask
+        boards, board_idx = np.unique(np.asarray(self.cols['testBoardSN'])[sel], return_inverse=True)
+        periods = np.asarray(self.cols['date'])[sel].astype('datetime64['+period+']')
+        uperiods, period_idx = np.unique(periods, return_inverse=True)
+        key = board_idx*len(uperiods) + period_idx
+        keys, inv, counts = np.unique(key, return_inverse=True, return_counts=True)
+        values = np.hstack([np.asarray(self.cols['rails'])[sel], np.asarray(self.cols['led'])[sel]]).astype('f8')
+        valid = ~np.isnan(values)
+        sums = np.zeros((len(keys), values.shape[1]))
+        n = np.zeros((len(keys), values.shape[1]))
+        np.add.at(sums, inv, np.where(valid, values, 0.0))
+        np.add.at(n, inv, valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / n
+        drift = OrderedDict((str(b), []) for b in boards)
+        for k, c, m in zip(keys, counts, means):
+            drift[str(boards[k // len(uperiods)])].append((str(uperiods[k % len(uperiods)]), int(c), m[:len(RAILS)].tolist(), m[len(RAILS):].tolist()))
+        return drift
+
+    def rebuild(self, dump_dirs):
+        shutil.rmtree(str(self.store_dir), ignore_errors=True)
+        self.cols = self.empty()
+        return self.update(dump_dirs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Yield, failure and drift analytics over the archived RFFEuC test results')
+    parser.add_argument('dumps', nargs='*', default=['./reports/'], help='Directories searched for dump() JSON files')
+    parser.add_argument('--store', default='./analytics/', help='Column store directory')
+    parser.add_argument('--rebuild', action='store_true', help='Drop the store and read every dump again')
+    parser.add_argument('--yield-by', default='lot', choices=['lot', 'testBoardSN', 'day'], help='Grouping of the yield table')
+    parser.add_argument('--since', help='First test date (YYYY-MM-DD)')
+    parser.add_argument('--until', help='Last test date, exclusive (YYYY-MM-DD)')
+    parser.add_argument('--drift', default='W', choices=['D', 'W', 'M'], help='Period of the test board drift table')
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    n = store.rebuild(args.dumps) if args.rebuild else store.update(args.dumps)
+    print('{} boards in the store ({} read)'.format(len(store), n))
+    mask = store.select(args.since, args.until)
+
+    print('\nYield by {}:'.format(args.yield_by))
+    for k, (boards, passed, y) in store.yield_by(args.yield_by, mask).items():
+        print('{:>20} {:6d} boards {:6d} pass {:6.1%}'.format(k, boards, passed, y))
+
+    print('\nFailure Pareto:')
+    for test, fails, share in store.pareto(mask):
+        print('{:>20} {:6d} {:6.1%}'.format(test, fails, share))
+
+    print('\nRails [V]:')
+    for rail, s in store.rails(mask=mask).items():
+        print('{:>20} mean {:.3f} std {:.4f} p1 {:.3f} p99 {:.3f}'.format(rail+'V', s['mean'], s['std'], s['p1'], s['p99']))
+
+    print('\nTest board drift (mean 3.3V / 5.0V per period):')
+    for board, rows in store.drift(args.drift, mask).items():
+        for period, boards, rails, leds in rows:
+            print('{:>20} {:>12} {:6d} boards {}'.format(board, period, boards, ' '.join('{:.3f}'.format(r) for r in rails)))
+
+if __name__ == '__main__':
+    main()
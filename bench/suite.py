@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+
+import rffe_test
+from allocator import IdentityAllocator
+from registry import BoardRegistry, format_mac
+from report import report_backends
+from rffe_uc import RFFEuC_Test
+from expect import Expect, Phase
+
+#Synthetic firmware logs, see rffe_sim.RFFEuC_Sim.test_session() for the real dialogue
+LOG_KINDS = ('nominal', 'verbose', 'failures')
+GPIO_PAIRS = [('P0_4', 'P0_5'), ('P0_6', 'P0_7'), ('P0_8', 'P0_9'), ('P0_10', 'P0_11'),
+              ('P1_18', 'P1_19'), ('P1_20', 'P1_21'), ('P1_22', 'P1_23'), ('P1_24', 'P1_25')]
+PARSERS = ('LED_parse', 'GPIOLoopback_parse', 'PowerSupply_parse', 'FeRAM_parse', 'Ethernet_parse', 'parse_results')
+REGISTRY_SIZES = (10, 10000, 100000)
+
+def synthetic_log(kind, rand, verbosity=20):
+    """ test firmware output of one board
+
+    'verbose' interleaves 'verbosity' debug lines after every firmware line,
+    'failures' makes every subtest fail.
+    """
+    fail = kind == 'failures'
+    lines = ['RFFEuC Test Firmware (synthetic)']
+    for led in range(4):
+        lines.append('[LED] LED {}: {:.3f}'.format(led, rand.uniform(3.0, 3.2) if fail else rand.uniform(0.5, 1.5)))
+    for pin1, pin2 in GPIO_PAIRS:
+        lines.append('Loopback [{}] <-> [{}]: {}'.format(pin1, pin2, 'Fail' if fail else 'Pass'))
+    for rail, nominal in (('3.3', 3.3), ('5.0', 5.0)):
+        lines.append('Power Supply {}V: {:.3f}'.format(rail, nominal * (0.8 if fail else rand.uniform(0.98, 1.02))))
+    pattern = bytes(rand.getrandbits(8) for i in range(256))
+    for i in range(0, len(pattern), 16):
+        lines.append('[RANDOM] '+' '.join('{:02X}'.format(b) for b in pattern[i:i+16]))
+    lines.append('[FERAM] {}'.format('Fail' if fail else 'Pass'))
+    lines.extend(['Insert MAC:', 'Insert IP:', 'Insert Mask:', 'Insert Gateway:', 'Initializing ETH stack'])
+    if fail:
+        lines.append('ETH link down!')
+    else:
+        lines.append('Listening on port: 6791')
+        lines.append('Received: "Test msg!"')
+    lines.append('End of tests!')
+    if kind == 'verbose':
+        noisy = []
+        for ln in lines:
+            noisy.append(ln)
+            noisy.extend('[DBG] t={} adc={} reg=0x{:08X}'.format(rand.getrandbits(20), rand.getrandbits(12), rand.getrandbits(32)) for i in range(verbosity))
+        lines = noisy
+    return [ln+'\r\n' for ln in lines]
+
+def timed(fn, repeat, setup=None):
+    """ run fn() 'repeat' times, returns min/median/mean in seconds """
+    samples = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return OrderedDict([('repeat', repeat), ('min', min(samples)), ('median', statistics.median(samples)), ('mean', statistics.mean(samples))])
+
+def board_test(log, mask_path):
+    uc = RFFEuC_Test(('192.168.2.201', '255.255.255.0', '192.168.2.1', '200000000001'), '/dev/null', 'Bench', 'RFFEuC:1.2', 'CN00001', 'M000001', mask_path)
+    uc.log = list(log)
+    return uc
+
+def bench_parse(logs, mask_path, repeat):
+    res = OrderedDict()
+    for kind, log in logs.items():
+        uc = board_test(log, mask_path)
+        res[kind] = OrderedDict()
+        for name in PARSERS:
+            def reset():
+                #Force parse_results() to go through the whole log instead of re-grading
+                uc.parser = None
+            res[kind][name] = timed(getattr(uc, name), repeat, reset)
+        res[kind]['lines'] = len(log)
+    return res
+
+def graded_results(logs, mask_path):
+    results = OrderedDict()
+    for kind, log in logs.items():
+        uc = board_test(log, mask_path)
+        uc.deploy_info(uc.parse_results())
+        results[kind] = uc
+    return results
+
+def board_batch(n, rand, mask_path, verbosity):
+    """ graded results of n distinct nominal boards """
+    batch = []
+    for i in range(n):
+        uc = board_test(synthetic_log('nominal', rand, verbosity), mask_path)
+        uc.test_results['boardSN'] = 'CN{:05d}'.format(i+1)
+        uc.deploy_info(uc.parse_results())
+        batch.append(uc)
+    return batch
+
+def per_item(t, n):
+    return OrderedDict((k, v/n if k != 'repeat' else v) for k, v in t.items())
+
+def bench_report(tests, batch, out_dir, repeat, pdf):
+    """ build (and generate) time of each backend for each log kind, and per report over a batch of distinct boards """
+    res = OrderedDict()
+    for backend in ('latex', 'fast', 'html'):
+        res[backend] = OrderedDict()
+        for kind, uc in tests.items():
+            def tex():
+                rep = report_backends[backend](uc.test_results)
+                rep.build()
+                if backend != 'html':
+                    rep.doc.dumps()
+            entry = OrderedDict([('build', timed(tex, repeat))])
+            if backend == 'html' or pdf:
+                def generate():
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        report_backends[backend](uc.test_results).generate(out_dir, 'bench_{}_{}'.format(backend, kind))
+                entry['generate'] = timed(generate, max(1, repeat//10) if backend != 'html' else repeat)
+            else:
+                entry['generate'] = None
+            res[backend][kind] = entry
+        if batch:
+            def build_batch():
+                for uc in batch:
+                    rep = report_backends[backend](uc.test_results)
+                    rep.build()
+                    if backend != 'html':
+                        rep.doc.dumps()
+            entry = OrderedDict([('reports', len(batch)), ('build', per_item(timed(build_batch, max(1, repeat//10)), len(batch)))])
+            if backend == 'html' or pdf:
+                def generate_batch():
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        for i, uc in enumerate(batch):
+                            report_backends[backend](uc.test_results).generate(out_dir, 'bench_{}_batch_{}'.format(backend, i))
+                entry['generate'] = per_item(timed(generate_batch, 1), len(batch))
+            else:
+                entry['generate'] = None
+            res[backend]['batch'] = entry
+    return res
+
+class BufferPort(object):
+    """ in memory serial port handing out the log in chunks of 'chunk' bytes """
+
+    def __init__(self, data, chunk):
+        self.data = memoryview(data)
+        self.chunk = chunk
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.data) - self.pos)
+
+    def readinto(self, b):
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+    def write(self, data):
+        return len(data)
+
+def bench_serial(logs, repeat, chunks=(64, 4096)):
+    """ a whole self test session through Expect and LineTransport, as if the port delivered 'chunk' bytes per read """
+    res = OrderedDict()
+    for kind, log in logs.items():
+        data = ''.join(log).encode('ascii')
+        res[kind] = OrderedDict([('bytes', len(data))])
+        for chunk in chunks:
+            def session():
+                Expect(BufferPort(data, chunk), [('Insert MAC:', '200000000001\r\n')], [Phase('test', 'End of tests!', 60.0)], end='End of tests!').run()
+            res[kind][str(chunk)] = timed(session, repeat)
+    return res
+
+def bench_dump(tests, out_dir, repeat):
+    return OrderedDict((kind, timed(lambda: uc.dump(os.path.join(out_dir, 'dump_'+kind+'.json')), repeat)) for kind, uc in tests.items())
+
+def fill_registry(registry, n):
+    #Bulk load, one transaction for the whole table
+    pool = rffe_test.ip_pool
+    registry.conn.execute('BEGIN IMMEDIATE')
+    for i in range(n):
+        registry.insert(('CN{:05d}'.format(i + 1), pool[i % len(pool)], format_mac('{:012X}'.format(0x200000000001 + i)), 'pass', 'M{:06d}'.format(i), None, None))
+    registry.conn.execute('COMMIT')
+
+def bench_registry(out_dir, sizes, repeat):
+    """ the per board update done by the bench: lease the next SN/IP/MAC, record the result and confirm the lease """
+    res = OrderedDict()
+    for n in sizes:
+        registry = BoardRegistry(os.path.join(out_dir, 'boards_{}.db'.format(n)))
+        fill_registry(registry, n)
+        allocator = IdentityAllocator(registry, rffe_test.ip_pool)
+        def update():
+            lease = allocator.lease('bench')
+            registry.add(lease['sn'], lease['ip'], lease['mac'], True, 'BENCH')
+            allocator.confirm(lease['id'])
+        leases = []
+        def release():
+            #Keeps the rack slot IPs from running out, outside the timed call
+            while leases:
+                allocator.release(leases.pop()['id'])
+        res[str(n)] = OrderedDict([('lease', timed(lambda: leases.append(allocator.lease('bench')), repeat, setup=release)),
+                                   ('update', timed(update, repeat)),
+                                   ('find_mac', timed(lambda: registry.find(mac='200000000005'), repeat))])
+        release()
+        registry.close()
+    return res
+
+def git_describe():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO, stderr=subprocess.DEVNULL).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of log parsing, grading, reports, dumps and registry updates')
+    parser.add_argument('-r', '--repeat', type=int, default=50, help='Repetitions of each measurement')
+    parser.add_argument('--verbosity', type=int, default=20, help='Debug lines after each firmware line in the verbose log')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(REGISTRY_SIZES), help='Registry sizes [boards]')
+    parser.add_argument('--reports', type=int, default=50, help='Distinct boards the reports are also timed over, per report')
+    parser.add_argument('--pdf', action='store_true', help='Also time the PDF generation (needs pdflatex)')
+    parser.add_argument('--mask', default=os.path.join(REPO, 'mask.json'), help='Test mask file')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    logs = OrderedDict((kind, synthetic_log(kind, rand, args.verbosity)) for kind in LOG_KINDS)
+    pdf = args.pdf and shutil.which('pdflatex') is not None
+    if args.pdf and not pdf:
+        print('pdflatex not found, skipping the PDF generation')
+
+    results = OrderedDict()
+    results['date'] = str(datetime.datetime.today())
+    results['commit'] = git_describe()
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    results['args'] = vars(args)
+
+    out_dir = tempfile.mkdtemp(prefix='rffe_bench_')
+    try:
+        print('Parsing...')
+        results['parse'] = bench_parse(logs, args.mask, args.repeat)
+        tests = graded_results(logs, args.mask)
+        print('Serial framing...')
+        results['serial'] = bench_serial(logs, args.repeat)
+        print('Reports...')
+        results['report'] = bench_report(tests, board_batch(args.reports, rand, args.mask, args.verbosity), out_dir, args.repeat, pdf)
+        print('Dumps...')
+        results['dump'] = bench_dump(tests, out_dir, args.repeat)
+        print('Registry...')
+        results['registry'] = bench_registry(out_dir, args.sizes, args.repeat)
+    finally:
+        shutil.rmtree(out_dir)
+
+    with open(args.output, 'w') as out_f:
+        json.dump(results, out_f, indent=4)
+
+    for kind, r in results['parse'].items():
+        print('{:>9} log ({:5d} lines): parse_results {:8.3f} ms'.format(kind, r['lines'], 1e3*r['parse_results']['median']))
+    for kind, r in results['serial'].items():
+        print('{:>9} log: serial session {:8.3f} ms ({:.1f} MB/s in 4 KiB reads)'.format(kind, 1e3*r['4096']['median'], r['bytes']/r['4096']['median']/1e6))
+    for backend, r in results['report'].items():
+        print('{:>9} report: build {:8.3f} ms'.format(backend, 1e3*r['nominal']['build']['median']), end='')
+        if 'batch' in r:
+            gen = r['batch']['generate']
+            print(', {} boards {:8.3f} ms per report (generate {})'.format(r['batch']['reports'], 1e3*r['batch']['build']['median'],
+                                                                        '-' if gen is None else '{:.3f} ms'.format(1e3*gen['median'])), end='')
+        print()
+    for n, r in results['registry'].items():
+        print('{:>9} boards: lease {:8.3f} ms, registry update {:8.3f} ms'.format(n, 1e3*r['lease']['median'], 1e3*r['update']['median']))
+    print('Results written to '+args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import os
+import socket
+import struct
+import threading
+
+from programmer import FirmwareImage, firmware_cache
+
+class DeployImageBuilder(object):
+    """ builds per board deploy images from a single template binary
+
+    The template is built with a known network configuration (template_conf,
+    a dict with 'ip', 'mask' and 'gateway'). The offsets of those fields are
+    indexed once and each build copies the template and patches the fields in
+    place. Fields are stored either as NUL terminated strings ('ascii') or as
+    4 byte addresses in network order ('binary'). Each template value must be
+    found exactly once, otherwise the template is rejected.
+    """
+
+    FIELDS = ('ip', 'mask', 'gateway')
+    #Word 7 of the LPC17xx vector table holds the 2's complement of the sum of words 0-6
+    VECTOR_CHECKSUM_WORDS = 7
+
+    def __init__(self, template_path, template_conf, encoding='ascii', cache_size=64):
+        self.template_path = template_path
+        self.template_conf = template_conf
+        self.encoding = encoding
+        self.cache_size = cache_size
+        self.images = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.template = firmware_cache.get(self.template_path)
+        self.offsets = {}
+        for f in self.FIELDS:
+            self.offsets[f] = self.index(f, self.template_conf[f])
+        self.images.clear()
+
+    def encode(self, addr):
+        if self.encoding == 'binary':
+            return socket.inet_aton(addr)
+        return addr.encode('ascii')+b'\0'
+
+    def index(self, field, value):
+        data = self.template.data
+        needle = self.encode(value)
+        offset = data.find(needle)
+        if offset < 0:
+            raise ValueError('Template {} does not contain the {} "{}"'.format(self.template_path, field, value))
+        if data.find(needle, offset+1) > -1:
+            raise ValueError('Template {} contains the {} "{}" more than once'.format(self.template_path, field, value))
+        size = len(needle)
+        if self.encoding != 'binary':
+            #The string buffer extends over the NUL padding that follows it
+            while offset+size < len(data) and size < 16 and data[offset+size] == 0:
+                size += 1
+        return offset, size
+
+    def fresh(self):
+        img = firmware_cache.get(self.template_path)
+        if img is not self.template:
+            self.load()
+
+    def patch(self, buf, field, addr):
+        offset, size = self.offsets[field]
+        value = self.encode(addr)
+        if len(value) > size:
+            raise ValueError('{} "{}" does not fit in the {} bytes reserved in the template'.format(field, addr, size))
+        mv = memoryview(buf)
+        mv[offset:offset+len(value)] = value
+        mv[offset+len(value):offset+size] = bytes(size-len(value))
+        return offset
+
+    def vector_checksum(self, buf):
+        words = struct.unpack_from('<7I', buf, 0)
+        struct.pack_into('<I', buf, 4*self.VECTOR_CHECKSUM_WORDS, (-sum(words)) & 0xFFFFFFFF)
+
+    def build(self, ip, mask, gateway):
+        key = (ip, mask, gateway)
+        with self.lock:
+            self.fresh()
+            img = self.images.get(key)
+            if img is not None:
+                return img
+            buf = bytearray(self.template.data)
+            offsets = [self.patch(buf, f, a) for f, a in zip(self.FIELDS, key)]
+            if min(offsets) < 4*(self.VECTOR_CHECKSUM_WORDS+1):
+                self.vector_checksum(buf)
+            img = FirmwareImage(buf, name='{}[{}]'.format(self.template_path, ip))
+            if len(self.images) >= self.cache_size:
+                self.images.pop(next(iter(self.images)))
+            self.images[key] = img
+            return img
+
+_builders = {}
+#Templates that could not be loaded, with the state of their file at the time
+_failed = {}
+_builders_lock = threading.Lock()
+
+def template_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def deploy_image_builder(conf):
+    """ the builder of the "deploy" entry of a mask, a template that can't be used is only retried once its file changes """
+    key = (conf['template'], conf['templateIP'], conf['templateMask'], conf['templateGateway'], conf.get('encoding', 'ascii'))
+    with _builders_lock:
+        if key not in _builders:
+            stamp = template_stamp(conf['template'])
+            failed = _failed.get(key)
+            if failed is not None and failed[0] == stamp:
+                raise failed[1]
+            try:
+                _builders[key] = DeployImageBuilder(conf['template'], {'ip': conf['templateIP'], 'mask': conf['templateMask'], 'gateway': conf['templateGateway']}, conf.get('encoding', 'ascii'))
+            except (OSError, ValueError) as e:
+                _failed[key] = (stamp, e)
+                raise
+            _failed.pop(key, None)
+        return _builders[key]
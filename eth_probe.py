@@ -0,0 +1,211 @@
+import socket
+import struct
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+#struct tcp_info (linux/tcp.h) up to tcpi_total_retrans
+TCP_INFO = struct.Struct('8B24I')
+TCPI_UNACKED = 8+4
+TCPI_RTT = 8+15
+TCPI_RTTVAR = 8+16
+TCPI_TOTAL_RETRANS = 8+23
+#Not exported by every Python build, the value is the same on all Linux architectures
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+ARP_TABLE = '/proc/net/arp'
+#ATF_COM, the entry holds a resolved MAC
+ARP_COMPLETE = 0x2
+
+def tcp_info(sock):
+    """ kernel TCP statistics of a connected socket, None where TCP_INFO is not available """
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        return TCP_INFO.unpack(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size))
+    except (OSError, struct.error):
+        return None
+
+def arp_entry(ip, path=ARP_TABLE):
+    """ (MAC, device) the kernel resolves ip to, None when it has no complete entry """
+    try:
+        with open(path) as arp_f:
+            lines = arp_f.read().splitlines()[1:]
+    except OSError:
+        return None
+    for ln in lines:
+        fields = ln.split()
+        if len(fields) >= 6 and fields[0] == ip and int(fields[2], 16) & ARP_COMPLETE:
+            return fields[3].lower(), fields[5]
+    return None
+
+def replace_neighbour(ip, mac, device):
+    """ point the kernel neighbour entry of ip at mac, needs CAP_NET_ADMIN """
+    try:
+        subprocess.run(['ip', 'neigh', 'replace', ip, 'lladdr', mac, 'dev', device, 'nud', 'reachable'],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=2.0)
+        return True
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+class EthTestConf(object):
+    """ network settings a station tests boards with
+
+    ip, mask and gateway are programmed into the board for the Ethernet test,
+    interface and source are the station side: probe sockets are bound to
+    the interface (SO_BINDTODEVICE) and to the source address. A setting left
+    None is taken from the test mask.
+    """
+
+    FIELDS = ('ip', 'mask', 'gateway', 'interface', 'source')
+
+    def __init__(self, ip=None, mask=None, gateway=None, interface=None, source=None):
+        self.ip = ip
+        self.mask = mask
+        self.gateway = gateway
+        self.interface = interface
+        self.source = source
+
+    @classmethod
+    def from_dict(cls, conf):
+        return cls(*[conf.get(k) for k in cls.FIELDS])
+
+    def to_dict(self):
+        return OrderedDict((k, getattr(self, k)) for k in self.FIELDS)
+
+    def merged(self, ip, mask, gateway):
+        return EthTestConf(self.ip or ip, self.mask or mask, self.gateway or gateway, self.interface, self.source)
+
+class EthProbe(object):
+    """ background Ethernet test of the RFFEuC TCP server
+
+    Connection attempts start as soon as the firmware is listening and are
+    retried with exponential backoff until 'deadline', so a slow PHY link-up
+    is waited for instead of failing the board. Once connected the test
+    message is sent, followed by 'payload' bytes to measure the sustained
+    throughput. Round-trip time and retransmissions are read from the kernel
+    (TCP_INFO), where it is not available the handshake time is used as RTT.
+
+    Sockets are bound to 'interface' and 'source' when given, so stations
+    on one host each reach their own board. When the board's 'mac' is given
+    a kernel ARP entry still holding the MAC of a previous board at the same
+    IP is replaced first, otherwise the connection would wait for the entry
+    to go stale. "arp" in results is 'stale' when it couldn't be replaced.
+
+    on_fail is called from the probe thread when the board could not be
+    reached, results holds the measurements once join() returns.
+    """
+
+    def __init__(self, host, port, message, deadline, payload=0, attempt_timeout=1.0, backoff=(0.02, 1.0), on_fail=None, interface=None, source=None, mac=None):
+        self.host = host
+        self.interface = interface
+        self.source = source
+        self.mac = mac
+        self.port = port
+        self.message = message
+        self.deadline = deadline
+        self.payload = payload
+        self.attempt_timeout = attempt_timeout
+        self.backoff = backoff
+        self.on_fail = on_fail
+        self.results = OrderedDict()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='eth-probe', daemon=True)
+        self.thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.results
+
+    def socket(self):
+        #Binding errors are a station setup problem, they are not retried
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if self.interface:
+                sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.interface.encode('ascii'))
+            if self.source:
+                sock.bind((self.source, 0))
+        except OSError as e:
+            sock.close()
+            raise OSError('cannot bind to {} {}: {}'.format(self.interface or '', self.source or '', e))
+        return sock
+
+    def check_arp(self):
+        entry = arp_entry(self.host)
+        if entry is None or entry[0] == self.mac:
+            return 'fresh'
+        #Left by the previous board tested at this address
+        if replace_neighbour(self.host, self.mac, self.interface or entry[1]):
+            return 'replaced'
+        print('[WARNING] ARP entry of {} still points at {}, could not replace it'.format(self.host, entry[0]))
+        return 'stale'
+
+    def connect(self, end):
+        delay = self.backoff[0]
+        attempts = 0
+        while True:
+            attempts += 1
+            remaining = end - time.monotonic()
+            start = time.monotonic()
+            sock = self.socket()
+            try:
+                sock.settimeout(max(0.001, min(self.attempt_timeout, remaining)))
+                sock.connect((self.host, self.port))
+                return sock, attempts, time.monotonic() - start
+            except OSError as e:
+                sock.close()
+                if time.monotonic() >= end:
+                    raise OSError('{} after {} attempts'.format(e, attempts))
+            time.sleep(max(0.0, min(delay, end - time.monotonic())))
+            delay = min(2*delay, self.backoff[1])
+
+    def wait_acked(self, sock, end):
+        #Data is only known to have reached the board once the kernel got its ACK
+        while time.monotonic() < end:
+            info = tcp_info(sock)
+            if info is None or info[TCPI_UNACKED] == 0:
+                return
+            time.sleep(0.001)
+
+    def run(self):
+        res = self.results
+        res['connected'] = False
+        start = time.monotonic()
+        end = start + self.deadline
+        if self.mac is not None:
+            res['arp'] = self.check_arp()
+        try:
+            sock, attempts, handshake = self.connect(end)
+        except OSError as e:
+            print('Fail to connect! ({})'.format(e))
+            res['error'] = str(e)
+            if self.on_fail is not None:
+                self.on_fail()
+            return
+        res['connected'] = True
+        res['attempts'] = attempts
+        res['connectTime'] = 1e3 * (time.monotonic() - start)
+        res['rtt'] = 1e3 * handshake
+        with sock:
+            try:
+                sock.settimeout(max(0.001, end - time.monotonic()))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(self.message)
+                if self.payload:
+                    t0 = time.monotonic()
+                    sock.sendall(bytes(self.payload))
+                    self.wait_acked(sock, end)
+                    res['throughput'] = 8e-6 * self.payload / max(time.monotonic() - t0, 1e-9)
+                info = tcp_info(sock)
+                if info is not None:
+                    res['rtt'] = 1e-3 * info[TCPI_RTT]
+                    res['rttVar'] = 1e-3 * info[TCPI_RTTVAR]
+                    res['retransmits'] = info[TCPI_TOTAL_RETRANS]
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError as e:
+                print('Ethernet transfer failed! ({})'.format(e))
+                res['error'] = str(e)
@@ -0,0 +1,127 @@
+import re
+import threading
+import time
+
+from transport import LineTransport
+
+class ExpectTimeout(Exception):
+
+    def __init__(self, phase, deadline, last_line=''):
+        self.phase = phase
+        self.deadline = deadline
+        self.last_line = last_line
+        super(ExpectTimeout, self).__init__('Phase "{}" did not finish within {:.1f}s (last line: {!r})'.format(phase, deadline, last_line))
+
+class Phase(object):
+
+    def __init__(self, name, until, deadline):
+        self.name = name
+        self.until = re.compile(until)
+        self.deadline = deadline
+
+class Expect(object):
+    """ table driven expect/respond engine for the RFFEuC serial dialogue
+
+    responses is a list of (marker, response) pairs. All markers are compiled
+    into one alternation, so each line is matched once. A response may be a
+    str/bytes to be written back or a callable taking the line and returning
+    what should be written (None for nothing, False to stop the session).
+    Every line is logged and handed to on_line before it is answered, on_line
+    may also return False to stop the session. on_phase is called with the
+    name of each phase as it ends. stop() ends the session from another
+    thread, run() then returns False.
+
+    Lines are framed by a transport.LineTransport, which may be shared by
+    successive sessions on the same port.
+
+    phases is a list of Phase objects, each one with its own deadline counted
+    from the end of the previous phase. The session finishes when the end
+    marker or the last phase's 'until' pattern is seen, and ExpectTimeout is
+    raised as soon as the running phase misses its deadline.
+    """
+
+    def __init__(self, port, responses, phases, end=None, log=None, on_line=None, on_phase=None, encoding='ascii', transport=None):
+        self.port = port
+        self.transport = transport if transport is not None else LineTransport(port)
+        self.on_line = on_line
+        self.on_phase = on_phase
+        self.encoding = encoding
+        self.log = log if log is not None else []
+        self.phases = phases
+        self.end = re.compile(re.escape(end)) if end else None
+        self.actions = []
+        alternatives = []
+        for i, (marker, response) in enumerate(responses):
+            alternatives.append('(?P<r{}>{})'.format(i, re.escape(marker)))
+            self.actions.append(response)
+        self.matcher = re.compile('|'.join(alternatives)) if alternatives else None
+        #Same markers on the raw bytes, a partial line is only decoded when it is a prompt
+        self.prompt = re.compile('|'.join(alternatives).encode(encoding)) if alternatives else None
+        self.phase = None
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def readline(self, deadline):
+        t = self.transport
+        while True:
+            ln = t.next_line()
+            if ln is not None:
+                return str(ln, self.encoding, 'replace')
+            if time.monotonic() >= deadline or self.stopped.is_set():
+                return None
+            #Blocks at most for the port timeout, so deadlines are checked regularly
+            if not t.fill() and self.prompt is not None and self.prompt.search(t.pending()):
+                #Prompts are not newline terminated, answer them as soon as the line goes quiet
+                return str(t.take_pending(), self.encoding, 'replace')
+
+    def respond(self, ln):
+        if self.matcher is None:
+            return True
+        m = self.matcher.search(ln)
+        if m is None:
+            return True
+        action = self.actions[int(m.lastgroup[1:])]
+        if callable(action):
+            action = action(ln)
+        if action is False:
+            return False
+        if action:
+            self.port.write(action if isinstance(action, bytes) else bytes(action, self.encoding))
+        return True
+
+    def run(self):
+        try:
+            return self.dialogue()
+        finally:
+            #Close the phase that was running when the session ended
+            if self.on_phase is not None and self.phase is not None:
+                self.on_phase(self.phase.name)
+
+    def dialogue(self):
+        phases = iter(self.phases)
+        self.phase = next(phases, None)
+        deadline = time.monotonic() + self.phase.deadline if self.phase else float('inf')
+        last = ''
+        while self.phase is not None:
+            ln = self.readline(deadline)
+            if ln is None:
+                if self.stopped.is_set():
+                    return False
+                raise ExpectTimeout(self.phase.name, self.phase.deadline, last.strip())
+            last = ln
+            self.log.append(ln)
+            if self.on_line is not None and self.on_line(ln) is False:
+                return False
+            if not self.respond(ln):
+                return False
+            if self.end is not None and self.end.search(ln):
+                return True
+            if self.phase.until.search(ln):
+                if self.on_phase is not None:
+                    self.on_phase(self.phase.name)
+                self.phase = next(phases, None)
+                if self.phase is not None:
+                    deadline = time.monotonic() + self.phase.deadline
+        return True
@@ -0,0 +1,170 @@
+import re
+from collections import OrderedDict
+
+from masks import CompiledMask, compile_mask
+
+class RFFEuC_LogParser(object):
+    """ single pass parser for the RFFEuC test firmware output
+
+    Each line is dispatched to its subtest by one precompiled marker regex and
+    the matching section of test_results is updated right away, so the results
+    are complete as soon as 'End of tests!' is fed. The same parser is used to
+    re-grade archived logs with parse().
+    """
+
+    SECTIONS = ('led', 'gpio', 'powerSupply', 'ethernet', 'feram')
+
+    MARKERS = re.compile(r'(?P<led>\[LED\])|(?P<gpio>Loopback)|(?P<powerSupply>Power Supply)|(?P<random>\[RANDOM\])|(?P<feram>\[FERAM\])|(?P<ethernet>Received:)|(?P<end>End of tests!)')
+    NUMBER = re.compile(r'\d*\.?\d+')
+    PIN = re.compile(r'\[([^]]+)\]')
+    PASS_FAIL = re.compile('(Pass|Fail)')
+    HEX_BYTE = re.compile(r'[0-9a-fA-F][0-9a-fA-F]')
+    QUOTED = re.compile(r'"(.*?)"')
+
+    def __init__(self, test_results, test_mask, eth_info):
+        self.test_results = test_results
+        #A mask dict is compiled here, callers testing many boards should pass the masks.CompiledMask
+        self.limits = test_mask if isinstance(test_mask, CompiledMask) else compile_mask(test_mask)
+        self.test_mask = self.limits.data
+        self.eth_info = eth_info
+        self.handlers = {'led': self.led, 'gpio': self.gpio, 'powerSupply': self.power_supply,
+                         'random': self.random, 'feram': self.feram, 'ethernet': self.ethernet, 'end': self.end}
+        self.sections = set()
+        self.lines = 0
+        self.done = False
+        self.failed = []
+
+    def begin(self, sections=SECTIONS):
+        #Reset the given sections of test_results before feeding a new log
+        self.sections = set(sections)
+        self.lines = 0
+        self.done = False
+        self.failed = []
+        self.gpio_count = 0
+        self.pattern = []
+        for s in self.SECTIONS:
+            if s in self.sections:
+                getattr(self, 'begin_'+s)()
+
+    def begin_led(self):
+        self.test_results['led'] = OrderedDict([('result', 1)])
+
+    def begin_gpio(self):
+        self.test_results['gpio'] = OrderedDict([('result', 1)])
+
+    def begin_powerSupply(self):
+        self.test_results['powerSupply'] = OrderedDict([('result', 1)])
+
+    def begin_ethernet(self):
+        eth = OrderedDict()
+        eth['message'] = ''
+        eth['result'] = self.limits.message(eth['message'])
+        eth.update((k, v) for k, v in self.eth_info.items() if k != 'link')
+        self.test_results['ethernet'] = eth
+        if 'link' in self.eth_info:
+            self.set_link(self.eth_info['link'])
+
+    def begin_feram(self):
+        self.test_results['feram'] = {'pattern': '', 'result': 0}
+        self.feram_graded = False
+
+    def fail(self, section):
+        #Subtests in the order they first failed, used to stop a session early
+        if section not in self.failed:
+            self.failed.append(section)
+
+    def feed(self, ln):
+        self.lines += 1
+        m = self.MARKERS.search(ln)
+        if m is None:
+            return
+        name = m.lastgroup
+        if name in self.sections or name == 'end' or (name == 'random' and 'feram' in self.sections):
+            self.handlers[name](ln)
+
+    def parse(self, lines, sections=SECTIONS):
+        self.begin(sections)
+        for ln in lines:
+            self.feed(ln)
+        return self.grade()
+
+    def grade(self):
+        res = 1
+        for k,v in self.test_results.items():
+            if isinstance(v, dict):
+                for k1,v1 in v.items():
+                    if (k1 == 'result'):
+                        res &= v1
+        return res
+
+    def set_item(self, section, key, item):
+        #Keep the section result as the last key, as in the JSON dumps
+        sec = self.test_results[section]
+        res = sec.pop('result')
+        sec[key] = item
+        sec['result'] = res & item['result']
+        if not item['result']:
+            self.fail(section)
+
+    def led(self, ln):
+        regex = self.NUMBER.findall(ln)
+        if len(regex) > 1:
+            value = float(regex[1])
+            self.set_item('led', regex[0], {'value': value, 'result': self.limits.led(value)})
+
+    def gpio(self, ln):
+        t = self.gpio_count
+        self.gpio_count += 1
+        loop_pair = self.PIN.findall(ln)
+        if len(loop_pair) > 0:
+            loop_res = self.PASS_FAIL.findall(ln)
+            self.set_item('gpio', t, {'pin1': loop_pair[0], 'pin2': loop_pair[1], 'result': self.limits.gpio(loop_res[0])})
+
+    def power_supply(self, ln):
+        regex = self.NUMBER.findall(ln)
+        if len(regex) > 1:
+            value = float(regex[1])
+            self.set_item('powerSupply', regex[0], {'value': value, 'result': self.limits.rail(regex[0])(value)})
+
+    def random(self, ln):
+        self.pattern.extend(self.HEX_BYTE.findall(ln))
+        self.test_results['feram']['pattern'] = ''.join(self.pattern)
+
+    def feram(self, ln):
+        regex = self.PASS_FAIL.findall(ln)
+        #Only the first verdict counts
+        if len(regex) > 0 and not self.feram_graded:
+            self.feram_graded = True
+            self.test_results['feram']['result'] = self.limits.feram(regex[0])
+            if not self.test_results['feram']['result']:
+                self.fail('feram')
+
+    def ethernet(self, ln):
+        regex = self.QUOTED.findall(ln)
+        if len(regex) > 0:
+            eth = self.test_results['ethernet']
+            eth['message'] = regex[0]
+            eth['result'] = self.limits.message(eth['message']) & eth.get('link', {'result': 1})['result']
+
+    def grade_link(self, link):
+        #Each metric with a limit in the "link" mask is graded, one that wasn't measured fails
+        graded = OrderedDict((k, v) for k, v in link.items() if k not in self.limits.link)
+        res = 1 if link.get('connected') else 0
+        for metric, limit in self.limits.link.items():
+            value = link.get(metric)
+            graded[metric] = {'value': value, 'limit': limit.spec, 'result': limit(value)}
+            res &= graded[metric]['result']
+        graded['result'] = res
+        return graded
+
+    def set_link(self, link):
+        """ grade the link measurements of eth_probe.EthProbe into the ethernet section """
+        self.eth_info['link'] = link
+        eth = self.test_results['ethernet']
+        eth['link'] = self.grade_link(link)
+        eth['result'] = self.limits.message(eth['message']) & eth['link']['result']
+        if not eth['link']['result']:
+            self.fail('ethernet')
+
+    def end(self, ln):
+        self.done = True
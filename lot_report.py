@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+import argparse
+import json
+import math
+import os
+import pathlib
+from collections import OrderedDict
+
+#Subtests of the summary table, in report order
+SUBTESTS = (('LED', 'led'), ('GPIO', 'gpio'), ('Power Supply', 'powerSupply'), ('FeRAM', 'feram'), ('Ethernet', 'ethernet'))
+HIST_BINS = 10
+#Extension of the stored summary rows, the report tree is scanned for *.json dumps and rows must not be taken for boards
+ROW_SUFFIX = '.row'
+
+def summary_row(test_results):
+    """ what the lot report keeps of a board: identification, verdicts and measurements """
+    r = test_results
+    eth = r.get('ethernet', {})
+    row = OrderedDict([('boardSN', r['boardSN']), ('manufSN', r.get('manufSN', '')), ('mac', eth.get('mac', '')),
+                       ('deployIP', eth.get('deployIP', r.get('deployIP', ''))), ('date', r.get('date', ''))])
+    row['tests'] = OrderedDict((key, r[key]['result'] if isinstance(r.get(key), dict) and 'result' in r[key] else None) for name, key in SUBTESTS)
+    row['result'] = r.get('result', 0)
+    row['led'] = OrderedDict((k, v['value']) for k, v in r.get('led', {}).items() if isinstance(v, dict))
+    row['powerSupply'] = OrderedDict((k, v['value']) for k, v in r.get('powerSupply', {}).items() if isinstance(v, dict))
+    return row
+
+def distribution(values, bins=HIST_BINS):
+    """ summary statistics and histogram of a list of readings """
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    n = len(values)
+    mean = sum(values) / n
+    low, high = min(values), max(values)
+    width = (high - low) / bins if high > low else 1.0
+    counts = [0]*bins
+    for v in values:
+        counts[min(int((v - low) / width), bins - 1)] += 1
+    return OrderedDict([('n', n), ('mean', mean), ('std', math.sqrt(sum((v - mean)**2 for v in values) / n)), ('min', low), ('max', high),
+                        ('hist', counts), ('edges', [low + i*width for i in range(bins + 1)])])
+
+class LotReport(object):
+    """ summary report of a production lot, kept current as boards are added
+
+    Each board is stored once in lot_dir/<lot>/boards/ as its summary row
+    (<sn>.row, JSON) together with its appendix: the board's HTML report body
+    for the 'html' backend, or a reference to its PDF report for the LaTeX
+    ones, which is attached as it is. add() only renders the new board, the
+    lot document is then assembled from the stored rows and appendices. A
+    board tested again replaces its previous entry.
+    """
+
+    def __init__(self, lot, lot_dir='./reports/lots/', backend='html', board_reports='./reports/'):
+        self.lot = str(lot)
+        self.backend = backend
+        self.board_reports = os.path.abspath(os.path.expanduser(board_reports))
+        self.lot_dir = pathlib.Path(os.path.abspath(os.path.expanduser(lot_dir))) / self.lot
+        self.boards_dir = self.lot_dir / 'boards'
+        self.boards_dir.mkdir(parents=True, exist_ok=True)
+        self.rows = OrderedDict()
+        for f in sorted(self.boards_dir.glob('*'+ROW_SUFFIX), key=lambda f: f.stat().st_mtime):
+            with f.open() as row_f:
+                row = json.loads(row_f.read(), object_pairs_hook=OrderedDict)
+            self.rows[row['boardSN']] = row
+
+    def write(self, path, text):
+        #Written next to the target and renamed, a reader never sees a half written file
+        tmp = path.with_name('.'+path.name)
+        with tmp.open('w') as out_f:
+            out_f.write(text)
+        os.replace(str(tmp), str(path))
+
+    def add(self, test_results, generate=True):
+        """ add or replace a board, then bring the lot document up to date """
+        row = summary_row(test_results)
+        sn = row['boardSN']
+        if self.backend == 'html':
+            #pylatex is only imported by processes that render reports
+            from report import RFFEuC_HTMLReport
+            rep = RFFEuC_HTMLReport(test_results)
+            rep.build()
+            self.write(self.boards_dir / (sn+'.html'), '<section id="{}">\n{}</section>\n'.format(sn, ''.join(rep.body)))
+        self.write(self.boards_dir / (sn+ROW_SUFFIX), json.dumps(row, indent=4, ensure_ascii=True))
+        self.rows.pop(sn, None)
+        self.rows[sn] = row
+        if generate:
+            return self.generate()
+
+    def statistics(self):
+        rows = list(self.rows.values())
+        stats = OrderedDict()
+        stats['boards'] = len(rows)
+        stats['passed'] = sum(1 for r in rows if r['result'])
+        stats['yield'] = float(stats['passed']) / len(rows) if rows else float('nan')
+        stats['failures'] = OrderedDict((key, sum(1 for r in rows if r['tests'].get(key) == 0)) for name, key in SUBTESTS)
+        for section, unit in (('led', 'LED {}'), ('powerSupply', '{}V')):
+            channels = OrderedDict()
+            for r in rows:
+                for k in r[section]:
+                    channels[k] = None
+            stats[section] = OrderedDict((unit.format(k), distribution([r[section].get(k) for r in rows])) for k in channels)
+        return stats
+
+    def appendices(self):
+        """ [(board SN, appendix)], the HTML fragment or PDF path of each board, None when it isn't available yet """
+        res = []
+        for sn in self.rows:
+            if self.backend == 'html':
+                path = self.boards_dir / (sn+'.html')
+                res.append((sn, path.read_text() if path.is_file() else None))
+            else:
+                pdf = os.path.join(self.board_reports, sn+'.pdf')
+                res.append((sn, pdf if os.path.isfile(pdf) else None))
+        return res
+
+    def generate(self):
+        from report import lot_report_backends
+        rep = lot_report_backends[self.backend](self.lot, list(self.rows.values()), self.statistics(), self.appendices())
+        return rep.generate(str(self.lot_dir), 'lot_'+self.lot)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the summary report of a production lot from dump() JSON files')
+    parser.add_argument('lot', help='Lot name')
+    parser.add_argument('dumps', nargs='*', default=[], help='dump() JSON files or directories of them to add to the lot')
+    parser.add_argument('--lots', default='./reports/lots/', help='Lot reports directory')
+    parser.add_argument('--reports', default='./reports/', help='Directory of the board reports attached to LaTeX lot reports')
+    parser.add_argument('--backend', default='html', choices=['latex', 'fast', 'html'], help='Report renderer')
+    parser.add_argument('--all', action='store_true', help='Add every dump, not only the ones of this lot')
+    args = parser.parse_args()
+
+    lot = LotReport(args.lot, args.lots, args.backend, args.reports)
+    added = 0
+    for d in args.dumps:
+        p = pathlib.Path(d)
+        for f in (sorted(p.rglob('*.json')) if p.is_dir() else [p]):
+            try:
+                with f.open() as dump_f:
+                    res = json.loads(dump_f.read(), object_pairs_hook=OrderedDict)
+            except (OSError, ValueError):
+                continue
+            if not isinstance(res, dict) or 'boardSN' not in res:
+                continue
+            if args.all or str(res.get('lot', res.get('date', '')[:10])) == args.lot:
+                lot.add(res, generate=False)
+                added += 1
+    lot.generate()
+    stats = lot.statistics()
+    print('Lot {}: {} boards ({} added), {} pass, yield {:.1%}'.format(args.lot, stats['boards'], added, stats['passed'], stats['yield']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+import threading
+from collections import OrderedDict
+
+class MaskError(ValueError):
+
+    def __init__(self, path, msg):
+        self.path = path
+        super(MaskError, self).__init__('{}: {}'.format(path, msg))
+
+class Limit(object):
+    """ one compiled limit, check(value) returns 1 when value is within it
+
+    A spec is either a dict with one of the forms
+        {"min": a}, {"max": b}, {"min": a, "max": b}  inclusive bounds
+        {"nominal": n, "tolerance": t}                window n +- t
+        {"below": b}                                   exclusive upper bound
+        {"equals": v}                                  equality
+        {"pattern": regex}                             full match of str(value)
+    or a plain value, which means equality. Values that weren't measured
+    (None) never pass.
+    """
+
+    __slots__ = ('spec', 'kind', 'check')
+
+    def __init__(self, spec):
+        self.spec = spec
+        if not isinstance(spec, dict):
+            spec = {'equals': spec}
+        if 'nominal' in spec:
+            low = spec['nominal'] - spec['tolerance']
+            high = spec['nominal'] + spec['tolerance']
+            self.kind = 'window'
+            self.check = lambda v: 1 if v is not None and low <= v <= high else 0
+        elif 'min' in spec or 'max' in spec:
+            low = spec.get('min', float('-inf'))
+            high = spec.get('max', float('inf'))
+            self.kind = 'range'
+            self.check = lambda v: 1 if v is not None and low <= v <= high else 0
+        elif 'below' in spec:
+            high = spec['below']
+            self.kind = 'below'
+            self.check = lambda v: 1 if v is not None and v < high else 0
+        elif 'equals' in spec:
+            expected = spec['equals']
+            self.kind = 'equals'
+            self.check = lambda v: 1 if v == expected else 0
+        elif 'pattern' in spec:
+            match = re.compile(spec['pattern']).fullmatch
+            self.kind = 'pattern'
+            self.check = lambda v: 1 if v is not None and match(str(v)) else 0
+        else:
+            raise ValueError('unknown limit {!r}'.format(spec))
+
+    def __call__(self, value):
+        return self.check(value)
+
+    def describe(self):
+        spec = self.spec if isinstance(self.spec, dict) else {'equals': self.spec}
+        if self.kind == 'window':
+            return '{} - {}'.format(spec['nominal'] - spec['tolerance'], spec['nominal'] + spec['tolerance'])
+        if self.kind == 'range':
+            if 'min' in spec and 'max' in spec:
+                return '{} - {}'.format(spec['min'], spec['max'])
+            return '>= {}'.format(spec['min']) if 'min' in spec else '<= {}'.format(spec['max'])
+        if self.kind == 'below':
+            return '< {}'.format(spec['below'])
+        if self.kind == 'equals':
+            return '= {}'.format(spec['equals'])
+        return '~ {}'.format(spec['pattern'])
+
+class CompiledMask(object):
+    """ a validated test mask with its limits compiled
+
+    data is the mask as loaded from the file and must not be modified, it is
+    shared by every test using the mask. version is the "version" entry of
+    the file, or a digest of its contents.
+
+    "ethernet": {"link": {...}} is optional and off by default. It holds
+    limits on the link measurements (connectTime, rtt, throughput,
+    retransmits) and the "payload" bytes sent after the test message, which
+    only a firmware that drains them after the message can be tested with.
+    """
+
+    REQUIRED = (('testBoardPN',), ('testBoardSN',), ('led', 'mask'), ('powerSupply',),
+                ('ethernet', 'message'), ('ethernet', 'testIP'), ('ethernet', 'testGateway'), ('ethernet', 'testMask'),
+                ('ethernet', 'genericIP'), ('ethernet', 'genericGateway'), ('ethernet', 'genericMask'))
+
+    def __init__(self, data, path='<mask>', digest=None):
+        self.path = str(path)
+        self.data = data
+        self.validate()
+        self.version = str(data.get('version', digest or hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:12]))
+        self.board_pn = data.get('boardPN')
+        if isinstance(self.board_pn, str):
+            self.board_pn = [self.board_pn]
+        try:
+            self.led = Limit({'below': data['led']['mask']})
+            self.rails = OrderedDict((rail, Limit(spec)) for rail, spec in data['powerSupply'].items())
+            self.message = Limit(data['ethernet']['message'])
+            self.link = OrderedDict((metric, Limit(spec)) for metric, spec in data['ethernet'].get('link', {}).items() if isinstance(spec, dict))
+            #Verdict printed by the firmware for a passing loopback pair / FeRAM check
+            self.gpio = Limit(data.get('gpio', {}).get('verdict', 'Pass'))
+            self.feram = Limit(data.get('feram', {}).get('verdict', 'Pass'))
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            raise MaskError(self.path, 'invalid limit: {}'.format(e))
+
+    def validate(self):
+        for keys in self.REQUIRED:
+            d = self.data
+            for k in keys:
+                if not isinstance(d, dict) or k not in d:
+                    raise MaskError(self.path, 'missing "{}"'.format('.'.join(keys)))
+                d = d[k]
+        for rail, spec in self.data['powerSupply'].items():
+            if not isinstance(spec, dict):
+                raise MaskError(self.path, 'power supply "{}" must be a limit'.format(rail))
+
+    def matches(self, board_pn):
+        return self.board_pn is None or board_pn in self.board_pn
+
+    def rail(self, name):
+        return self.rails[name]
+
+    def grade_link(self, link):
+        """ re-grade the link measurements of an ethernet section in place, returns the link result """
+        lres = 1 if link.get('connected') else 0
+        for metric, limit in self.link.items():
+            item = link.get(metric)
+            value = item.get('value') if isinstance(item, dict) else item
+            link[metric] = {'value': value, 'limit': limit.spec, 'result': limit(value)}
+            lres &= link[metric]['result']
+        link['result'] = lres
+        return lres
+
+    def grade(self, test_results):
+        """ re-grade a whole result record against this mask in one pass, returns the board result """
+        res = 1
+        led = test_results.get('led')
+        if isinstance(led, dict):
+            sec = 1
+            for k, v in led.items():
+                if isinstance(v, dict):
+                    v['result'] = self.led(v['value'])
+                    sec &= v['result']
+            led['result'] = sec
+        ps = test_results.get('powerSupply')
+        if isinstance(ps, dict):
+            sec = 1
+            for k, v in ps.items():
+                if isinstance(v, dict):
+                    v['result'] = self.rails[k](v['value']) if k in self.rails else 0
+                    sec &= v['result']
+            ps['result'] = sec
+        eth = test_results.get('ethernet')
+        if isinstance(eth, dict):
+            sec = self.message(eth.get('message'))
+            link = eth.get('link')
+            if isinstance(link, dict):
+                sec &= self.grade_link(link)
+            eth['result'] = sec
+        for k, v in test_results.items():
+            if isinstance(v, dict) and 'result' in v:
+                res &= v['result']
+        if 'timeout' in test_results:
+            res = 0
+        test_results['result'] = res
+        return res
+
+class MaskSet(object):
+    """ every mask version found at a path, a single file or a directory of .json masks
+
+    Masks are reloaded when their file changes. select() picks the mask of a
+    board PN, preferring masks that name the PN ("boardPN") and the test
+    board ("testBoardSN") over generic ones.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.masks = OrderedDict()
+
+    def files(self):
+        if self.path.is_dir():
+            return sorted(self.path.glob('*.json'))
+        return [self.path]
+
+    def refresh(self):
+        files = self.files()
+        if not files:
+            raise MaskError(self.path, 'no mask found')
+        with self.lock:
+            current = OrderedDict()
+            for f in files:
+                st = f.stat()
+                key = (st.st_mtime_ns, st.st_size)
+                cached = self.masks.get(str(f))
+                if cached is not None and cached[0] == key:
+                    current[str(f)] = cached
+                    continue
+                with f.open('rb') as mask_f:
+                    raw = mask_f.read()
+                try:
+                    data = json.loads(raw.decode('utf-8'), object_pairs_hook=OrderedDict)
+                except ValueError as e:
+                    raise MaskError(f, 'invalid JSON: {}'.format(e))
+                current[str(f)] = (key, CompiledMask(data, f, hashlib.sha1(raw).hexdigest()[:12]))
+            self.masks = current
+            return [m for key, m in current.values()]
+
+    def select(self, board_pn=None, test_board_sn=None):
+        best = None
+        for m in self.refresh():
+            if not m.matches(board_pn):
+                continue
+            score = (m.board_pn is not None, test_board_sn is not None and m.data['testBoardSN'] == test_board_sn)
+            if best is None or score > best[0]:
+                best = (score, m)
+        if best is None:
+            raise MaskError(self.path, 'no mask for board "{}"'.format(board_pn))
+        return best[1]
+
+mask_sets = {}
+mask_sets_lock = threading.Lock()
+
+def select(path, board_pn=None, test_board_sn=None):
+    """ the compiled mask of a board, mask files are loaded once per process """
+    path = os.path.abspath(os.path.expanduser(str(path)))
+    with mask_sets_lock:
+        ms = mask_sets.get(path)
+        if ms is None:
+            ms = mask_sets[path] = MaskSet(path)
+    return ms.select(board_pn, test_board_sn)
+
+def compile_mask(data):
+    return CompiledMask(data)
@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+class StageStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self.blocked = 0.0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.errors = 0
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def add(self, busy=0.0, idle=0.0, blocked=0.0, depth=None):
+        with self.lock:
+            self.busy += busy
+            self.idle += idle
+            self.blocked += blocked
+            if depth is not None:
+                self.items += 1
+                self.depth_sum += depth
+                self.max_depth = max(self.max_depth, depth)
+
+    def summary(self):
+        with self.lock:
+            total = self.busy + self.idle + self.blocked
+            return OrderedDict([('items', self.items), ('busy', self.busy), ('idle', self.idle), ('blocked', self.blocked),
+                                ('utilization', self.busy/total if total else 0.0),
+                                ('meanDepth', float(self.depth_sum)/self.items if self.items else 0.0), ('maxDepth', self.max_depth), ('errors', self.errors)])
+
+class Stage(object):
+    """ one step of a Pipeline, run by its own thread
+
+    fn is called with each item of inbox and what it returns is put in outbox,
+    None drops the item. An exception raised by fn is printed and counted in
+    the stats, and the item is dropped so the line keeps flowing. Time spent
+    waiting for an item is idle time, time spent waiting for room in outbox
+    is blocked time.
+    """
+
+    def __init__(self, name, fn, inbox, outbox=None):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stats = StageStats()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='stage-'+self.name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            t0 = time.monotonic()
+            item = self.inbox.get()
+            t1 = time.monotonic()
+            if item is None:
+                self.stats.add(idle=t1-t0)
+                if self.outbox is not None:
+                    self.outbox.put(None)
+                return
+            depth = self.inbox.qsize()
+            try:
+                out = self.fn(item)
+            except Exception as e:
+                print('[ERROR] Stage {}: {}: {}'.format(self.name, type(e).__name__, e))
+                self.stats.error()
+                out = None
+            t2 = time.monotonic()
+            if out is not None and self.outbox is not None:
+                self.outbox.put(out)
+            self.stats.add(busy=t2-t1, idle=t1-t0, blocked=time.monotonic()-t2, depth=depth)
+
+class Pipeline(object):
+    """ chain of stages connected by bounded queues
+
+    submit() blocks while the first queue is full, so whoever feeds the line
+    (the operator scanning boards) is held back instead of piling up work.
+    The 'feed' entry of stats() accounts the time between submits as busy
+    and the time submit() waited for room as blocked. The stage with the
+    highest utilization is the one limiting the line.
+    """
+
+    def __init__(self, stages, depth=2):
+        self.queues = [queue.Queue(maxsize=depth) for s in stages]
+        self.stages = []
+        for i, (name, fn) in enumerate(stages):
+            outbox = self.queues[i+1] if i+1 < len(stages) else None
+            self.stages.append(Stage(name, fn, self.queues[i], outbox))
+        self.feed = StageStats()
+        self.last_submit = None
+
+    def start(self):
+        for s in self.stages:
+            s.start()
+        return self
+
+    def submit(self, item):
+        t0 = time.monotonic()
+        self.queues[0].put(item)
+        t1 = time.monotonic()
+        self.feed.add(busy=(t0 - self.last_submit) if self.last_submit is not None else 0.0, blocked=t1-t0, depth=self.queues[0].qsize())
+        self.last_submit = t1
+
+    def stop(self):
+        self.queues[0].put(None)
+        for s in self.stages:
+            if s.thread is not None and s.thread is not threading.current_thread():
+                s.thread.join()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        res = OrderedDict([('feed', self.feed.summary())])
+        for s, q in zip(self.stages, self.queues):
+            res[s.name] = s.stats.summary()
+            res[s.name]['depth'] = q.qsize()
+        return res
+
+    def bottleneck(self):
+        stats = self.stats()
+        return max(stats, key=lambda name: stats[name]['utilization'])
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+class FirmwareImage(object):
+
+    def __init__(self, data, path=None, mtime=None, name=None):
+        #Images built in memory are kept as given, without another copy
+        self.data = data if isinstance(data, (bytes, bytearray)) else bytes(data)
+        self.path = path
+        self.name = name if name is not None else path
+        self.mtime = mtime
+        self.size = len(self.data)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.tmp_path = None
+
+    @classmethod
+    def load(cls, path):
+        st = os.stat(path)
+        with open(path, 'rb') as fw_f:
+            return cls(fw_f.read(), path, st.st_mtime)
+
+    def file(self):
+        #The programmer works on files, images built in memory are written out once
+        if self.path is not None:
+            return self.path
+        if self.tmp_path is None:
+            fd, self.tmp_path = tempfile.mkstemp(prefix='rffe_fw_{}_'.format(self.sha256[:12]), suffix='.bin')
+            with os.fdopen(fd, 'wb') as fw_f:
+                fw_f.write(self.data)
+        return self.tmp_path
+
+    def __del__(self):
+        if self.tmp_path is not None:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+class FirmwareCache(object):
+    """ keeps firmware images in memory, an image is only read again if its file changes """
+
+    def __init__(self):
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        path = os.path.abspath(os.path.expanduser(path))
+        st = os.stat(path)
+        with self.lock:
+            img = self.images.get(path)
+            if img is None or img.mtime != st.st_mtime or img.size != st.st_size:
+                img = self.images[path] = FirmwareImage.load(path)
+            return img
+
+    def preload(self, paths):
+        return [self.get(p) for p in paths]
+
+class ProgrammerSession(object):
+    """ one programmer instance per probe, created on first use and reused for every board
+
+    The digests of the images flashed to the board under the probe are
+    remembered, so flashing the same image again is turned into a verify when
+    the programmer supports it. Nothing is ever skipped on the digest alone:
+    the target is the manufacturer SN typed in by the operator, not read from
+    the board, so without a verify the image is always programmed. Only the
+    current target is remembered, a new one clears the digests.
+    """
+
+    def __init__(self, programmer_cls, probe_id=None):
+        self.programmer_cls = programmer_cls
+        self.probe_id = probe_id
+        self.programmer = None
+        self.target = None
+        self.flashed = set()
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.programmer is None:
+            self.programmer = self.programmer_cls() if self.probe_id is None else self.programmer_cls(self.probe_id)
+        return self.programmer
+
+    def close(self):
+        self.programmer = None
+        self.target = None
+        self.flashed.clear()
+
+    def program(self, image, target=None):
+        with self.lock:
+            programmer = self.open()
+            if target != self.target:
+                self.target = target
+                self.flashed.clear()
+            if target is not None and image.sha256 in self.flashed and hasattr(programmer, 'verify'):
+                print('Verifying firmware '+str(image.name)+' on LPC...')
+                if programmer.verify(image.file()):
+                    return True
+            print('Programming firmware '+str(image.name)+' to LPC...')
+            try:
+                ok = programmer.program(image.file())
+            except Exception:
+                #Let the probe be enumerated again on the next attempt
+                self.close()
+                raise
+            if target is not None:
+                if ok:
+                    self.flashed.add(image.sha256)
+                else:
+                    self.flashed.discard(image.sha256)
+            return ok
+
+firmware_cache = FirmwareCache()
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def programmer_session(programmer_cls, probe_id=None):
+    with _sessions_lock:
+        key = (programmer_cls, probe_id)
+        if key not in _sessions:
+            _sessions[key] = ProgrammerSession(programmer_cls, probe_id)
+        return _sessions[key]
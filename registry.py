@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+def format_mac(mac):
+    mac = str(mac).replace(':', '').upper()
+    return ':'.join([mac[i:i+2] for i in range(0, len(mac), 2)])
+
+class BoardRegistry(object):
+    """ SQLite backed registry of the tested boards
+
+    'boards' holds one row per board SN, in the order the SNs were first
+    registered (as ip_sn_table.json did), and 'journal' keeps every test
+    result ever recorded. SN, MAC, IP and manufacturer SN are indexed and
+    writes are done in immediate transactions, so several stations may share
+    the same database file.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS boards (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            sn TEXT NOT NULL UNIQUE,
+            ip TEXT,
+            mac TEXT,
+            result TEXT,
+            manuf_sn TEXT,
+            station TEXT,
+            date TEXT
+        );
+        CREATE INDEX IF NOT EXISTS boards_ip ON boards(ip);
+        CREATE INDEX IF NOT EXISTS boards_mac ON boards(mac);
+        CREATE INDEX IF NOT EXISTS boards_manuf_sn ON boards(manuf_sn);
+        CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sn TEXT NOT NULL,
+            ip TEXT,
+            mac TEXT,
+            result TEXT,
+            manuf_sn TEXT,
+            station TEXT,
+            date TEXT
+        );
+        CREATE INDEX IF NOT EXISTS journal_sn ON journal(sn);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+
+    FIELDS = ('sn', 'ip', 'mac', 'result', 'manuf_sn', 'station', 'date')
+
+    def __init__(self, path='boards.db', timeout=30.0):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def row(self, r):
+        if r is None:
+            return None
+        return OrderedDict((k, r[k]) for k in self.FIELDS)
+
+    def insert(self, entry):
+        self.conn.execute('INSERT INTO journal (sn, ip, mac, result, manuf_sn, station, date) VALUES (?,?,?,?,?,?,?)', entry)
+        self.conn.execute('''INSERT INTO boards (sn, ip, mac, result, manuf_sn, station, date) VALUES (?,?,?,?,?,?,?)
+                             ON CONFLICT(sn) DO UPDATE SET ip=excluded.ip, mac=excluded.mac, result=excluded.result,
+                             manuf_sn=excluded.manuf_sn, station=excluded.station, date=excluded.date''', entry)
+
+    def add(self, sn, ip, mac, result, manuf_sn, station=None, date=None):
+        if date is None:
+            date = str(datetime.datetime.today())
+        if not isinstance(result, str):
+            result = 'pass' if result else 'fail'
+        entry = (str(sn), ip, format_mac(mac), result, manuf_sn, station, date)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.insert(entry)
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def last(self):
+        """ the most recently registered board, it's where the next SN/IP/MAC are allocated from """
+        with self.lock:
+            return self.row(self.conn.execute('SELECT * FROM boards ORDER BY seq DESC LIMIT 1').fetchone())
+
+    def get(self, sn):
+        with self.lock:
+            return self.row(self.conn.execute('SELECT * FROM boards WHERE sn = ?', (str(sn),)).fetchone())
+
+    def find(self, sn=None, ip=None, mac=None, manuf_sn=None):
+        cond = []
+        args = []
+        for col, val in (('sn', sn), ('ip', ip), ('mac', format_mac(mac) if mac is not None else None), ('manuf_sn', manuf_sn)):
+            if val is not None:
+                cond.append(col+' = ?')
+                args.append(str(val))
+        query = 'SELECT * FROM boards'+(' WHERE '+' AND '.join(cond) if cond else '')+' ORDER BY seq'
+        with self.lock:
+            return [self.row(r) for r in self.conn.execute(query, args)]
+
+    def history(self, sn):
+        with self.lock:
+            return [self.row(r) for r in self.conn.execute('SELECT * FROM journal WHERE sn = ? ORDER BY id', (str(sn),))]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM boards').fetchone()[0]
+
+    def import_json(self, json_path):
+        """ one-time import of an ip_sn_table.json file, returns the number of boards imported """
+        with open(str(json_path)) as json_f:
+            table = json.loads(json_f.read(), object_pairs_hook=OrderedDict)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                done = self.conn.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone()
+                if done is not None:
+                    self.conn.execute('ROLLBACK')
+                    return 0
+                for sn, b in table.items():
+                    self.insert((sn, b.get('ip'), format_mac(b.get('mac', '')), b.get('result'), b.get('manufSN'), None, None))
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('imported', ?)", (str(json_path),))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return len(table)
+
+    def export_json(self, json_path):
+        table = OrderedDict()
+        for b in self.find():
+            table[b['sn']] = OrderedDict([('ip', b['ip']), ('mac', b['mac']), ('result', b['result']), ('manufSN', b['manuf_sn'])])
+        with open(str(json_path), 'w') as json_f:
+            json.dump(table, json_f, indent=4, ensure_ascii=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='RFFEuC board registry')
+    parser.add_argument('--db', default='boards.db', help='Registry database')
+    parser.add_argument('--import-json', metavar='JSON', help='Import an ip_sn_table.json file')
+    parser.add_argument('--export-json', metavar='JSON', help='Export the registry in the ip_sn_table.json layout')
+    parser.add_argument('--sn', help='Look up a board SN')
+    parser.add_argument('--mac', help='Look up a MAC address')
+    parser.add_argument('--ip', help='Look up an IP address')
+    parser.add_argument('--manuf-sn', help='Look up a manufacturer SN')
+    args = parser.parse_args()
+
+    reg = BoardRegistry(args.db)
+    if args.import_json:
+        print('Imported {} boards'.format(reg.import_json(args.import_json)))
+    if args.export_json:
+        reg.export_json(args.export_json)
+    if any((args.sn, args.mac, args.ip, args.manuf_sn)):
+        for b in reg.find(args.sn, args.ip, args.mac, args.manuf_sn):
+            print(json.dumps(b))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+import argparse
+import copy
+import datetime
+import json
+import os
+import pathlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import masks
+import results
+from log_parser import RFFEuC_LogParser
+from serial_archive import CaptureArchive, RX, TX
+
+#A capture is used for a dump when it started at most this long before/after the test date [s]
+CAPTURE_WINDOW = 600
+#Records of a result log re-graded by one job
+LOG_CHUNK = 1000
+#Command starting the FeRAM store session after the self tests, see RFFEuC_Test.run()
+STORE_COMMAND = b'r'
+
+archives = {}
+
+def capture_archive(path):
+    #One archive per worker process, its index is memory mapped on each lookup
+    if path not in archives:
+        archives[path] = CaptureArchive(path)
+    return archives[path]
+
+def find_dumps(dump_dirs):
+    files = []
+    for d in dump_dirs:
+        p = pathlib.Path(d)
+        files.extend(sorted(list(p.rglob('*.json')) + list(p.rglob('*.rfr'))) if p.is_dir() else [p])
+    return [str(f) for f in files]
+
+def capture_lines(chunks):
+    """ the lines received during the self tests of a capture, as RFFEuC_Test.log held them """
+    rx = []
+    for t, d, data in chunks:
+        if d == TX and data == STORE_COMMAND:
+            break
+        if d == RX:
+            rx.append(data)
+    return b''.join(rx).decode('ascii', 'replace').splitlines(True)
+
+def find_capture(archive, test_results):
+    entries = archive.find(test_results.get('boardSN'))
+    try:
+        date = datetime.datetime.fromisoformat(test_results['date']).timestamp()
+    except (KeyError, ValueError):
+        return entries[-1] if entries else None
+    entries = [e for e in entries if abs(e.date - date) <= CAPTURE_WINDOW]
+    return min(entries, key=lambda e: abs(e.date - date)) if entries else None
+
+def eth_info(test_results):
+    #The parser settings a board was tested with, as RFFEuC_Test.log_parser() built them
+    eth = test_results.get('ethernet', {})
+    info = OrderedDict((k, eth[k]) for k in ('mac', 'targetIP', 'targetGateway', 'targetMask', 'testIP', 'testGateway', 'testMask') if k in eth)
+    link = eth.get('link')
+    if isinstance(link, dict):
+        info['link'] = OrderedDict((k, v['value'] if isinstance(v, dict) else v) for k, v in link.items() if k != 'result')
+    return info
+
+def failed_tests(test_results):
+    return [k for k, v in test_results.items() if isinstance(v, dict) and v.get('result') == 0]
+
+def regrade(test_results, mask, lines=None):
+    """ grade test_results again against mask, from the serial lines when given, returns the board result """
+    if lines is not None:
+        old_eth = test_results.get('ethernet', {})
+        parser = RFFEuC_LogParser(test_results, mask, eth_info(test_results))
+        res = parser.parse(lines)
+        #The deploy settings are not part of the serial log
+        eth = test_results['ethernet']
+        result = eth.pop('result')
+        eth.update((k, v) for k, v in old_eth.items() if k not in eth and k != 'result')
+        eth['result'] = result
+        if 'timeout' in test_results or test_results.get('aborted'):
+            res = 0
+        test_results['result'] = res
+    else:
+        res = mask.grade(test_results)
+        if test_results.get('aborted'):
+            res = test_results['result'] = 0
+    test_results['testMaskVersion'] = mask.version
+    return res
+
+def board_result(path, sn, manuf_sn, date, old):
+    return OrderedDict([('path', path), ('sn', sn), ('manufSN', manuf_sn), ('date', date), ('old', old), ('new', None), ('source', None),
+                        ('failed', []), ('error', None)])
+
+def render(test_results, opts, changed):
+    if opts['reports'] is not None and (changed or opts['all_reports']):
+        #pylatex is only imported by the workers rendering reports
+        from report import report_backends
+        report_backends[opts['backend']](copy.deepcopy(test_results)).generate(opts['reports'], test_results['boardSN'])
+
+def replay_one(job):
+    path, opts = job
+    res = board_result(path, None, None, None, None)
+    try:
+        with open(path) as dump_f:
+            test_results = json.loads(dump_f.read(), object_pairs_hook=OrderedDict)
+        if not isinstance(test_results, dict) or 'boardSN' not in test_results:
+            return None
+        res['sn'], res['manufSN'], res['date'] = test_results['boardSN'], test_results.get('manufSN'), test_results.get('date')
+        res['old'] = test_results.get('result', 0)
+        mask = masks.select(opts['mask'], test_results.get('boardPN'), test_results.get('testBoardSN'))
+        lines = None
+        if opts['captures'] is not None:
+            archive = capture_archive(opts['captures'])
+            entry = find_capture(archive, test_results)
+            if entry is not None:
+                lines = capture_lines(archive.read(entry))
+        res['source'] = 'capture' if lines is not None else 'dump'
+        res['new'] = regrade(test_results, mask, lines)
+        res['failed'] = failed_tests(test_results)
+        if opts['output'] is not None:
+            out = os.path.join(opts['output'], os.path.basename(path))
+            with open(out, 'w') as out_f:
+                json.dump(test_results, out_f, indent=4, ensure_ascii=True)
+        render(test_results, opts, bool(res['new']) != bool(res['old']))
+    except Exception as e:
+        res['error'] = '{}: {}'.format(type(e).__name__, e)
+    return [res]
+
+def replay_log(job):
+    """ re-grade records start to stop of a results.ResultLog
+
+    Boards are graded on the typed model, only the ones matched to a capture
+    or getting a report are converted to the dump() layout. The re-graded
+    records are returned encoded, the parent process appends them to the
+    output log in order.
+    """
+    path, opts, start, stop = job
+    res_list, encoded = [], []
+    for r in results.ResultLog(path).read(start, stop):
+        info = r.info
+        res = board_result(path, info.board_sn, info.manuf_sn, info.date, r.result if r.result is not None else 0)
+        res_list.append(res)
+        try:
+            mask = masks.select(opts['mask'], info.board_pn, info.test_board_sn)
+            lines = None
+            if opts['captures'] is not None:
+                archive = capture_archive(opts['captures'])
+                entry = find_capture(archive, {'boardSN': info.board_sn, 'date': info.date})
+                if entry is not None:
+                    lines = capture_lines(archive.read(entry))
+            res['source'] = 'capture' if lines is not None else 'dump'
+            if lines is not None:
+                test_results = r.to_json()
+                res['new'] = regrade(test_results, mask, lines)
+                r = results.TestResults.from_json(test_results)
+            else:
+                res['new'] = r.grade(mask)
+                if r.extra.get('aborted') or r.trailer.get('aborted'):
+                    res['new'] = r.result = 0
+                info.test_mask_version = mask.version
+            res['failed'] = r.failed()
+            if opts['output'] is not None:
+                encoded.append(results.encode(r))
+            changed = bool(res['new']) != bool(res['old'])
+            if opts['reports'] is not None and (changed or opts['all_reports']):
+                render(r.to_json(), opts, changed)
+        except Exception as e:
+            res['error'] = '{}: {}'.format(type(e).__name__, e)
+    return res_list, encoded
+
+def replay(dump_dirs, mask_path='mask.json', captures=None, output=None, reports=None, all_reports=False, backend='fast', workers=None, chunksize=16):
+    """ re-grade every dump found under dump_dirs over a process pool, yields one result per board """
+    for d in (output, reports):
+        if d is not None:
+            pathlib.Path(d).mkdir(parents=True, exist_ok=True)
+    opts = {'mask': mask_path, 'captures': captures, 'output': output, 'reports': reports, 'all_reports': all_reports, 'backend': backend}
+    files = find_dumps(dump_dirs)
+    dumps = [(f, opts) for f in files if not f.endswith('.rfr')]
+    logs = []
+    for f in files:
+        if f.endswith('.rfr'):
+            n = len(results.ResultLog(f).records())
+            logs.extend((f, opts, start, start + LOG_CHUNK) for start in range(0, n, LOG_CHUNK))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for res_list in pool.map(replay_one, dumps, chunksize=chunksize):
+            for res in res_list or []:
+                yield res
+        outputs = {}
+        try:
+            for (path, opts, start, stop), (res_list, encoded) in zip(logs, pool.map(replay_log, logs)):
+                if output is not None:
+                    if path not in outputs:
+                        #A log re-graded again replaces the previous output
+                        outputs[path] = open(os.path.join(output, os.path.basename(path)), 'wb')
+                    for data in encoded:
+                        outputs[path].write(results.RECORD.pack(len(data)) + data)
+                for res in res_list:
+                    yield res
+        finally:
+            for out_f in outputs.values():
+                out_f.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-grade the archived RFFEuC test results against the current mask and parser')
+    parser.add_argument('dumps', nargs='*', default=['./reports/'], help='Directories searched for dump() JSON files and result logs (.rfr)')
+    parser.add_argument('--mask', default='mask.json', help='Test mask file, or a directory of mask versions selected by board PN')
+    parser.add_argument('--captures', help='Serial capture archive, boards found there are parsed again from their transcript')
+    parser.add_argument('--output', help='Directory the re-graded dumps are written to')
+    parser.add_argument('--reports', help='Regenerate the reports of the boards whose result changed in this directory')
+    parser.add_argument('--all-reports', action='store_true', help='Regenerate the report of every board, not only the changed ones')
+    parser.add_argument('--backend', default='fast', choices=['latex', 'fast', 'html'], help='Report renderer')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    boards = changed = errors = 0
+    sources = OrderedDict([('capture', 0), ('dump', 0)])
+    for res in replay(args.dumps, args.mask, args.captures, args.output, args.reports, args.all_reports, args.backend, args.workers):
+        boards += 1
+        if res['error'] is not None:
+            errors += 1
+            print('[ERROR] {}: {}'.format(res['path'], res['error']))
+            continue
+        sources[res['source']] += 1
+        if bool(res['new']) != bool(res['old']):
+            changed += 1
+            print('{:>12} {:>24} {:>26} {} -> {} {}'.format(res['sn'], res['manufSN'] or '', res['date'] or '', 'PASS' if res['old'] else 'FAIL',
+                                                            'PASS' if res['new'] else 'FAIL', ','.join(res['failed'])))
+    elapsed = time.monotonic() - start
+    print('{} boards re-graded in {:.1f}s ({} from captures, {} from dumps), {} changed, {} errors'.format(
+        boards, elapsed, sources['capture'], sources['dump'], changed, errors))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,26 @@
 from pylatex.package import Package
-from pylatex import Document, Section, Subsection, Subsubsection, Command, Tabular, Center, MultiColumn, Alignat
+from pylatex import Document, Section, Subsection, Subsubsection, Command, Tabular, LongTable, Center, MultiColumn, Alignat
 from pylatex.utils import NoEscape, italic, bold
 from datetime import datetime
+from contextlib import contextmanager
 import pathlib
 import binascii
+import hashlib
+import html
 import os
+import re
+import subprocess
+import tempfile
+import threading
+
+from masks import Limit
+from lot_report import SUBTESTS
 
 class RFFEuC_Report(object):
 
+    #Graded link measurements of the Ethernet test, in report order
+    LINK_METRICS = (('connectTime', 'Connect time [ms]'), ('rtt', 'Round-trip time [ms]'), ('throughput', 'Throughput [Mbit/s]'), ('retransmits', 'Retransmissions'))
+
     def __init__(self, test_results, date=datetime.today()):
         self.date = date
         self.doc = Document(default_filepath='./', page_numbers=False)
@@ -56,13 +69,15 @@ class RFFEuC_Report(object):
                     tbl.add_row(bold('Ethernet'), ('Pass' if self.test_results['ethernet']['result'] else 'Fail'), color=('green' if self.test_results['ethernet']['result'] else 'red'))
                     tbl.add_hline()
 
+    def LED_description(self, c):
+        c.append('This test asserts the correct assembly of the 4 LEDs on RFFEuC\'s edge.\n')
+        c.append('A large LDR (20mm) is positioned in front of all LEDs and is connected to one of the Analogic-to-Digital converter ports - routed through the TestBoard Jn connector.\n')
+        c.append('Each LED is activated separately and the LDR voltage is read and compared to a predefined mask.\n')
+
     def LED_report(self):
         self.doc.append(NoEscape(r'\clearpage'))
         with self.doc.create(Section('LEDs')):
-            with self.doc.create(Subsection('Description')):
-                self.doc.append('This test asserts the correct assembly of the 4 LEDs on RFFEuC\'s edge.\n')
-                self.doc.append('A large LDR (20mm) is positioned in front of all LEDs and is connected to one of the Analogic-to-Digital converter ports - routed through the TestBoard Jn connector.\n')
-                self.doc.append('Each LED is activated separately and the LDR voltage is read and compared to a predefined mask.\n')
+            self.description('LED', self.LED_description)
 
             with self.doc.create(Subsection('Results')):
                 with self.doc.create(Center()) as centered:
@@ -75,13 +90,15 @@ class RFFEuC_Report(object):
                                 tbl.add_row(bold(key), (val['value']), ('Pass' if val['result'] else 'Fail'), color=('green' if val['result'] else 'red'))
                                 tbl.add_hline()
 
+    def GPIOLoopback_description(self, c):
+        c.append('This test asserts the correct assembly of the GPIO pins on both RFFEuC\'s headers.')
+        c.append('In the TestBoard all GPIO pins are connected in pairs via a 1K1 resistor, so they\'re logically binded.\n')
+        c.append('Each pin in the loopback pair is tested as an Input and Output, changing the logic level of its pair to assert the electrical connection.\n')
+
     def GPIOLoopback_report(self):
         self.doc.append(NoEscape(r'\clearpage'))
         with self.doc.create(Section('GPIO Loopback')):
-            with self.doc.create(Subsection('Description')):
-                self.doc.append('This test asserts the correct assembly of the GPIO pins on both RFFEuC\'s headers.')
-                self.doc.append('In the TestBoard all GPIO pins are connected in pairs via a 1K1 resistor, so they\'re logically binded.\n')
-                self.doc.append('Each pin in the loopback pair is tested as an Input and Output, changing the logic level of its pair to assert the electrical connection.\n')
+            self.description('GPIOLoopback', self.GPIOLoopback_description)
 
             with self.doc.create(Subsection('Results')):
                 with self.doc.create(Center()) as centered:
@@ -94,14 +111,16 @@ class RFFEuC_Report(object):
                                 tbl.add_row(val['pin1'], val['pin2'], ('Pass' if val['result'] else 'Fail'), color=('green' if val['result'] else 'red'))
                                 tbl.add_hline()
 
+    def PowerSupply_description(self, c):
+        c.append('This test asserts the correct assembly of the Voltage regulation circuit.\n')
+        c.append('Both power supply lines (5V and 3.3V) are tested using a simple voltage divider circuit present on the TestBoard. Given that the voltage divider provides a half of the real value to the RFFEuC ADC circuit, the following convertion is applied: \n')
+        with c.create(Alignat(numbering=False, escape=False)) as agn:
+            agn.append(r'V_{PS} = ADC_{read} * 3.3 * 2 \\')
+
     def PowerSupply_report(self):
         self.doc.append(NoEscape(r'\clearpage'))
         with self.doc.create(Section('Power Supply')):
-            with self.doc.create(Subsection('Description')):
-                self.doc.append('This test asserts the correct assembly of the Voltage regulation circuit.\n')
-                self.doc.append('Both power supply lines (5V and 3.3V) are tested using a simple voltage divider circuit present on the TestBoard. Given that the voltage divider provides a half of the real value to the RFFEuC ADC circuit, the following convertion is applied: \n')
-                with self.doc.create(Alignat(numbering=False, escape=False)) as agn:
-                    agn.append(r'V_{PS} = ADC_{read} * 3.3 * 2 \\')
+            self.description('PowerSupply', self.PowerSupply_description)
 
             with self.doc.create(Subsection('Results')):
                 with self.doc.create(Center()) as centered:
@@ -114,12 +133,14 @@ class RFFEuC_Report(object):
                                 tbl.add_row(bold(key+'V'), val['value'] ,('Pass' if val['result'] else 'Fail'), color=('green' if val['result'] else 'red'))
                                 tbl.add_hline()
 
+    def FERAM_description(self, c):
+        c.append('This test asserts the correct assembly of the FeRAM chip (IC1 - FM24CL16B-G) and its communication lines (I2C).\n')
+        c.append('A random pattern, 256 bytes long, is generated by reading the two least significant bits of ADC0 and shifting them left. This pattern is then written in each page of the FeRAM and then read back to be compared with the original data.\n')
+
     def FERAM_report(self):
         self.doc.append(NoEscape(r'\clearpage'))
         with self.doc.create(Section('FeRAM')):
-            with self.doc.create(Subsection('Description')):
-                self.doc.append('This test asserts the correct assembly of the FeRAM chip (IC1 - FM24CL16B-G) and its communication lines (I2C).\n')
-                self.doc.append('A random pattern, 256 bytes long, is generated by reading the two least significant bits of ADC0 and shifting them left. This pattern is then written in each page of the FeRAM and then read back to be compared with the original data.\n')
+            self.description('FERAM', self.FERAM_description)
 
             with self.doc.create(Subsection('Results')):
                 with self.doc.create(Center()) as centered:
@@ -140,27 +161,43 @@ class RFFEuC_Report(object):
                         tbl.add_row((('Pass' if self.test_results['feram']['result'] else 'Fail'),), color=('green' if self.test_results['feram']['result'] else 'red') )
                         tbl.add_hline()
 
+    def Ethernet_description(self, c):
+        c.append('This test asserts the correct assembly of all the Ethernet related circuit, including the PLL (CDCE906) used to generate the 50MHz reference, the PHY chip and the RJ45 connector.\n')
+
+        with c.create(Subsubsection('PLL Configuration')):
+            c.append('At first the PLL is configured to generate 50MHz in its output using a 12MHz oscillator. The output frequency can be calculated using the following equation:\n')
+            with c.create(Alignat(numbering=False, escape=False)) as agn:
+                agn.append(r'f_{out} = \frac{3 * N * f_{in}}{M*P} \\')
+            c.append(NoEscape(r'To generate 50MHz, the following values are used in the PLL configuration: $ f_{in} = 12MHz$, $M = 9$, $N = 25$ , $P = 2$'))
+
+        with c.create(Subsubsection('TCP Server')):
+            c.append(NoEscape(r'The RFFEuC will establish an Ethernet connection using the PHY interface chip and, if successfull, will create a TCP Server and listen on port 6791 for incoming connections. In order for the test to pass, an external client must connect to this port and send the following string: \textbf{\lq\lq Test msg!\rq\rq}, including a string terminating char (0x00) at the end.'))
+            c.append('For this test the board is programmed with the test address of the station it is tested on, each station has its own so that several boards can be tested at once. The configuration the board was tested with can be seen below.')
+
+        with c.create(Subsubsection('Link Quality')):
+            c.append('The connection is retried until the PHY link is up. The test message is followed by a bulk transfer, and the connection time, the TCP round-trip time, the sustained throughput and the number of retransmissions are measured. When the test mask sets link limits they are graded against them, so a marginal PHY or PLL configuration is detected even if the message gets through.')
+
+    def link_rows(self):
+        """ (label, measured, limit, result) of each graded link metric, empty for boards tested without them """
+        link = self.test_results['ethernet'].get('link', {})
+        rows = []
+        for metric, label in self.LINK_METRICS:
+            item = link.get(metric)
+            if isinstance(item, dict):
+                value = '-' if item['value'] is None else ('{:.3f}'.format(item['value']) if isinstance(item['value'], float) else str(item['value']))
+                rows.append((label, value, Limit(item['limit']).describe(), item['result']))
+        return rows
+
     def Ethernet_report(self):
         hex_str = str(binascii.hexlify(self.test_results['ethernet']['message'].encode('ascii')),'ascii')
         ascii_str = self.test_results['ethernet']['message']
 
         self.doc.append(NoEscape(r'\clearpage'))
         with self.doc.create(Section('Ethernet')):
-            with self.doc.create(Subsection('Description')):
-                self.doc.append('This test asserts the correct assembly of all the Ethernet related circuit, including the PLL (CDCE906) used to generate the 50MHz reference, the PHY chip and the RJ45 connector.\n')
-
-                with self.doc.create(Subsubsection('PLL Configuration')):
-                    self.doc.append('At first the PLL is configured to generate 50MHz in its output using a 12MHz oscillator. The output frequency can be calculated using the following equation:\n')
-                    with self.doc.create(Alignat(numbering=False, escape=False)) as agn:
-                        agn.append(r'f_{out} = \frac{3 * N * f_{in}}{M*P} \\')
-                    self.doc.append(NoEscape(r'To generate 50MHz, the following values are used in the PLL configuration: $ f_{in} = 12MHz$, $M = 9$, $N = 25$ , $P = 2$'))
-
-                with self.doc.create(Subsubsection('TCP Server')):
-                    self.doc.append(NoEscape(r'The RFFEuC will establish an Ethernet connection using the PHY interface chip and, if successfull, will create a TCP Server and listen on port 6791 for incoming connections. In order for the test to pass, an external client must connect to this port and send the following string: \textbf{\lq\lq Test msg!\rq\rq}, including a string terminating char (0x00) at the end.'))
-                    self.doc.append('It is important to notice that all boards in test phase are programmed with the same ethernet configuration, which can be seen below.')
+            self.description('Ethernet', self.Ethernet_description)
 
             with self.doc.create(Subsection('Results')):
-                self.doc.append('Ethernet test configuration:')
+                self.doc.append('Ethernet test configuration of the station:')
                 with self.doc.create(Center()) as centered:
                     with centered.create(Tabular('|c|c|c|c|',row_height=1.2)) as tbl:
                         tbl.add_hline()
@@ -178,13 +215,27 @@ class RFFEuC_Report(object):
                         tbl.add_row(ascii_str, hex_str, ('Pass' if self.test_results['ethernet']['result'] else 'Fail'), color=('green' if self.test_results['ethernet']['result'] else 'red'))
                         tbl.add_hline()
 
+                link_rows = self.link_rows()
+                if link_rows:
+                    self.doc.append('Link quality:')
+                    with self.doc.create(Center()) as centered:
+                        with centered.create(Tabular('|c|c|c|c|',row_height=1.2)) as tbl:
+                            tbl.add_hline()
+                            tbl.add_row(bold('Metric'), bold('Measured'), bold('Limit'), bold('Result') )
+                            tbl.add_hline()
+                            for label, value, limit, res in link_rows:
+                                tbl.add_row(label, value, limit, ('Pass' if res else 'Fail'), color=('green' if res else 'red'))
+                                tbl.add_hline()
+
+    def Deploy_description(self, c):
+        c.append('Information about the deploy firmware programmed in the board.\n')
+        c.append('If the board passed all the tests, it will be assigned a valid IP in the range 201-213, which corresponds to its slot in the rack.\n')
+        c.append('If the board for some reason failed in any tests, it is treated as a spare part and programmed with a generic IP address (xxx.xxx.xxx.220), which should be ovewritten when replacing an old part.\n')
+
     def Deploy_report(self):
         self.doc.append(NoEscape(r'\clearpage'))
         with self.doc.create(Section('Deploy')):
-            with self.doc.create(Subsection('Description')):
-                self.doc.append('Information about the deploy firmware programmed in the board.\n')
-                self.doc.append('If the board passed all the tests, it will be assigned a valid IP in the range 201-213, which corresponds to its slot in the rack.\n')
-                self.doc.append('If the board for some reason failed in any tests, it is treated as a spare part and programmed with a generic IP address (xxx.xxx.xxx.220), which should be ovewritten when replacing an old part.\n')
+            self.description('Deploy', self.Deploy_description)
 
             with self.doc.create(Subsection('Results')):
                 with self.doc.create(Center()) as centered:
@@ -208,7 +259,11 @@ class RFFEuC_Report(object):
                         tbl.add_row((bold('Gateway'),self.test_results['deployGateway']))
                         tbl.add_hline()
 
-    def generate(self, file_dir='./reports/', file_name='report1'):
+    def description(self, name, builder):
+        with self.doc.create(Subsection('Description')) as sub:
+            builder(sub)
+
+    def build(self):
         self.header()
         self.LED_report()
         self.GPIOLoopback_report()
@@ -216,12 +271,440 @@ class RFFEuC_Report(object):
         self.FERAM_report()
         self.Ethernet_report()
 
+    def output_path(self, file_dir, file_name):
         file_dir_abs = os.path.abspath(os.path.expanduser(file_dir))
-        if file_name.lower().endswith('.pdf'):
+        if file_name.lower().endswith(('.pdf', '.html')):
             raise NameError('File name must not have an extension!')
         pathlib.Path(file_dir_abs).mkdir(parents=True, exist_ok=True)
+        return file_dir_abs+'/'+file_name
 
-        report_full_name = file_dir_abs+'/'+file_name
+    def generate(self, file_dir='./reports/', file_name='report1'):
+        self.build()
+
+        report_full_name = self.output_path(file_dir, file_name)
         print('Saving report to '+report_full_name+'.pdf')
 
         self.doc.generate_pdf(report_full_name)
+
+class RFFEuC_FastReport(RFFEuC_Report):
+    """ RFFEuC_Report with cached static sections and a precompiled preamble
+
+    The description of each section is rendered once per process, and the
+    preamble, which is the same for every board, is dumped into a pdflatex
+    format the first time it is seen. Each report is then compiled from the
+    document body alone, with a second pass only when the first one changed
+    the .aux or asks for a rerun (LongTable column widths, references). Falls
+    back to the regular pylatex compile if the format can't be built or a
+    compile with it fails.
+    """
+
+    FORMAT_DIR = os.path.join(tempfile.gettempdir(), 'rffe_report_fmt')
+    MAX_PASSES = 3
+
+    fragments = {}
+    formats = {}
+    lock = threading.Lock()
+
+    def description(self, name, builder):
+        frag = self.fragments.get(name)
+        if frag is None:
+            sub = Subsection('Description')
+            builder(sub)
+            sub._propagate_packages()
+            frag = self.fragments[name] = (sub.dumps_as_content(), list(sub.packages))
+        self.doc.append(NoEscape(frag[0]))
+        for pkg in frag[1]:
+            self.doc.packages.add(pkg)
+
+    def preamble_format(self, preamble):
+        digest = hashlib.sha1(preamble.encode('utf-8')).hexdigest()[:12]
+        with self.lock:
+            if digest in self.formats:
+                return self.formats[digest]
+            name = 'rffe_report_'+digest
+            fmt_dir = pathlib.Path(self.FORMAT_DIR)
+            if not (fmt_dir / (name+'.fmt')).is_file():
+                fmt_dir.mkdir(parents=True, exist_ok=True)
+                #Built under a private name and renamed, other stations may be doing the same
+                job = '{}_{}'.format(name, os.getpid())
+                with (fmt_dir / (job+'.tex')).open('w') as tex_f:
+                    tex_f.write(preamble+'\\dump\n')
+                try:
+                    proc = subprocess.run(['pdflatex', '-ini', '-interaction=batchmode', '-jobname='+job, '&pdflatex', job+'.tex'],
+                                          cwd=str(fmt_dir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    if proc.returncode != 0:
+                        raise OSError('pdflatex -ini exited with {}'.format(proc.returncode))
+                    os.replace(str(fmt_dir / (job+'.fmt')), str(fmt_dir / (name+'.fmt')))
+                except OSError as e:
+                    print('[WARNING] Could not precompile the report preamble: '+str(e))
+                    name = None
+                for ext in ('.tex', '.log', '.fmt'):
+                    try:
+                        os.remove(str(fmt_dir / (job+ext)))
+                    except OSError:
+                        pass
+            self.formats[digest] = name
+            return name
+
+    @staticmethod
+    def read_output(path):
+        try:
+            with open(path, 'rb') as out_f:
+                return out_f.read()
+        except OSError:
+            return b''
+
+    def passes(self, report_full_name, tex, fmt):
+        out_dir, name = os.path.split(report_full_name)
+        env = dict(os.environ, TEXFORMATS=self.FORMAT_DIR+os.pathsep+os.environ.get('TEXFORMATS', ''))
+        with open(report_full_name+'.tex', 'w') as tex_f:
+            tex_f.write(tex)
+        aux = None
+        try:
+            for i in range(self.MAX_PASSES):
+                subprocess.check_output(['pdflatex', '-interaction=batchmode', '-fmt='+fmt, name+'.tex'], cwd=out_dir, env=env, stderr=subprocess.STDOUT)
+                prev, aux = aux, self.read_output(report_full_name+'.aux')
+                if b'Rerun' not in self.read_output(report_full_name+'.log') and (prev is None or aux == prev):
+                    break
+        finally:
+            for ext in ('.tex', '.aux', '.log'):
+                try:
+                    os.remove(report_full_name+ext)
+                except OSError:
+                    pass
+
+    def compile(self, report_full_name):
+        tex = self.doc.dumps()
+        begin = tex.index('\\begin{document}')
+        preamble = tex[:begin]
+        fmt = self.preamble_format(preamble)
+        if fmt is not None:
+            try:
+                return self.passes(report_full_name, tex[begin:], fmt)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print('[WARNING] Compiling with the precompiled preamble failed ({}), compiling the whole report'.format(e))
+                #Not used again by this process
+                with self.lock:
+                    self.formats[hashlib.sha1(preamble.encode('utf-8')).hexdigest()[:12]] = None
+        self.doc.generate_pdf(report_full_name)
+
+    def generate(self, file_dir='./reports/', file_name='report1'):
+        self.build()
+
+        report_full_name = self.output_path(file_dir, file_name)
+        print('Saving report to '+report_full_name+'.pdf')
+
+        self.compile(report_full_name)
+
+class HTMLFragment(object):
+
+    def __init__(self, tag='div', title=None):
+        self.tag = tag
+        self.title = title
+        self.parts = []
+
+    @staticmethod
+    def latex_to_html(text):
+        text = html.escape(text, quote=False)
+        text = re.sub(r'\\textbf\{(.*?)\}', r'<b>\1</b>', text)
+        text = text.replace('\\lq\\lq ', '&ldquo;').replace('\\lq\\lq', '&ldquo;').replace('\\rq\\rq', '&rdquo;')
+        return text.replace('$', '').replace('\\\\', '').strip()
+
+    def append(self, item):
+        if isinstance(item, NoEscape):
+            text = self.latex_to_html(str(item))
+        else:
+            text = html.escape(str(item), quote=False)
+        self.parts.append(text.replace('\n', '<br/>\n'))
+
+    @contextmanager
+    def create(self, child):
+        if isinstance(child, Alignat):
+            frag = HTMLFragment('pre')
+        else:
+            frag = HTMLFragment('div', getattr(child, 'title', None))
+        yield frag
+        self.parts.append(frag.html())
+
+    def html(self):
+        title = '<h4>{}</h4>\n'.format(html.escape(self.title)) if self.title else ''
+        if self.tag == 'pre':
+            return '<pre>{}</pre>\n'.format(''.join(self.parts).replace('\\\\', '').strip())
+        return '{}<{}>{}</{}>\n'.format(title, self.tag, ' '.join(self.parts), self.tag)
+
+class RFFEuC_HTMLReport(RFFEuC_Report):
+    """ LaTeX free report, written as a single HTML page """
+
+    TITLE = 'RFFEuC Test Report'
+    STYLE = 'body{font-family:sans-serif;max-width:50em;margin:auto} table{border-collapse:collapse;margin:1em auto} td,th{border:1px solid #000;padding:.2em .6em;text-align:center} .pass{background:#0f0} .fail{background:#f00}'
+
+    fragments = {}
+
+    def __init__(self, test_results, date=datetime.today()):
+        self.date = date
+        self.test_results = test_results
+        self.body = []
+
+    def description(self, name, builder):
+        frag = self.fragments.get(name)
+        if frag is None:
+            c = HTMLFragment()
+            builder(c)
+            frag = self.fragments[name] = '<h3>Description</h3>\n'+c.html()
+        self.body.append(frag)
+
+    @staticmethod
+    def result_cell(res):
+        return '<td class="{}">{}</td>'.format('pass' if res else 'fail', 'Pass' if res else 'Fail')
+
+    def table(self, header, rows):
+        out = ['<table>']
+        if header:
+            out.append('<tr>'+''.join('<th>{}</th>'.format(html.escape(str(h))) for h in header)+'</tr>')
+        for row in rows:
+            cells = []
+            for cell in row:
+                cells.append(cell if str(cell).startswith('<td') else '<td>{}</td>'.format(html.escape(str(cell))))
+            out.append('<tr>'+''.join(cells)+'</tr>')
+        out.append('</table>')
+        self.body.append('\n'.join(out)+'\n')
+
+    def section(self, title, name):
+        self.body.append('<h2>{}</h2>\n'.format(html.escape(title)))
+        self.description(name, getattr(self, name+'_description'))
+        self.body.append('<h3>Results</h3>\n')
+
+    def header(self):
+        r = self.test_results
+        self.body.append('<h1>RFFEuC Test Report</h1>\n<b>Board information:</b>\n')
+        self.table(None, [('Operator', r['operator']),
+                          ('Manufacturer SN', r['manufSN']),
+                          ('Board PN/SN', ':'.join([r['boardPN'], r['boardSN']])),
+                          ('Testboard PN/SN', ':'.join([r['testBoardPN'], r['testBoardSN']])),
+                          ('TestSW commit', r['testSWCommit']),
+                          ('Programmed IP', r['ethernet']['deployIP']),
+                          ('Programmed MAC', r['ethernet']['mac']),
+                          ('Test Date', r['date'])])
+        self.body.append('<b>Test Results:</b>\n')
+        self.table(None, [(name, self.result_cell(r[key]['result'])) for name, key in
+                          (('LED', 'led'), ('GPIO Loopback', 'gpio'), ('Power Supply', 'powerSupply'), ('FeRAM', 'feram'), ('Ethernet', 'ethernet'))])
+
+    def LED_report(self):
+        self.section('LEDs', 'LED')
+        self.table(('LED', 'LDR read [V]', 'Result'), [(k, v['value'], self.result_cell(v['result'])) for k, v in self.test_results['led'].items() if isinstance(v, dict)])
+
+    def GPIOLoopback_report(self):
+        self.section('GPIO Loopback', 'GPIOLoopback')
+        self.table(('Pin', 'Pin', 'Result'), [(v['pin1'], v['pin2'], self.result_cell(v['result'])) for k, v in self.test_results['gpio'].items() if isinstance(v, dict)])
+
+    def PowerSupply_report(self):
+        self.section('Power Supply', 'PowerSupply')
+        self.table(('Power Supply', 'Measured [V]', 'Result'), [(k+'V', v['value'], self.result_cell(v['result'])) for k, v in self.test_results['powerSupply'].items() if isinstance(v, dict)])
+
+    def FERAM_report(self):
+        self.section('FeRAM', 'FERAM')
+        pattern = self.test_results['feram']['pattern']
+        self.table(('Random Pattern',), [(pattern[i:i+16],) for i in range(0, len(pattern), 16)])
+        self.table(('Result',), [(self.result_cell(self.test_results['feram']['result']),)])
+
+    def Ethernet_report(self):
+        eth = self.test_results['ethernet']
+        self.section('Ethernet', 'Ethernet')
+        self.body.append('Ethernet test configuration of the station:\n')
+        self.table(('MAC', 'IP', 'Gateway', 'Mask'), [(eth['mac'], eth['testIP'], eth['testGateway'], eth['testMask'])])
+        self.body.append('Test results:\n')
+        self.table(('Received String', 'Hexadecimal', 'Result'), [(eth['message'], str(binascii.hexlify(eth['message'].encode('ascii')), 'ascii'), self.result_cell(eth['result']))])
+        link_rows = self.link_rows()
+        if link_rows:
+            self.body.append('Link quality:\n')
+            self.table(('Metric', 'Measured', 'Limit', 'Result'), [(label, value, limit, self.result_cell(res)) for label, value, limit, res in link_rows])
+
+    def generate(self, file_dir='./reports/', file_name='report1'):
+        self.build()
+
+        report_full_name = self.output_path(file_dir, file_name)
+        print('Saving report to '+report_full_name+'.html')
+
+        with open(report_full_name+'.html', 'w') as html_f:
+            html_f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{}</title><style>{}</style></head><body>\n'.format(self.TITLE, self.STYLE))
+            html_f.write(''.join(self.body))
+            html_f.write('</body></html>\n')
+
+report_backends = {'latex': RFFEuC_Report, 'fast': RFFEuC_FastReport, 'html': RFFEuC_HTMLReport}
+
+def result_text(res):
+    return '-' if res is None else ('Pass' if res else 'Fail')
+
+def reading(value):
+    return '-' if value is None else '{:.3f}'.format(value)
+
+class RFFEuC_LotReport(RFFEuC_Report):
+    """ summary of a lot: a table of every board, statistics and histograms of
+    the measurements, and the PDF report of each board attached after them
+
+    rows, stats and appendices are built by lot_report.LotReport.
+    """
+
+    #Length of the longest histogram bar [mm]
+    BAR_LENGTH = 60
+
+    def __init__(self, lot, rows, stats, appendices, date=datetime.today()):
+        self.date = date
+        self.doc = Document(default_filepath='./', page_numbers=False, geometry_options={'margin': '1.5cm'})
+        self.lot = lot
+        self.rows = rows
+        self.stats = stats
+        self.appendices = appendices
+
+    def header(self):
+        self.doc.preamble.append(Command('title', 'RFFEuC Lot Report'))
+        self.doc.preamble.append(Command('date', NoEscape(r'')))
+        self.doc.append(NoEscape(r'\maketitle'))
+
+        dates = sorted(r['date'] for r in self.rows if r['date'])
+        with self.doc.create(Center()) as centered:
+            with centered.create(Tabular('|l|l|',row_height=1.2)) as tbl:
+                tbl.add_hline()
+                tbl.add_row(bold('Lot'), self.lot)
+                tbl.add_hline()
+                tbl.add_row(bold('Boards'), self.stats['boards'])
+                tbl.add_hline()
+                tbl.add_row(bold('Passed'), self.stats['passed'])
+                tbl.add_hline()
+                tbl.add_row(bold('Yield'), '{:.1%}'.format(self.stats['yield']))
+                tbl.add_hline()
+                tbl.add_row(bold('Tested'), '{} - {}'.format(dates[0][:19], dates[-1][:19]) if dates else '-')
+                tbl.add_hline()
+
+    def summary(self):
+        self.doc.append(NoEscape(r'\clearpage'))
+        with self.doc.create(Section('Boards')):
+            self.doc.append(NoEscape(r'\footnotesize'))
+            with self.doc.create(LongTable('|l|l|l|l|'+'c|'*(len(SUBTESTS)+1), row_height=1.2)) as tbl:
+                tbl.add_hline()
+                tbl.add_row([bold(h) for h in ('SN', 'Manufacturer SN', 'MAC', 'Deploy IP')+tuple(name for name, key in SUBTESTS)+('Result',)])
+                tbl.add_hline()
+                tbl.end_table_header()
+                for r in self.rows:
+                    tbl.add_row([r['boardSN'], r['manufSN'], r['mac'], r['deployIP']]+[result_text(r['tests'][key]) for name, key in SUBTESTS]+[result_text(r['result'])],
+                                color=('green' if r['result'] else 'red'))
+                    tbl.add_hline()
+            self.doc.append(NoEscape(r'\normalsize'))
+
+    def statistics(self):
+        self.doc.append(NoEscape(r'\clearpage'))
+        with self.doc.create(Section('Statistics')):
+            with self.doc.create(Subsection('Failures')):
+                with self.doc.create(Center()) as centered:
+                    with centered.create(Tabular('|l|c|',row_height=1.2)) as tbl:
+                        tbl.add_hline()
+                        tbl.add_row(bold('Test'), bold('Failed boards'))
+                        tbl.add_hline()
+                        for name, key in SUBTESTS:
+                            tbl.add_row(bold(name), self.stats['failures'][key])
+                            tbl.add_hline()
+            for section, title in (('led', 'LED readings [V]'), ('powerSupply', 'Power supply readings [V]')):
+                with self.doc.create(Subsection(title)):
+                    self.distribution(self.stats[section])
+
+    def distribution(self, channels):
+        with self.doc.create(Center()) as centered:
+            with centered.create(Tabular('|l|c|c|c|c|c|',row_height=1.2)) as tbl:
+                tbl.add_hline()
+                tbl.add_row([bold(h) for h in ('Channel', 'Boards', 'Mean', 'Std. dev.', 'Min', 'Max')])
+                tbl.add_hline()
+                for name, d in channels.items():
+                    if d is not None:
+                        tbl.add_row(bold(name), d['n'], reading(d['mean']), '{:.4f}'.format(d['std']), reading(d['min']), reading(d['max']))
+                        tbl.add_hline()
+        for name, d in channels.items():
+            if d is None:
+                continue
+            self.doc.append(bold(name+':'))
+            with self.doc.create(Center()) as centered:
+                with centered.create(Tabular('r|l',row_height=1.0)) as tbl:
+                    top = max(d['hist']) or 1
+                    for i, count in enumerate(d['hist']):
+                        bar = NoEscape(r'\rule{{{:.1f}mm}}{{1.5ex}} {}'.format(self.BAR_LENGTH*count/top, count))
+                        tbl.add_row('{} - {}'.format(reading(d['edges'][i]), reading(d['edges'][i+1])), bar)
+
+    def appendix(self):
+        #The board reports are attached as they were rendered
+        self.doc.packages.add(Package('pdfpages'))
+        for sn, pdf in self.appendices:
+            if pdf is not None:
+                self.doc.append(NoEscape(r'\includepdf[pages=-]{'+pdf+'}'))
+            else:
+                self.doc.append(NoEscape(r'\clearpage'))
+                self.doc.append('The report of board {} is not available yet.\n'.format(sn))
+
+    def build(self):
+        self.header()
+        self.summary()
+        self.statistics()
+        self.appendix()
+
+class RFFEuC_FastLotReport(RFFEuC_LotReport, RFFEuC_FastReport):
+    """ RFFEuC_LotReport compiled with the precompiled preamble of RFFEuC_FastReport """
+
+class RFFEuC_HTMLLotReport(RFFEuC_HTMLReport):
+    """ RFFEuC_LotReport as a single HTML page, the board reports are embedded after the summary """
+
+    TITLE = 'RFFEuC Lot Report'
+    STYLE = RFFEuC_HTMLReport.STYLE+' .bar{background:#444;height:1em} td.hist{text-align:left}'
+    #Width of the longest histogram bar [em]
+    BAR_LENGTH = 20
+
+    def __init__(self, lot, rows, stats, appendices, date=datetime.today()):
+        self.date = date
+        self.lot = lot
+        self.rows = rows
+        self.stats = stats
+        self.appendices = appendices
+        self.body = []
+
+    @staticmethod
+    def result_cell(res):
+        if res is None:
+            return '<td>-</td>'
+        return RFFEuC_HTMLReport.result_cell(res)
+
+    def header(self):
+        dates = sorted(r['date'] for r in self.rows if r['date'])
+        self.body.append('<h1>RFFEuC Lot Report</h1>\n')
+        self.table(None, [('Lot', self.lot), ('Boards', self.stats['boards']), ('Passed', self.stats['passed']), ('Yield', '{:.1%}'.format(self.stats['yield'])),
+                          ('Tested', '{} - {}'.format(dates[0][:19], dates[-1][:19]) if dates else '-')])
+
+    def summary(self):
+        self.body.append('<h2>Boards</h2>\n')
+        self.table(('SN', 'Manufacturer SN', 'MAC', 'Deploy IP')+tuple(name for name, key in SUBTESTS)+('Result',),
+                   [['<td><a href="#{0}">{0}</a></td>'.format(html.escape(r['boardSN'])), r['manufSN'], r['mac'], r['deployIP']]+
+                    [self.result_cell(r['tests'][key]) for name, key in SUBTESTS]+[self.result_cell(r['result'])] for r in self.rows])
+
+    def statistics(self):
+        self.body.append('<h2>Statistics</h2>\n<h3>Failures</h3>\n')
+        self.table(('Test', 'Failed boards'), [(name, self.stats['failures'][key]) for name, key in SUBTESTS])
+        for section, title in (('led', 'LED readings [V]'), ('powerSupply', 'Power supply readings [V]')):
+            self.body.append('<h3>{}</h3>\n'.format(title))
+            channels = [(name, d) for name, d in self.stats[section].items() if d is not None]
+            self.table(('Channel', 'Boards', 'Mean', 'Std. dev.', 'Min', 'Max'),
+                       [(name, d['n'], reading(d['mean']), '{:.4f}'.format(d['std']), reading(d['min']), reading(d['max'])) for name, d in channels])
+            for name, d in channels:
+                top = max(d['hist']) or 1
+                self.body.append('<b>{}:</b>\n'.format(html.escape(name)))
+                self.table(None, [('{} - {}'.format(reading(d['edges'][i]), reading(d['edges'][i+1])),
+                                   '<td class="hist"><div class="bar" style="width:{:.1f}em"></div></td>'.format(self.BAR_LENGTH*count/top), count)
+                                  for i, count in enumerate(d['hist'])])
+
+    def appendix(self):
+        self.body.append('<h2>Board Reports</h2>\n')
+        for sn, fragment in self.appendices:
+            self.body.append(fragment if fragment is not None else '<p>The report of board {} is not available yet.</p>\n'.format(html.escape(sn)))
+
+    def build(self):
+        self.header()
+        self.summary()
+        self.statistics()
+        self.appendix()
+
+lot_report_backends = {'latex': RFFEuC_LotReport, 'fast': RFFEuC_FastLotReport, 'html': RFFEuC_HTMLLotReport}
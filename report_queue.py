@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import pathlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+class ReportQueue(object):
+    """ durable queue of pending PDF reports
+
+    Jobs are JSON files moved between the pending/, running/, done/ and failed/
+    directories of queue_dir, so they survive a crash of the station and may
+    be shared by several processes (a job is claimed by renaming it). The
+    test results of each job are stored with RFFEuC_Test.dump() in dumps/.
+    """
+
+    def __init__(self, queue_dir='./reports/queue/', workers=2, retries=3, retry_delay=10.0, poll=0.5, backend='fast'):
+        self.backend = backend
+        self.queue_dir = pathlib.Path(os.path.abspath(os.path.expanduser(queue_dir)))
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.poll = poll
+        self.threads = []
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Condition()
+        for d in ('pending', 'running', 'done', 'failed', 'dumps'):
+            (self.queue_dir / d).mkdir(parents=True, exist_ok=True)
+        self.requeue_orphans()
+
+    def job_path(self, state, name):
+        return self.queue_dir / state / name
+
+    def write_job(self, state, name, job):
+        #Write to a temporary file first, so a job file is never seen half written
+        tmp = self.queue_dir / state / ('.'+name+'.tmp')
+        with tmp.open('w') as job_f:
+            json.dump(job, job_f, indent=4, ensure_ascii=True)
+        os.replace(str(tmp), str(self.job_path(state, name)))
+
+    def requeue_orphans(self):
+        for f in (self.queue_dir / 'running').glob('*.json.*'):
+            name, pid = f.name.rsplit('.', 1)
+            try:
+                os.kill(int(pid), 0)
+            except (ValueError, ProcessLookupError):
+                os.replace(str(f), str(self.job_path('pending', name)))
+            except PermissionError:
+                pass
+
+    def submit(self, test, file_dir, file_name):
+        job_id = '{}_{}_{}.json'.format(time.strftime('%Y%m%d%H%M%S'), file_name, uuid.uuid4().hex[:8])
+        dump_path = self.queue_dir / 'dumps' / job_id
+        test.dump(str(dump_path))
+        job = OrderedDict([('dump', str(dump_path)),
+                           ('fileDir', os.path.abspath(os.path.expanduser(file_dir))),
+                           ('fileName', file_name),
+                           ('backend', self.backend),
+                           ('attempts', 0),
+                           ('notBefore', 0),
+                           ('errors', [])])
+        self.write_job('pending', job_id, job)
+        with self.wakeup:
+            self.wakeup.notify()
+        return job_id
+
+    def claim(self):
+        now = time.time()
+        for f in sorted((self.queue_dir / 'pending').glob('*.json')):
+            try:
+                with f.open() as job_f:
+                    job = json.loads(job_f.read(), object_pairs_hook=OrderedDict)
+            except (OSError, ValueError):
+                continue
+            if job['notBefore'] > now:
+                continue
+            running = self.job_path('running', f.name+'.'+str(os.getpid()))
+            try:
+                os.rename(str(f), str(running))
+            except OSError:
+                #Claimed by another worker
+                continue
+            return f.name, running, job
+        return None
+
+    def render(self, job):
+        #pylatex is only needed by the process that renders the reports
+        from report import report_backends
+        with open(job['dump']) as dump_f:
+            test_results = json.loads(dump_f.read(), object_pairs_hook=OrderedDict)
+        report_backends[job.get('backend', self.backend)](test_results).generate(job['fileDir'], job['fileName'])
+
+    def process_one(self):
+        claimed = self.claim()
+        if claimed is None:
+            return False
+        name, running, job = claimed
+        job['attempts'] += 1
+        try:
+            self.render(job)
+            state = 'done'
+        except Exception as e:
+            print('[ERROR] Report {} failed (attempt {}/{}): {}'.format(job['fileName'], job['attempts'], self.retries, e))
+            job['errors'].append(str(e))
+            job['notBefore'] = time.time() + self.retry_delay
+            state = 'failed' if job['attempts'] >= self.retries else 'pending'
+        self.write_job(state, name, job)
+        os.remove(str(running))
+        return True
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            if not self.process_one():
+                with self.wakeup:
+                    self.wakeup.wait(self.poll)
+
+    def start(self):
+        self.stop_event.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self.worker, name='report-worker-{}'.format(i), daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def count(self, state='pending'):
+        return len(list((self.queue_dir / state).glob('[!.]*.json*')))
+
+    def outstanding(self):
+        return self.count('pending') + self.count('running')
+
+    def wait(self, timeout=None):
+        """ wait until no report is pending or running, returns False on timeout or when no worker is left to render them """
+        end = None if timeout is None else time.monotonic() + timeout
+        while self.outstanding():
+            if end is not None and time.monotonic() >= end:
+                return False
+            if not any(t.is_alive() for t in self.threads):
+                return False
+            time.sleep(self.poll)
+        return True
+
+    def flush(self):
+        """ render every pending report in the calling thread, ignoring retry delays """
+        for f in (self.queue_dir / 'pending').glob('*.json'):
+            try:
+                with f.open() as job_f:
+                    job = json.loads(job_f.read(), object_pairs_hook=OrderedDict)
+                job['notBefore'] = 0
+                self.write_job('pending', f.name, job)
+            except (OSError, ValueError):
+                pass
+        while self.process_one():
+            pass
+        return self.count('failed')
+
+    def retry_failed(self):
+        for f in (self.queue_dir / 'failed').glob('*.json'):
+            with f.open() as job_f:
+                job = json.loads(job_f.read(), object_pairs_hook=OrderedDict)
+            job['attempts'] = 0
+            job['notBefore'] = 0
+            self.write_job('pending', f.name, job)
+            os.remove(str(f))
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the pending RFFEuC reports')
+    parser.add_argument('--queue', default='./reports/queue/', help='Report queue directory')
+    parser.add_argument('--retry-failed', action='store_true', help='Move failed reports back to the queue first')
+    parser.add_argument('--backend', default='fast', choices=['latex', 'fast', 'html'], help='Renderer for jobs that do not name one')
+    args = parser.parse_args()
+
+    queue = ReportQueue(args.queue, backend=args.backend)
+    if args.retry_failed:
+        queue.retry_failed()
+    print('{} pending reports'.format(queue.count('pending')))
+    failed = queue.flush()
+    print('Done, {} failed reports in {}'.format(failed, queue.queue_dir / 'failed'))
+
+if __name__ == '__main__':
+    main()
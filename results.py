@@ -0,0 +1,501 @@
+#!/usr/bin/python3
+import argparse
+import json
+import mmap
+import os
+import pathlib
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+#JSON key and attribute of each board information field, in dump order
+INFO_FIELDS = (('operator', 'operator'), ('date', 'date'), ('testBoardSN', 'test_board_sn'), ('testBoardPN', 'test_board_pn'),
+               ('testSWCommit', 'test_sw_commit'), ('testMaskVersion', 'test_mask_version'), ('boardSN', 'board_sn'),
+               ('boardPN', 'board_pn'), ('manufSN', 'manuf_sn'))
+ETH_FIELDS = (('message', 'message'), ('result', 'result'), ('mac', 'mac'), ('targetIP', 'target_ip'), ('targetGateway', 'target_gateway'),
+              ('targetMask', 'target_mask'), ('testIP', 'test_ip'), ('testGateway', 'test_gateway'), ('testMask', 'test_mask'), ('link', 'link'))
+DEPLOY_FIELDS = (('deployIP', 'ip'), ('deployMask', 'mask'), ('deployGateway', 'gateway'))
+SECTIONS = ('led', 'gpio', 'powerSupply', 'ethernet', 'feram')
+
+def verdict(v):
+    return type(v) is int and 0 <= v <= 1
+
+class Measurement(object):
+    """ one LED or power supply reading """
+
+    __slots__ = ('name', 'value', 'result')
+
+    def __init__(self, name, value, result):
+        self.name = name
+        self.value = value
+        self.result = result
+
+    @classmethod
+    def from_json(cls, name, d):
+        if tuple(d) != ('value', 'result') or type(d['value']) is not float or not verdict(d['result']):
+            return None
+        return cls(name, d['value'], d['result'])
+
+    def to_json(self):
+        return OrderedDict([('value', self.value), ('result', self.result)])
+
+class Loopback(object):
+    """ one GPIO loopback pair """
+
+    __slots__ = ('name', 'pin1', 'pin2', 'result')
+
+    def __init__(self, name, pin1, pin2, result):
+        self.name = name
+        self.pin1 = pin1
+        self.pin2 = pin2
+        self.result = result
+
+    @classmethod
+    def from_json(cls, name, d):
+        if tuple(d) != ('pin1', 'pin2', 'result') or not isinstance(d['pin1'], str) or not isinstance(d['pin2'], str) or not verdict(d['result']):
+            return None
+        return cls(name, d['pin1'], d['pin2'], d['result'])
+
+    def to_json(self):
+        return OrderedDict([('pin1', self.pin1), ('pin2', self.pin2), ('result', self.result)])
+
+class Section(object):
+    """ LED, GPIO or power supply results: the items in test order and the section result """
+
+    __slots__ = ('items', 'result')
+
+    def __init__(self, items, result):
+        self.items = items
+        self.result = result
+
+    @classmethod
+    def from_json(cls, d, item):
+        #None when d isn't laid out as the parser writes it, the section is then kept as it is
+        if not isinstance(d, dict) or 'result' not in d or list(d)[-1] != 'result' or not verdict(d['result']):
+            return None
+        items = []
+        for k, v in d.items():
+            if k == 'result':
+                continue
+            #Item keys are strings once dumped, the parser may still hold them as ints
+            v = item.from_json(str(k), v) if isinstance(v, dict) else None
+            if v is None:
+                return None
+            items.append(v)
+        return cls(items, d['result'])
+
+    def to_json(self):
+        d = OrderedDict((item.name, item.to_json()) for item in self.items)
+        d['result'] = self.result
+        return d
+
+    def grade(self, check):
+        res = 1
+        for item in self.items:
+            item.result = check(item)
+            res &= item.result
+        self.result = res
+        return res
+
+class FeRAMResult(object):
+    """ FeRAM test, the random pattern is kept as bytes """
+
+    __slots__ = ('pattern', 'lower', 'result')
+
+    def __init__(self, pattern, result, lower=False):
+        self.pattern = pattern
+        self.lower = lower
+        self.result = result
+
+    @classmethod
+    def from_json(cls, d):
+        if not isinstance(d, dict) or tuple(d) != ('pattern', 'result') or not isinstance(d['pattern'], str) or not verdict(d['result']):
+            return None
+        hex_str = d['pattern']
+        try:
+            pattern = bytes.fromhex(hex_str)
+        except ValueError:
+            return None
+        #The case of the hex digits is kept, so the JSON comes back unchanged
+        if pattern.hex().upper() == hex_str:
+            return cls(pattern, d['result'])
+        if pattern.hex() == hex_str:
+            return cls(pattern, d['result'], lower=True)
+        return None
+
+    def to_json(self):
+        hex_str = self.pattern.hex()
+        return OrderedDict([('pattern', hex_str if self.lower else hex_str.upper()), ('result', self.result)])
+
+class Deploy(object):
+    """ network configuration programmed with the deploy firmware """
+
+    __slots__ = ('ip', 'mask', 'gateway')
+
+    def __init__(self, ip=None, mask=None, gateway=None):
+        self.ip = ip
+        self.mask = mask
+        self.gateway = gateway
+
+class EthernetResult(object):
+    """ Ethernet test: received message, test and target configuration, graded link measurements """
+
+    __slots__ = tuple(attr for key, attr in ETH_FIELDS) + ('extra',)
+
+    def __init__(self, **fields):
+        for key, attr in ETH_FIELDS:
+            setattr(self, attr, fields.get(attr))
+        self.extra = fields.get('extra') or OrderedDict()
+
+class BoardInfo(object):
+
+    __slots__ = tuple(attr for key, attr in INFO_FIELDS)
+
+    def __init__(self, **fields):
+        for key, attr in INFO_FIELDS:
+            setattr(self, attr, fields.get(attr))
+
+class TestResults(object):
+    """ typed RFFEuC_Test.test_results
+
+    from_json() and to_json() convert from and to the dump() layout without
+    losing anything: keys the model doesn't know, and sections that are not
+    laid out as the parser writes them, are kept as they are in extra (or in
+    trailer when they came after the board result). Key order follows
+    RFFEuC_Test. A missing field or section is None.
+    """
+
+    __slots__ = ('info', 'timing', 'led', 'gpio', 'power_supply', 'ethernet', 'deploy', 'feram', 'result', 'extra', 'trailer')
+
+    def __init__(self, info=None, timing=None, led=None, gpio=None, power_supply=None, ethernet=None, deploy=None, feram=None, result=None, extra=None, trailer=None):
+        self.info = info if info is not None else BoardInfo()
+        self.timing = timing
+        self.led = led
+        self.gpio = gpio
+        self.power_supply = power_supply
+        self.ethernet = ethernet
+        self.deploy = deploy
+        self.feram = feram
+        self.result = result
+        self.extra = extra if extra is not None else OrderedDict()
+        self.trailer = trailer if trailer is not None else OrderedDict()
+
+    @classmethod
+    def from_json(cls, d):
+        r = cls()
+        info = dict((key, attr) for key, attr in INFO_FIELDS)
+        after_result = False
+        for k, v in d.items():
+            extra = r.trailer if after_result else r.extra
+            if v is None:
+                #Typed fields use None for missing, an explicit null is kept as it is
+                extra[k] = v
+            elif k in info and isinstance(v, str):
+                setattr(r.info, info[k], v)
+            elif k == 'timing' and isinstance(v, dict):
+                r.timing = v
+            elif k == 'led' and r.led is None:
+                r.led = Section.from_json(v, Measurement)
+                if r.led is None:
+                    extra[k] = v
+            elif k == 'gpio' and r.gpio is None:
+                r.gpio = Section.from_json(v, Loopback)
+                if r.gpio is None:
+                    extra[k] = v
+            elif k == 'powerSupply' and r.power_supply is None:
+                r.power_supply = Section.from_json(v, Measurement)
+                if r.power_supply is None:
+                    extra[k] = v
+            elif k == 'ethernet' and isinstance(v, dict):
+                r.ethernet, r.deploy = cls.ethernet_from_json(v)
+            elif k == 'feram':
+                r.feram = FeRAMResult.from_json(v)
+                if r.feram is None:
+                    extra[k] = v
+            elif k == 'result' and not after_result:
+                r.result = v
+                after_result = True
+            else:
+                extra[k] = v
+        return r
+
+    @staticmethod
+    def ethernet_from_json(d):
+        eth = EthernetResult()
+        deploy = None
+        fields = dict(ETH_FIELDS)
+        deploy_fields = dict(DEPLOY_FIELDS)
+        for k, v in d.items():
+            if v is not None and k in fields:
+                setattr(eth, fields[k], v)
+            elif v is not None and k in deploy_fields:
+                if deploy is None:
+                    deploy = Deploy()
+                setattr(deploy, deploy_fields[k], v)
+            else:
+                eth.extra[k] = v
+        return eth, deploy
+
+    def to_json(self):
+        d = OrderedDict()
+        for key, attr in INFO_FIELDS:
+            v = getattr(self.info, attr)
+            if v is not None:
+                d[key] = v
+        if self.timing is not None:
+            d['timing'] = self.timing
+        for key, section in (('led', self.led), ('gpio', self.gpio), ('powerSupply', self.power_supply)):
+            if section is not None:
+                d[key] = section.to_json()
+        if self.ethernet is not None:
+            eth = d['ethernet'] = OrderedDict()
+            for key, attr in ETH_FIELDS:
+                v = getattr(self.ethernet, attr)
+                if v is not None:
+                    eth[key] = v
+            if self.deploy is not None:
+                for key, attr in DEPLOY_FIELDS:
+                    v = getattr(self.deploy, attr)
+                    if v is not None:
+                        eth[key] = v
+            eth.update(self.ethernet.extra)
+        if self.feram is not None:
+            d['feram'] = self.feram.to_json()
+        d.update(self.extra)
+        if self.result is not None:
+            d['result'] = self.result
+        d.update(self.trailer)
+        return d
+
+    def sections(self):
+        """ (name, section result) of the subtests present """
+        res = []
+        for name, sec in (('led', self.led), ('gpio', self.gpio), ('powerSupply', self.power_supply), ('ethernet', self.ethernet), ('feram', self.feram)):
+            if sec is not None:
+                res.append((name, sec.result))
+            elif isinstance(self.extra.get(name), dict) and 'result' in self.extra[name]:
+                res.append((name, self.extra[name]['result']))
+        return res
+
+    def failed(self):
+        return [name for name, res in self.sections() if res == 0]
+
+    def grade(self, mask):
+        """ re-grade against a masks.CompiledMask, as CompiledMask.grade() does for the JSON layout, returns the board result """
+        if self.led is not None:
+            self.led.grade(lambda m: mask.led(m.value))
+        if self.power_supply is not None:
+            self.power_supply.grade(lambda m: mask.rails[m.name](m.value) if m.name in mask.rails else 0)
+        if self.ethernet is not None:
+            sec = mask.message(self.ethernet.message)
+            if isinstance(self.ethernet.link, dict):
+                sec &= mask.grade_link(self.ethernet.link)
+            self.ethernet.result = sec
+        res = 1
+        for name, r in self.sections():
+            res &= r
+        for k, v in list(self.extra.items()) + list(self.trailer.items()):
+            if isinstance(v, dict) and 'result' in v and k not in SECTIONS:
+                res &= v['result']
+        if 'timeout' in self.extra or 'timeout' in self.trailer:
+            res = 0
+        self.result = res
+        return res
+
+#Binary encoding, version 1: HEADER, the verdicts and readings of the LED, GPIO
+#and power supply sections as packed arrays, the FeRAM verdict and pattern,
+#then the strings and free form fields (timing, link, extra keys) as one
+#compact JSON array, which the C decoder of the json module reads at once.
+MAGIC = b'RFR'
+VERSION = 1
+#Magic, version, flags, LED, GPIO and power supply item counts
+HEADER = struct.Struct('<3sBB3H')
+FERAM_HEAD = struct.Struct('<BI')
+LED, GPIO, POWER_SUPPLY, FERAM, FERAM_LOWER = 1, 2, 4, 8, 16
+RECORD = struct.Struct('<I')
+
+def encode(r):
+    """ TestResults (or a dump() dict) to the compact binary encoding """
+    if isinstance(r, dict):
+        r = TestResults.from_json(r)
+    flags = 0
+    counts = []
+    body = bytearray()
+    tail = [[getattr(r.info, attr) for key, attr in INFO_FIELDS], r.timing]
+    for bit, sec in ((LED, r.led), (GPIO, r.gpio), (POWER_SUPPLY, r.power_supply)):
+        if sec is None:
+            counts.append(0)
+            tail.append(None)
+            continue
+        flags |= bit
+        counts.append(len(sec.items))
+        body.append(sec.result)
+        body += bytes(item.result for item in sec.items)
+        if bit == GPIO:
+            tail.append([field for item in sec.items for field in (item.name, item.pin1, item.pin2)])
+        else:
+            body += struct.pack('<{}d'.format(len(sec.items)), *[item.value for item in sec.items])
+            tail.append([item.name for item in sec.items])
+    if r.feram is not None:
+        flags |= FERAM | (FERAM_LOWER if r.feram.lower else 0)
+        body += FERAM_HEAD.pack(r.feram.result, len(r.feram.pattern))
+        body += r.feram.pattern
+    eth = r.ethernet
+    tail.append(None if eth is None else [getattr(eth, attr) for key, attr in ETH_FIELDS] + [eth.extra])
+    tail.append(None if r.deploy is None else [r.deploy.ip, r.deploy.mask, r.deploy.gateway])
+    tail += [r.result, r.extra, r.trailer]
+    return HEADER.pack(MAGIC, VERSION, flags, *counts) + body + json.dumps(tail, separators=(',', ':')).encode('ascii')
+
+def decode(data):
+    """ TestResults from its binary encoding, data is bytes """
+    magic, version, flags, n_led, n_gpio, n_ps = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not an encoded test result')
+    if version != VERSION:
+        raise ValueError('unsupported test result encoding version {}'.format(version))
+    pos = HEADER.size
+    sections = []
+    for bit, n in ((LED, n_led), (GPIO, n_gpio), (POWER_SUPPLY, n_ps)):
+        if not flags & bit:
+            sections.append(None)
+            continue
+        res, verdicts = data[pos], data[pos+1:pos+1+n]
+        pos += 1 + n
+        values = None
+        if bit != GPIO:
+            values = struct.unpack_from('<{}d'.format(n), data, pos)
+            pos += 8*n
+        sections.append((res, verdicts, values))
+    r = TestResults()
+    if flags & FERAM:
+        res, n = FERAM_HEAD.unpack_from(data, pos)
+        pos += FERAM_HEAD.size
+        r.feram = FeRAMResult(data[pos:pos+n], res, lower=bool(flags & FERAM_LOWER))
+        pos += n
+    info, r.timing, led, gpio, ps, eth, deploy, r.result, r.extra, r.trailer = json.loads(data[pos:], object_pairs_hook=OrderedDict)
+    for (key, attr), v in zip(INFO_FIELDS, info):
+        setattr(r.info, attr, v)
+    if sections[0] is not None:
+        res, verdicts, values = sections[0]
+        r.led = Section([Measurement(*item) for item in zip(led, values, verdicts)], res)
+    if sections[1] is not None:
+        res, verdicts, values = sections[1]
+        fields = iter(gpio)
+        r.gpio = Section([Loopback(*pins, result) for pins, result in zip(zip(fields, fields, fields), verdicts)], res)
+    if sections[2] is not None:
+        res, verdicts, values = sections[2]
+        r.power_supply = Section([Measurement(*item) for item in zip(ps, values, verdicts)], res)
+    if eth is not None:
+        r.ethernet = EthernetResult(extra=eth.pop())
+        for (key, attr), v in zip(ETH_FIELDS, eth):
+            setattr(r.ethernet, attr, v)
+    if deploy is not None:
+        r.deploy = Deploy(*deploy)
+    return r
+
+class ResultLog(object):
+    """ append only file of encoded test results, for loading whole result histories at once
+
+    Each record is its length followed by the encoding. Reading maps the
+    file and decodes the records one by one, a record left half written by
+    a crash is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def extend(self, results):
+        n = 0
+        with open(self.path, 'ab') as log_f:
+            for r in results:
+                data = encode(r)
+                #One write per record, so that concurrent appends don't interleave
+                log_f.write(RECORD.pack(len(data)) + data)
+                n += 1
+        return n
+
+    def append(self, r):
+        return self.extend([r])
+
+    def records(self):
+        """ (offset, size) of each complete record, only the length prefixes are read """
+        res = []
+        try:
+            log_f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return res
+        with log_f:
+            size = os.fstat(log_f.fileno()).st_size
+            pos = 0
+            while pos + RECORD.size <= size:
+                log_f.seek(pos)
+                n = RECORD.unpack(log_f.read(RECORD.size))[0]
+                if pos + RECORD.size + n > size:
+                    break
+                res.append((pos + RECORD.size, n))
+                pos += RECORD.size + n
+        return res
+
+    def read(self, start=0, stop=None):
+        """ decode the records start to stop """
+        try:
+            log_f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with log_f:
+            size = os.fstat(log_f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(log_f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = i = 0
+                while pos + RECORD.size <= size and (stop is None or i < stop):
+                    n = RECORD.unpack_from(mm, pos)[0]
+                    pos += RECORD.size
+                    if pos + n > size:
+                        return
+                    if i >= start:
+                        yield decode(mm[pos:pos+n])
+                    pos += n
+                    i += 1
+
+    def __iter__(self):
+        return self.read()
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert RFFEuC test results between dump() JSON files and a binary result log')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    pack = sub.add_parser('pack', help='Append dump() JSON files to a result log')
+    pack.add_argument('log', help='Result log file')
+    pack.add_argument('dumps', nargs='+', help='dump() JSON files or directories of them')
+    unpack = sub.add_parser('unpack', help='Write every result of a log back as dump() JSON files, named after the board SN')
+    unpack.add_argument('log', help='Result log file')
+    unpack.add_argument('output', help='Output directory')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    if args.cmd == 'pack':
+        def results():
+            for d in args.dumps:
+                p = pathlib.Path(d)
+                for f in (sorted(p.rglob('*.json')) if p.is_dir() else [p]):
+                    try:
+                        with f.open() as dump_f:
+                            res = json.loads(dump_f.read(), object_pairs_hook=OrderedDict)
+                    except (OSError, ValueError) as e:
+                        print('[WARNING] Skipping {}: {}'.format(f, e), file=sys.stderr)
+                        continue
+                    if isinstance(res, dict) and 'boardSN' in res:
+                        yield res
+        n = ResultLog(args.log).extend(results())
+    else:
+        pathlib.Path(args.output).mkdir(parents=True, exist_ok=True)
+        n = 0
+        for r in ResultLog(args.log):
+            with open(os.path.join(args.output, '{}.json'.format(r.info.board_sn)), 'w') as dump_f:
+                json.dump(r.to_json(), dump_f, indent=4, ensure_ascii=True)
+            n += 1
+    print('{} results in {:.1f}s'.format(n, time.monotonic() - start))
+
+if __name__ == '__main__':
+    main()
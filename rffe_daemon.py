@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import serial
+
+import masks
+import rffe_test
+from allocator import IdentityAllocator
+from eth_probe import EthTestConf
+import station_metrics
+from pipeline import Pipeline
+from programmer import firmware_cache, programmer_session
+from report_queue import ReportQueue
+from serial_archive import CaptureArchive
+from lot_report import LotReport
+from rffe_uc import RFFEuC_Test, sw_commit
+
+SOCKET_PATH = './rffe_bench.sock'
+
+class DaemonError(Exception):
+    pass
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        #One JSON request per line, each one answered by one JSON line
+        for ln in self.rfile:
+            try:
+                req = json.loads(ln.decode('utf-8'))
+                resp = self.server.daemon.handle(req)
+            except ValueError as e:
+                resp = {'ok': False, 'error': 'invalid request: {}'.format(e)}
+            self.wfile.write((json.dumps(resp)+'\n').encode('utf-8'))
+            self.wfile.flush()
+
+class BenchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class BenchDaemon(object):
+    """ long running test bench, driven through a local Unix socket
+
+    The serial port, programmer session, masks, firmware images, report
+    queue, registry and commit metadata are set up once in start() and kept
+    for every board. Requests are JSON objects with a "cmd" entry:
+
+        next                          SN/IP/MAC the next board will get
+        start   manufSN, operator     queue a board, sn/ip/mac/boardPN override the defaults,
+                [repeat]              repeat is the id of a job whose board is tested again
+        status                        running job, its phase and the queue
+        abort   [id]                  stop the self tests of the running board
+        results id                    state and test results of a job
+        wait    id [timeout]          block until the job is done
+        reports                       pending and failed report counts
+        shutdown
+
+    Every answer has "ok", and "error" when ok is false.
+
+    Boards go through a pipeline: the 'test' stage owns the fixture (flashing,
+    self tests, deploy flash) and the 'record' stage writes the registry,
+    metrics and report of a board while the next one is already being tested.
+    At most queue_depth boards wait for each stage, start blocks when the line
+    is full. Jobs go through the states queued, testing, recording and then
+    done, aborted or error.
+
+    Identities are leased from the registry under the station name (host and
+    serial port by default), so several benches may share one database. A
+    lease is confirmed once its board got the identity stored in FeRAM, pass
+    or fail, and released when the test stopped before. A job given its own
+    SN or MAC doesn't take a lease.
+    """
+
+    KEEP_JOBS = 200
+    ACTIVE = ('queued', 'testing', 'recording')
+
+    def __init__(self, socket_path=SOCKET_PATH, serial_port='/dev/ttyUSB0', board_pn='RFFEuC:1.2', mask_path='mask.json', report_path='./reports/',
+                 registry_path=None, probe_id=None, test_board_sn=None, fail_fast=False, metrics_dir='./metrics/', test_class=RFFEuC_Test, queue_depth=2, capture_dir='./captures/', lot=None, station=None, eth_test=None):
+        self.socket_path = str(socket_path)
+        self.serial_port = serial_port
+        self.board_pn = board_pn
+        self.mask_path = mask_path
+        self.report_path = report_path
+        #rffe_test imports this module, its defaults are only looked up at run time
+        self.registry_path = registry_path if registry_path is not None else rffe_test.registry_path
+        self.probe_id = probe_id
+        self.test_board_sn = test_board_sn
+        self.fail_fast = fail_fast
+        self.metrics_dir = metrics_dir
+        self.capture_dir = capture_dir
+        self.lot = lot
+        self.station = station if station is not None else '{}:{}'.format(socket.gethostname(), serial_port)
+        #Test address and interface of this bench, benches sharing a host or subnet each need their own
+        self.eth_test = eth_test
+        self.test_class = test_class
+        self.jobs = OrderedDict()
+        self.pipeline = Pipeline([('test', self.test_stage), ('record', self.record_stage)], queue_depth)
+        self.current = None
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.port = None
+        self.server = None
+        self.threads = []
+        self.stopper = None
+        self.commands = {'next': self.cmd_next, 'start': self.cmd_start, 'status': self.cmd_status, 'abort': self.cmd_abort,
+                         'results': self.cmd_results, 'wait': self.cmd_wait, 'reports': self.cmd_reports, 'shutdown': self.cmd_shutdown}
+
+    def warm_up(self):
+        sw_commit()
+        masks.select(self.mask_path, self.board_pn, self.test_board_sn)
+        programmer_session(self.test_class.PROGRAMMER, self.probe_id)
+        try:
+            firmware_cache.get(self.test_class.TEST_FW)
+        except OSError as e:
+            print('[WARNING] Could not preload the test firmware: '+str(e))
+        try:
+            self.port = serial.Serial(self.serial_port, 115200, timeout=self.test_class.SERIAL_POLL)
+        except (serial.SerialException, OSError) as e:
+            #Opened again for each board
+            print('[WARNING] Could not open {}: {}'.format(self.serial_port, e))
+            self.port = None
+
+    def start(self):
+        self.warm_up()
+        self.registry = rffe_test.open_registry(self.registry_path)
+        self.allocator = IdentityAllocator(self.registry, rffe_test.ip_pool)
+        #No reports at all when report_path is None
+        self.report_queue = ReportQueue(os.path.join(self.report_path, 'queue')).start() if self.report_path is not None else None
+        self.capture_archive = CaptureArchive(self.capture_dir).start() if self.capture_dir is not None else None
+        #The lot report embeds the HTML report of each board, it's up to date as soon as a board is recorded
+        self.lot_report = LotReport(self.lot, os.path.join(self.report_path, 'lots'), 'html', self.report_path) if self.lot is not None and self.report_path is not None else None
+        self.metrics = station_metrics.StationMetrics()
+        if os.path.exists(self.socket_path):
+            try:
+                BenchClient(self.socket_path).close()
+                raise DaemonError('a test bench is already running on '+self.socket_path)
+            except OSError:
+                #Left over by a daemon that didn't shut down cleanly
+                os.remove(self.socket_path)
+        self.server = BenchServer(self.socket_path, RequestHandler)
+        self.server.daemon = self
+        self.pipeline.start()
+        t = threading.Thread(target=self.server.serve_forever, name='bench-server', daemon=True)
+        t.start()
+        self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.pipeline.stop()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        for t in self.threads:
+            if t is not threading.current_thread():
+                t.join()
+        self.threads = []
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        if self.report_queue is not None:
+            self.report_queue.stop()
+        if self.capture_archive is not None:
+            self.capture_archive.stop()
+        if self.port is not None:
+            self.port.close()
+        self.registry.close()
+
+    def drain(self):
+        """ wait for the queued boards and their reports """
+        with self.lock:
+            while any(job['state'] in self.ACTIVE for job in self.jobs.values()):
+                self.done.wait()
+        if self.report_queue is None:
+            return
+        if self.report_queue.outstanding():
+            print('Waiting for {} pending reports...'.format(self.report_queue.outstanding()))
+        if not self.report_queue.wait():
+            print('[WARNING] {} reports left in the queue, run report_queue.py to render them'.format(self.report_queue.outstanding()))
+        if self.report_queue.count('failed'):
+            print('{} reports failed, run report_queue.py --retry-failed to render them again'.format(self.report_queue.count('failed')))
+
+    def handle(self, req):
+        cmd = self.commands.get(req.get('cmd'))
+        if cmd is None:
+            return {'ok': False, 'error': 'unknown command "{}"'.format(req.get('cmd'))}
+        try:
+            resp = cmd(req)
+        except (DaemonError, KeyError) as e:
+            return {'ok': False, 'error': str(e)}
+        resp['ok'] = True
+        return resp
+
+    def summary(self, job, results=False):
+        return OrderedDict((k, v) for k, v in job.items() if results or k != 'results')
+
+    def job(self, req):
+        job_id = req.get('id')
+        if job_id is None and self.current is not None:
+            job_id = self.current[0]['id']
+        if job_id not in self.jobs:
+            raise DaemonError('unknown job "{}"'.format(job_id))
+        return self.jobs[job_id]
+
+    def cmd_next(self, req):
+        nxt = self.allocator.peek(self.station)
+        return {'next': OrderedDict((k, nxt[k]) for k in ('sn', 'ip', 'mac'))}
+
+    def cmd_start(self, req):
+        if not req.get('manufSN'):
+            raise DaemonError('manufSN is required')
+        if req.get('sn') or req.get('mac'):
+            lease = self.allocator.peek(self.station)
+            lease['id'] = None
+        else:
+            with self.lock:
+                repeat = self.jobs.get(req.get('repeat'), {}).get('lease')
+            lease = self.allocator.lease(self.station, repeat)
+        sn, ip, mac = req.get('sn') or lease['sn'], req.get('ip') or lease['ip'], str(req.get('mac') or lease['mac']).replace(':', '')
+        with self.lock:
+            job = OrderedDict([('id', uuid.uuid4().hex[:12]), ('state', 'queued'), ('sn', sn), ('ip', ip), ('mac', mac), ('lease', lease['id']), ('stored', False),
+                               ('manufSN', str(req['manufSN'])), ('operator', req.get('operator', '')), ('boardPN', req.get('boardPN', self.board_pn)),
+                               ('queued', time.time()), ('result', None), ('duration', None), ('results', None)])
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.KEEP_JOBS:
+                self.jobs.popitem(last=False)
+        #Blocks while the line is full, the pipeline's feed stats tell how long
+        self.pipeline.submit(job)
+        return {'job': self.summary(job)}
+
+    def cmd_status(self, req):
+        with self.lock:
+            resp = OrderedDict([('state', 'running' if self.current else 'idle'), ('queued', self.pipeline.depth())])
+            if self.current is not None:
+                job, uc = self.current
+                resp['job'] = self.summary(job)
+                if uc.session is not None and uc.session.phase is not None:
+                    resp['phase'] = uc.session.phase.name
+                resp['timing'] = uc.test_results.get('timing')
+            resp['metrics'] = self.metrics.summary()
+            resp['boards'] = OrderedDict(self.metrics.results)
+        resp['stages'] = self.pipeline.stats()
+        resp['bottleneck'] = self.pipeline.bottleneck()
+        return resp
+
+    def cmd_abort(self, req):
+        with self.lock:
+            job = self.job(req)
+            if job['state'] == 'queued':
+                #Taken out of the line here, test_stage skips it. The registry is written once the lock is released
+                job['state'] = 'aborted'
+            elif self.current is not None and self.current[0] is job:
+                self.current[1].abort()
+                return {'job': self.summary(job)}
+            elif job['state'] == 'testing':
+                #The test is being set up, it is aborted as soon as it exists
+                job['abort'] = True
+                return {'job': self.summary(job)}
+            else:
+                raise DaemonError('job "{}" is not running'.format(job['id']))
+        self.settle(job)
+        with self.lock:
+            self.done.notify_all()
+            return {'job': self.summary(job)}
+
+    def cmd_results(self, req):
+        with self.lock:
+            return {'job': self.summary(self.job(req), True)}
+
+    def cmd_wait(self, req):
+        end = None if req.get('timeout') is None else time.monotonic() + req['timeout']
+        with self.lock:
+            job = self.job(req)
+            while job['state'] in self.ACTIVE:
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.done.wait(remaining)
+            return {'job': self.summary(job, True)}
+
+    def cmd_reports(self, req):
+        if self.report_queue is None:
+            return {'pending': 0, 'failed': 0}
+        return {'pending': self.report_queue.outstanding(), 'failed': self.report_queue.count('failed')}
+
+    def cmd_shutdown(self, req):
+        #The server can't be shut down from one of its own requests. Not a daemon thread, so the process
+        #doesn't exit before the report queue, the capture archive and the registry are closed
+        with self.lock:
+            if self.stopper is None:
+                self.stopper = threading.Thread(target=self.stop, name='bench-stop')
+                self.stopper.start()
+        return {}
+
+    def test_stage(self, job):
+        with self.lock:
+            if job['state'] != 'queued':
+                return None
+            #Claimed in the same step, an abort can no longer release the lease of a board about to be tested
+            job['state'] = 'testing'
+        uc = None
+        try:
+            eth_conf = (job['ip'], '255.255.255.0', rffe_test.ip_base+'1', job['mac'])
+            uc = self.test_class(eth_conf, self.port if self.port is not None else self.serial_port, job['operator'], job['boardPN'], job['sn'], job['manufSN'],
+                                 self.mask_path, self.probe_id, self.test_board_sn, self.fail_fast,
+                                 report_queue=self.report_queue, capture_archive=self.capture_archive, eth_test=self.eth_test)
+            with self.lock:
+                self.current = (job, uc)
+                if job.get('abort'):
+                    uc.abort()
+            start = time.monotonic()
+            #The report is left to the record stage, the fixture is free as soon as the deploy firmware is in
+            result = uc.run(report_path=None)
+            job['duration'] = time.monotonic() - start
+        except Exception as e:
+            self.finish(job, 'error', error=str(e), stored=uc.stored if uc is not None else False)
+            return None
+        finally:
+            with self.lock:
+                self.current = None
+        job['stored'] = uc.stored
+        with self.lock:
+            job['state'] = 'recording'
+        return job, uc, result
+
+    def record_stage(self, item):
+        job, uc, result = item
+        try:
+            if self.lot is not None:
+                uc.test_results['lot'] = self.lot
+            eth = uc.test_results.get('ethernet', {})
+            self.registry.add(job['sn'], eth.get('deployIP', uc.test_mask['ethernet']['genericIP']), eth.get('mac', job['mac']), result, job['manufSN'])
+            if self.report_path is not None:
+                uc.report(self.report_path, uc.test_results['boardSN'])
+            if self.lot_report is not None:
+                try:
+                    self.lot_report.add(uc.test_results)
+                except (OSError, KeyError) as e:
+                    print('[WARNING] Could not update the report of lot {}: {}'.format(self.lot, e))
+            self.metrics.add(uc.test_results.get('timing'), result)
+            station_metrics.export([self.metrics], self.metrics_dir)
+        except Exception as e:
+            self.finish(job, 'error', error=str(e), results=uc.test_results)
+            return None
+        self.finish(job, 'aborted' if uc.aborted else 'done', result=bool(result), results=uc.test_results)
+
+    def settle(self, job):
+        #A board that got its SN/MAC in FeRAM keeps them, pass or fail, only an identity that never reached it is given back
+        if job['lease'] is None:
+            return
+        if job['stored']:
+            if not self.allocator.confirm(job['lease']):
+                print('[WARNING] The lease of board {} had expired, its SN/MAC may be handed out again'.format(job['sn']))
+        else:
+            self.allocator.release(job['lease'])
+
+    def finish(self, job, state, **info):
+        if state == 'error':
+            print('[ERROR] Board {} failed to run: {}'.format(job['sn'], info.get('error')))
+        with self.lock:
+            job.update(info)
+            job['state'] = state
+        self.settle(job)
+        with self.lock:
+            self.done.notify_all()
+
+class BenchClient(object):
+    """ client of a BenchDaemon, call() sends one command and returns its answer """
+
+    def __init__(self, socket_path=SOCKET_PATH, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(str(socket_path))
+        except OSError:
+            self.sock.close()
+            raise
+        self.f = self.sock.makefile('rwb')
+
+    def call(self, cmd, **args):
+        args['cmd'] = cmd
+        self.f.write((json.dumps(args)+'\n').encode('utf-8'))
+        self.f.flush()
+        ln = self.f.readline()
+        if not ln:
+            raise DaemonError('the test bench closed the connection')
+        resp = json.loads(ln.decode('utf-8'), object_pairs_hook=OrderedDict)
+        if not resp.get('ok'):
+            raise DaemonError(resp.get('error'))
+        return resp
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+def connect(socket_path=SOCKET_PATH, **daemon_args):
+    """ client of the running test bench, or of a new one started in this process
+
+    Returns (client, daemon), daemon is None when the bench was already running.
+    """
+    try:
+        return BenchClient(socket_path), None
+    except OSError:
+        pass
+    daemon = BenchDaemon(socket_path, **daemon_args).start()
+    return BenchClient(socket_path), daemon
+
+def main():
+    parser = argparse.ArgumentParser(description='RFFEuC test bench daemon')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='Control socket')
+    parser.add_argument('--port', default='/dev/ttyUSB0', help='Serial port of the test board')
+    parser.add_argument('--probe', default=None, help='LPC-Link2 probe ID')
+    parser.add_argument('--test-board-sn', default=None, help='SN of the test board, defaults to the one in the mask')
+    parser.add_argument('--board-pn', default='RFFEuC:1.2', help='Default board part number')
+    parser.add_argument('--mask', default='mask.json', help='Test mask file, or a directory of mask versions selected by board PN')
+    parser.add_argument('--reports', default='./reports/', help='Report output directory')
+    parser.add_argument('--metrics', default='./metrics/', help='Directory of the Prometheus textfile and CSV phase metrics')
+    parser.add_argument('--captures', default='./captures/', help='Serial capture archive directory')
+    parser.add_argument('--fail-fast', action='store_true', help='Stop testing a board on its first fatal failure')
+    parser.add_argument('--queue-depth', type=int, default=2, help='Boards that may wait for each stage of the line')
+    parser.add_argument('--lot', help='Production lot of the boards, its lot report is updated after each board')
+    parser.add_argument('--station', help='Name the SN/MAC/IP leases of this bench are taken under (default: host:port)')
+    parser.add_argument('--eth-ip', help='IP the boards are tested at, defaults to the testIP of the mask')
+    parser.add_argument('--eth-mask', help='Netmask of the test IP, defaults to the testMask of the mask')
+    parser.add_argument('--eth-gateway', help='Gateway of the test IP, defaults to the testGateway of the mask')
+    parser.add_argument('--eth-interface', help='Interface the boards are reached through')
+    parser.add_argument('--eth-source', help='Local address the Ethernet test connects from')
+    args = parser.parse_args()
+
+    daemon = BenchDaemon(args.socket, args.port, args.board_pn, args.mask, args.reports, probe_id=args.probe, test_board_sn=args.test_board_sn,
+                         fail_fast=args.fail_fast, metrics_dir=args.metrics, queue_depth=args.queue_depth, capture_dir=args.captures, lot=args.lot,
+                         station=args.station, eth_test=EthTestConf(args.eth_ip, args.eth_mask, args.eth_gateway, args.eth_interface, args.eth_source)).start()
+    print('Test bench listening on '+args.socket)
+    try:
+        while daemon.stopper is None:
+            time.sleep(0.5)
+        daemon.stopper.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if daemon.stopper is None:
+            daemon.stop()
+
+if __name__ == '__main__':
+    main()
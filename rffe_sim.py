@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+import argparse
+import ipaddress
+import json
+import os
+import random
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tty
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_probe import EthTestConf
+from rffe_uc import RFFEuC_Test
+from serial_archive import CaptureArchive
+from station_metrics import StationMetrics
+
+class SimReset(Exception):
+    pass
+
+class RFFEuC_Sim(object):
+    """ software model of the RFFEuC test firmware
+
+    The firmware UART is exposed as a pseudo-terminal (see port_name) and the
+    TCP server is opened on port at the IP address the board is programmed
+    with, as the firmware does. host is the test address of the simulated
+    station, a loopback alias (127.0.0.0/8 all goes to lo) or an address in a
+    network namespace, so several stations are tested at once. Failures listed in 'failures' are always
+    injected, and each one of them is also injected randomly with probability
+    'fail_rate'. Known failures: led, gpio, power, feram, eth, hang.
+    """
+
+    LED_COUNT = 4
+    GPIO_PAIRS = [('P0_4', 'P0_5'), ('P0_6', 'P0_7'), ('P0_8', 'P0_9'), ('P0_10', 'P0_11'),
+                  ('P1_18', 'P1_19'), ('P1_20', 'P1_21'), ('P1_22', 'P1_23'), ('P1_24', 'P1_25')]
+    FERAM_SIZE = 256
+
+    def __init__(self, host='127.0.0.1', port=6791, latency=0.0, baudrate=115200, failures=(), fail_rate=0.0, accept_timeout=5.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.baudrate = baudrate
+        self.failures = set(failures)
+        self.fail_rate = fail_rate
+        self.accept_timeout = accept_timeout
+        self.rand = random.Random(seed)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.reset_event = threading.Event()
+        self.reset_done = threading.Event()
+        self.stop_event = threading.Event()
+        #Wakes the firmware thread up from select() when the reset line is pulled
+        self.wake_r, self.wake_w = os.pipe()
+        self.rx = b''
+        self.boards = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, name='rffe-sim-'+self.port_name, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.reset_event.set()
+        os.write(self.wake_w, b'\0')
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def reset(self, timeout=1.0):
+        """ pull the reset line, returns once the board dropped what it had received so far
+
+        Like the real reset, what is sent afterwards reaches the restarted
+        firmware, so the start command never races the reset.
+        """
+        self.reset_done.clear()
+        self.reset_event.set()
+        os.write(self.wake_w, b'\0')
+        return self.reset_done.wait(timeout)
+
+    def fails(self, name):
+        return name in self.failures or (self.fail_rate > 0 and self.rand.random() < self.fail_rate)
+
+    def check_reset(self):
+        if self.reset_event.is_set():
+            raise SimReset()
+
+    def send(self, data):
+        self.check_reset()
+        data = data.encode('ascii')
+        os.write(self.master, data)
+        #Pace the output as the real UART would
+        time.sleep(self.latency + len(data) * 10.0 / self.baudrate)
+
+    def recv(self, timeout=0.1):
+        r, _, _ = select.select([self.master, self.wake_r], [], [], timeout)
+        if self.wake_r in r:
+            os.read(self.wake_r, 64)
+        if self.master in r:
+            try:
+                self.rx += os.read(self.master, 4096)
+            except OSError:
+                pass
+
+    def drain(self):
+        #Bytes already in the UART when the reset line was pulled
+        while select.select([self.master], [], [], 0)[0]:
+            try:
+                os.read(self.master, 4096)
+            except OSError:
+                break
+
+    def read_cmd(self):
+        while True:
+            self.check_reset()
+            if self.stop_event.is_set():
+                return None
+            if self.rx:
+                cmd, self.rx = self.rx[:1], self.rx[1:]
+                return cmd
+            self.recv()
+
+    def read_line(self):
+        while True:
+            self.check_reset()
+            nl = self.rx.find(b'\n')
+            if nl > -1:
+                ln, self.rx = self.rx[:nl], self.rx[nl+1:]
+                return ln.decode('ascii', 'replace').strip()
+            self.recv()
+
+    def serve(self):
+        while not self.stop_event.is_set():
+            try:
+                cmd = self.read_cmd()
+                if cmd == b's':
+                    self.test_session()
+                elif cmd == b'r':
+                    self.store_session()
+            except SimReset:
+                pass
+            if self.reset_event.is_set():
+                #Board went through reset, everything sent to the UART before it is lost
+                self.reset_event.clear()
+                self.drain()
+                self.rx = b''
+                self.reset_done.set()
+
+    def ask_eth_config(self):
+        conf = []
+        for prompt in ('Insert MAC:', 'Insert IP:', 'Insert Mask:', 'Insert Gateway:'):
+            self.send(prompt)
+            conf.append(self.read_line())
+            self.send('\r\n')
+        return conf
+
+    def test_session(self):
+        self.boards += 1
+        self.send('RFFEuC Test Firmware (simulated)\r\n')
+        hang = self.fails('hang')
+        for led in range(self.LED_COUNT):
+            value = self.rand.uniform(3.0, 3.2) if self.fails('led') else self.rand.uniform(0.5, 1.5)
+            self.send('[LED] LED {}: {:.3f}\r\n'.format(led, value))
+        if hang:
+            #Board stops answering, only a reset gets it back
+            while True:
+                self.read_cmd()
+        for pin1, pin2 in self.GPIO_PAIRS:
+            self.send('Loopback [{}] <-> [{}]: {}\r\n'.format(pin1, pin2, 'Fail' if self.fails('gpio') else 'Pass'))
+        for rail, nominal in (('3.3', 3.3), ('5.0', 5.0)):
+            value = nominal * (0.8 if self.fails('power') else self.rand.uniform(0.98, 1.02))
+            self.send('Power Supply {}V: {:.3f}\r\n'.format(rail, value))
+        pattern = bytes(self.rand.getrandbits(8) for i in range(self.FERAM_SIZE))
+        for i in range(0, len(pattern), 16):
+            self.send('[RANDOM] '+' '.join('{:02X}'.format(b) for b in pattern[i:i+16])+'\r\n')
+        self.send('[FERAM] {}\r\n'.format('Fail' if self.fails('feram') else 'Pass'))
+
+        mac, ip, mask, gateway = self.ask_eth_config()
+        self.send('Initializing ETH stack\r\n')
+        if self.fails('eth'):
+            self.send('ETH link down!\r\n')
+            self.send('End of tests!\r\n')
+            return
+        msg = self.eth_server(ip)
+        if msg is not None:
+            self.send('Received: "{}"\r\n'.format(msg))
+        self.send('End of tests!\r\n')
+
+    def eth_server(self, ip):
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            try:
+                srv.bind((ip, self.port))
+            except OSError as e:
+                #Another board already holds the address, the station would never reach this one
+                self.send('ETH bind to {} failed: {}\r\n'.format(ip, e))
+                return None
+            srv.listen(1)
+            srv.settimeout(self.accept_timeout)
+            self.send('Listening on port: {}\r\n'.format(self.port))
+            try:
+                conn, _ = srv.accept()
+            except socket.timeout:
+                return None
+            with conn:
+                conn.settimeout(self.accept_timeout)
+                data = b''
+                try:
+                    #Drain the throughput payload sent after the message, until the station closes the connection
+                    while True:
+                        chunk = conn.recv(65536)
+                        if not chunk:
+                            break
+                        data += chunk
+                except socket.timeout:
+                    pass
+            return data.split(b'\0')[0].decode('ascii', 'replace')
+        finally:
+            srv.close()
+
+    def store_session(self):
+        self.send('RFFEuC Test Firmware (simulated)\r\n')
+        self.ask_eth_config()
+        self.send('Ethernet configuration stored in FeRAM\r\n')
+        self.send('End of tests!\r\n')
+
+class SimLPCLink2(object):
+    """ LPCLink2 stand-in, programming takes 'program_time' seconds and always succeeds unless 'fail' is set """
+
+    program_time = 0.0
+    fail = False
+
+    def __init__(self, probe_id=None):
+        self.probe_id = probe_id
+
+    def program(self, fw):
+        time.sleep(self.program_time)
+        return not self.fail
+
+class RFFEuC_SimTest(RFFEuC_Test):
+
+    PROGRAMMER = SimLPCLink2
+
+    def __init__(self, sim, *args, **kwargs):
+        if kwargs.get('eth_test') is None:
+            kwargs['eth_test'] = EthTestConf(sim.host, '255.0.0.0', '127.0.0.1')
+        super(RFFEuC_SimTest, self).__init__(*args, **kwargs)
+        self.sim = sim
+
+    def reset(self, ser):
+        #DTR/RTS are not available on a pseudo-terminal
+        self.sim.reset()
+        time.sleep(self.BOOT_DELAY)
+
+def sim_board(sim, n, mask_path, fail_fast=False, capture_archive=None, interface=None, source=None):
+    #Each simulated station tests its boards at its own address
+    eth_test = EthTestConf(sim.host, '255.0.0.0', '127.0.0.1', interface, source)
+    uc = RFFEuC_SimTest(sim, ('192.168.2.201', '255.255.255.0', '192.168.2.1', format(0x20000000000+n, '012X')),
+                        sim.port_name, 'Simulator', 'RFFEuC:1.2', 'SIM{:05d}'.format(n), 'SIM-{}'.format(n), mask_path, probe_id=sim.port_name, fail_fast=fail_fast,
+                        capture_archive=capture_archive, eth_test=eth_test)
+    start = time.monotonic()
+    result = uc.run(report_path=None)
+    return result, time.monotonic() - start, uc.test_results.get('timing')
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test RFFEuC_Test.run() against simulated boards')
+    parser.add_argument('-n', '--boards', type=int, default=100, help='Number of boards to test')
+    parser.add_argument('-j', '--stations', type=int, default=8, help='Number of simulated stations running concurrently')
+    parser.add_argument('--latency', type=float, default=0.0, help='Extra delay after each firmware line [s]')
+    parser.add_argument('--baudrate', type=int, default=115200, help='Simulated UART baud rate')
+    parser.add_argument('--program-time', type=float, default=0.0, help='Simulated LPC-Link2 programming time [s]')
+    parser.add_argument('--fail', action='append', default=[], help='Failure injected on every board (led, gpio, power, feram, eth, hang)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Probability of injecting each failure on a board')
+    parser.add_argument('--mask', default='mask.json', help='Test mask file, or a directory of mask versions selected by board PN')
+    parser.add_argument('--fail-fast', action='store_true', help='Stop testing a board on its first fatal failure')
+    parser.add_argument('--captures', help='Archive the serial captures of the simulated boards in this directory')
+    parser.add_argument('--interface', help='Bind the Ethernet test sockets to this interface (lo, or a veth in a network namespace)')
+    parser.add_argument('--source', help='Bind the Ethernet test sockets to this source address')
+    parser.add_argument('--base-ip', default='127.0.1.1', help='Test address of the first simulated station, the others count on from it')
+    args = parser.parse_args()
+
+    SimLPCLink2.program_time = args.program_time
+    #Placeholder images, the simulated programmer doesn't look at their content
+    fw_dir = tempfile.mkdtemp(prefix='rffe_sim_fw_')
+    RFFEuC_SimTest.TEST_FW = os.path.join(fw_dir, 'rffe-uc-test-fw.bin')
+    RFFEuC_SimTest.DEPLOY_FW_PATH = fw_dir
+    with open(RFFEuC_SimTest.TEST_FW, 'wb') as fw_f:
+        fw_f.write(os.urandom(64*1024))
+    with open(args.mask) as mask_f:
+        generic_ip = json.loads(mask_f.read())['ethernet']['genericIP']
+    for ip in ('192.168.2.201', generic_ip):
+        os.makedirs(os.path.join(fw_dir, ip), exist_ok=True)
+        with open(os.path.join(fw_dir, ip, 'V2_0_0.bin'), 'wb') as fw_f:
+            fw_f.write(os.urandom(64*1024))
+    #Each station tests its boards at its own address, so all of them can use the firmware port at once
+    base = ipaddress.IPv4Address(args.base_ip)
+    sims = [RFFEuC_Sim(str(base + i), latency=args.latency, baudrate=args.baudrate, failures=args.fail, fail_rate=args.fail_rate, seed=i).start() for i in range(args.stations)]
+    capture_archive = CaptureArchive(args.captures).start() if args.captures else None
+    free = list(sims)
+    lock = threading.Lock()
+
+    def job(n):
+        with lock:
+            sim = free.pop()
+        try:
+            return sim_board(sim, n, args.mask, args.fail_fast, capture_archive, args.interface, args.source)
+        finally:
+            with lock:
+                free.append(sim)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.stations) as pool:
+        results = list(pool.map(job, range(args.boards)))
+    elapsed = time.monotonic() - start
+    if capture_archive is not None:
+        capture_archive.stop()
+    for sim in sims:
+        sim.stop()
+    shutil.rmtree(fw_dir)
+
+    metrics = StationMetrics('sim', window=len(results))
+    for r, d, timing in results:
+        metrics.add(timing, r)
+    durations = sorted(d for r, d, t in results)
+    print('Boards: {} ({} pass)'.format(len(results), sum(1 for r, d, t in results if r)))
+    print('Time per board: min {:.3f}s median {:.3f}s max {:.3f}s'.format(durations[0], durations[len(durations)//2], durations[-1]))
+    print('Throughput: {:.1f} boards/h'.format(3600.0 * len(results) / elapsed))
+    print('{:>12} {:>8} {:>8} {:>8}'.format('phase', 'p50 [s]', 'p95 [s]', 'max [s]'))
+    for phase, s in metrics.summary().items():
+        print('{:>12} {:8.3f} {:8.3f} {:8.3f}'.format(phase, s['p50'], s['p95'], s['max']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+import argparse
+import ipaddress
+import json
+import multiprocessing
+import os
+import queue
+import time
+from collections import OrderedDict
+
+import masks
+import rffe_test
+import station_metrics
+from allocator import IdentityAllocator
+from eth_probe import EthTestConf
+from programmer import firmware_cache
+from report_queue import ReportQueue
+from serial_archive import CaptureArchive
+from rffe_uc import RFFEuC_Test
+
+class Station(object):
+
+    def __init__(self, name, serial_port, probe_id=None, test_board_sn=None, eth_test=None):
+        self.name = str(name)
+        self.serial_port = serial_port
+        self.probe_id = probe_id
+        self.test_board_sn = test_board_sn
+        self.eth_test = eth_test if eth_test is not None else EthTestConf()
+
+    @classmethod
+    def from_dict(cls, conf):
+        return cls(conf['name'], conf['serialPort'], conf.get('probeID'), conf.get('testBoardSN'), EthTestConf.from_dict(conf.get('ethTest', {})))
+
+def load_stations(path):
+    with open(path) as stations_f:
+        conf = json.loads(stations_f.read())
+    stations = [Station.from_dict(s) for s in conf['stations']]
+    names = [s.name for s in stations]
+    if len(set(names)) != len(names):
+        raise ValueError('Duplicated station names in '+path)
+    return stations
+
+def station_test_addresses(stations, eth):
+    """ {station name: EthTestConf}, with the settings of the mask's 'ethernet' section where the station has none
+
+    The boards of each station are tested at their own IP, so the Ethernet
+    tests of all stations run at once. Stations without an "ip" in their
+    "ethTest" entry get the next free addresses from the mask's testIP on.
+    Two stations may only share an address when both are bound to different
+    interfaces.
+    """
+    taken = set(s.eth_test.ip for s in stations if s.eth_test.ip)
+    pool = ipaddress.IPv4Address(eth['testIP'])
+    res = OrderedDict()
+    for s in stations:
+        ip = s.eth_test.ip
+        if not ip:
+            while str(pool) in taken:
+                pool += 1
+            ip = str(pool)
+            taken.add(ip)
+        conf = s.eth_test.merged(ip, eth['testMask'], eth['testGateway'])
+        for name, other in res.items():
+            if other.ip == conf.ip and (None in (other.interface, conf.interface) or other.interface == conf.interface):
+                raise ValueError('Stations {} and {} would both test their boards at {}'.format(name, s.name, conf.ip))
+        res[s.name] = conf
+    return res
+
+def station_worker(station, jobs, results, operator, board_pn, mask_path, report_path, fail_fast=False, capture_dir='./captures/', eth_test=None):
+    #Each station runs in its own process, so a blocking serial read or a slow
+    #LPC-Link2 programming pass only holds up the fixture it belongs to
+    try:
+        firmware_cache.preload([RFFEuC_Test.TEST_FW])
+    except OSError as e:
+        print('[{}] [WARNING] Could not preload the test firmware: {}'.format(station.name, e))
+    report_queue = ReportQueue(os.path.join(report_path, 'queue'), workers=1).start()
+    #Stations share the archive, each batch is written under a lock of its index
+    capture_archive = CaptureArchive(capture_dir).start()
+    while True:
+        job = jobs.get()
+        if job is None:
+            if not report_queue.wait():
+                print('[{}] [WARNING] {} reports left in the queue, run report_queue.py to render them'.format(station.name, report_queue.outstanding()))
+            report_queue.stop()
+            capture_archive.stop()
+            break
+        start = time.monotonic()
+        try:
+            uc = RFFEuC_Test(job['ethConf'], station.serial_port, operator, board_pn, job['sn'], job['manufSN'], mask_path, station.probe_id, station.test_board_sn, fail_fast,
+                             report_queue=report_queue, capture_archive=capture_archive, eth_test=eth_test)
+        except Exception as e:
+            #The runner still waits for this board and holds its lease
+            print('[{}] [ERROR] Could not set up the test: {}'.format(station.name, e))
+            results.put({'station': station.name,
+                         'lease': job['lease'],
+                         'sn': job['sn'],
+                         'manufSN': job['manufSN'],
+                         'ip': job['ethConf'][0],
+                         'mac': job['ethConf'][3],
+                         'result': False,
+                         'stored': False,
+                         'timing': None,
+                         'duration': time.monotonic() - start})
+            continue
+        try:
+            result = uc.run(report_path)
+        except Exception as e:
+            print('[{}] [ERROR] Test aborted: {}'.format(station.name, e))
+            result = False
+        eth = uc.test_results.get('ethernet', {})
+        results.put({'station': station.name,
+                     'lease': job['lease'],
+                     'sn': job['sn'],
+                     'manufSN': job['manufSN'],
+                     'ip': eth.get('deployIP', uc.test_mask['ethernet']['genericIP']),
+                     'mac': eth.get('mac', ':'.join([uc.eth_mac[i:i+2] for i in range(0, len(uc.eth_mac), 2)])),
+                     'result': bool(result),
+                     'stored': uc.stored,
+                     'timing': uc.test_results.get('timing'),
+                     'duration': time.monotonic() - start})
+
+class StationStats(object):
+
+    def __init__(self):
+        self.boards = 0
+        self.passed = 0
+        self.busy_time = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def add(self, start, end, result):
+        if self.first_start is None:
+            self.first_start = start
+        self.last_end = end
+        self.busy_time += end - start
+        self.boards += 1
+        self.passed += 1 if result else 0
+
+    def boards_per_hour(self, now=None):
+        if self.first_start is None:
+            return 0.0
+        elapsed = (now if now is not None else self.last_end) - self.first_start
+        return (3600.0 * self.boards / elapsed) if elapsed > 0 else 0.0
+
+class StationRunner(object):
+
+    def __init__(self, stations, operator, board_pn='RFFEuC:1.2', mask_path='mask.json', report_path='./reports/', registry_path=rffe_test.registry_path, fail_fast=False, metrics_dir='./metrics/', capture_dir='./captures/'):
+        self.stations = OrderedDict((s.name, s) for s in stations)
+        self.operator = operator
+        self.board_pn = board_pn
+        self.mask_path = mask_path
+        self.report_path = report_path
+        self.fail_fast = fail_fast
+        self.registry = rffe_test.open_registry(registry_path)
+        self.eth_tests = station_test_addresses(stations, masks.select(mask_path, board_pn).data['ethernet'])
+        self.stats = OrderedDict((name, StationStats()) for name in self.stations)
+        self.metrics = OrderedDict((name, station_metrics.StationMetrics(name)) for name in self.stations)
+        self.metrics_dir = metrics_dir
+        self.capture_dir = capture_dir
+        self.start_time = None
+        #Each station leases its identities, runners on other hosts may share the registry
+        self.allocator = IdentityAllocator(self.registry, rffe_test.ip_pool)
+        self.results = multiprocessing.Queue()
+        self.jobs = OrderedDict()
+        self.procs = OrderedDict()
+        self.running = OrderedDict()
+
+    def start(self):
+        self.start_time = time.monotonic()
+        for name, station in self.stations.items():
+            self.jobs[name] = multiprocessing.Queue()
+            self.procs[name] = multiprocessing.Process(target=station_worker, name='station-'+name,
+                                                       args=(station, self.jobs[name], self.results, self.operator, self.board_pn, self.mask_path, self.report_path, self.fail_fast, self.capture_dir,
+                                                             self.eth_tests[name]))
+            self.procs[name].start()
+
+    def idle_stations(self):
+        return [name for name in self.stations if name not in self.running]
+
+    def submit(self, station_name, manuf_sn):
+        if station_name in self.running:
+            raise RuntimeError('Station {} is busy'.format(station_name))
+        lease = self.allocator.lease(station_name)
+        job = {'sn': lease['sn'],
+               'manufSN': manuf_sn,
+               'lease': lease['id'],
+               'ethConf': (lease['ip'], '255.255.255.0', rffe_test.ip_base+'1', lease['mac'])}
+        print('[{}] Testing -> Ip: {} MAC: {} SN: {}'.format(station_name, lease['ip'], lease['mac'], lease['sn']))
+        self.running[station_name] = time.monotonic()
+        self.jobs[station_name].put(job)
+        return job
+
+    def collect(self, timeout=None):
+        try:
+            res = self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        start = self.running.pop(res['station'])
+        self.stats[res['station']].add(start, time.monotonic(), res['result'])
+        self.registry.add(res['sn'], res['ip'], res['mac'], res['result'], res['manufSN'], res['station'])
+        #A board that got its SN/MAC in FeRAM keeps them, pass or fail, so they are never handed out twice
+        if not res['stored']:
+            self.allocator.release(res['lease'])
+        elif not self.allocator.confirm(res['lease']):
+            print('[{}] [WARNING] The lease of board {} had expired, its SN/MAC may be handed out again'.format(res['station'], res['sn']))
+        self.metrics[res['station']].add(res['timing'], res['result'])
+        station_metrics.export(self.metrics.values(), self.metrics_dir)
+        print('\n[{}] SN: {} Result: {} ({:.1f}s)\n'.format(res['station'], res['sn'], 'PASS!' if res['result'] else 'FAIL!', res['duration']))
+        return res
+
+    def stop(self):
+        while self.running:
+            self.collect()
+        for name in self.stations:
+            self.jobs[name].put(None)
+        for proc in self.procs.values():
+            proc.join()
+
+    def throughput(self):
+        now = time.monotonic()
+        per_station = OrderedDict((name, st.boards_per_hour(now)) for name, st in self.stats.items())
+        boards = sum(st.boards for st in self.stats.values())
+        elapsed = now - self.start_time if self.start_time is not None else 0
+        total = (3600.0 * boards / elapsed) if elapsed > 0 else 0.0
+        return per_station, total
+
+    def print_throughput(self):
+        per_station, total = self.throughput()
+        for name, bph in per_station.items():
+            st = self.stats[name]
+            print('{:>12}: {:4d} boards ({:4d} pass) {:7.1f} boards/h'.format(name, st.boards, st.passed, bph))
+        print('{:>12}: {:4d} boards {:16.1f} boards/h'.format('Total', sum(st.boards for st in self.stats.values()), total))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several RFFEuC test fixtures in parallel from one host')
+    parser.add_argument('stations', help='JSON file describing the test stations')
+    parser.add_argument('--mask', default='mask.json', help='Test mask file, or a directory of mask versions selected by board PN')
+    parser.add_argument('--board-pn', default='RFFEuC:1.2', help='Board part number')
+    parser.add_argument('--reports', default='./reports/', help='Report output directory')
+    parser.add_argument('--fail-fast', action='store_true', help='Stop testing a board on its first fatal failure')
+    parser.add_argument('--metrics', default='./metrics/', help='Directory of the Prometheus textfile and CSV phase metrics')
+    parser.add_argument('--captures', default='./captures/', help='Serial capture archive directory')
+    args = parser.parse_args()
+
+    runner = StationRunner(load_stations(args.stations), input('Operator name: '), args.board_pn, args.mask, args.reports, fail_fast=args.fail_fast, metrics_dir=args.metrics, capture_dir=args.captures)
+    runner.start()
+    try:
+        while True:
+            idle = runner.idle_stations()
+            if not idle:
+                runner.collect()
+                continue
+            name = idle[0]
+            manuf_sn = input('[{}] QRCode Scan (empty to finish): '.format(name))
+            if not manuf_sn:
+                break
+            runner.submit(name, manuf_sn)
+            #Pick up any board that finished while the operator was scanning
+            while runner.collect(timeout=0) is not None:
+                pass
+    finally:
+        runner.stop()
+        runner.print_throughput()
+
+if __name__ == '__main__':
+    main()
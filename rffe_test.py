@@ -1,101 +1,129 @@
 #!/usr/bin/python3
-import json
+import argparse
 import pathlib
-import re
-from collections import OrderedDict
-from rffe_uc import RFFEuC_Test
+import queue
+import threading
+from registry import BoardRegistry
+import rffe_daemon
 
 ip_ends = [i for i in range(201,214)]
 ip_base = '192.168.2.'
 #ip_base = '10.0.18.'
-
-#Code from Chris Olds @ http://code.activestate.com/recipes/442460/
-def increment(s):
-    """ look for the last sequence of number(s) in a string and increment """
-    lastNum = re.compile(r'(?:[^\d]*(\d+)[^\d]*)+')
-    m = lastNum.search(s)
-    if m:
-        next = str(int(m.group(1))+1)
-        start, end = m.span(1)
-        s = s[:max(end-len(next), start)] + next + s[end:]
-    return s
-
-def increment_ip(s):
-    if (int(s.split('.')[-1]) +1) in ip_ends:
-        return increment(s)
-    else:
-        return ip_base+'201'
-
-def increment_mac(m):
-    return format((int(m,16)+1), '012X')
+#Deploy IPs of the rack slots, leased to the boards by allocator.IdentityAllocator
+ip_pool = [ip_base+str(i) for i in ip_ends]
 
 ip_sn_table_path = pathlib.Path('ip_sn_table.json')
-try:
-    ip_sn_table_path.resolve()
-    with ip_sn_table_path.open('r') as json_f:
-        ip_sn_table = json.loads(json_f.read(), object_pairs_hook=OrderedDict)
-        last_sn = list(ip_sn_table.keys())[-1]
-        next_sn = increment(last_sn)
-        last_ip = ip_sn_table[last_sn]['ip']
-        next_ip = increment_ip(last_ip)
-        last_mac = ip_sn_table[last_sn]['mac'].replace(':','')
-        next_mac = increment_mac(last_mac)
-
-except FileNotFoundError:
-    print('"ip_sn_table.json file not found! A new one will be created')
-    next_sn = 'CN00001'
-    next_ip = ip_base+'201'
-    next_mac = '20000000001'
-
-op_name = input('Operator name: ')
-
-seq = input('Should the test run [c]ontinuously or just [o]ne time? (default: "c"): ')
-if seq == '':
-    #Default to continuous
-    seq = 'c'
-
-manuf_sn = ''
-while True:
-    while not manuf_sn:
-        manuf_sn = input('QRCode Scan: ')
-    override = input('Override initial board informations? (default: SN:"'+next_sn+'" IP:"'+next_ip+'" MAC"'+next_mac+'"): [y/N] ')
-    if override.lower() == 'y':
-        override_sn = input('SN: ')
-        if override_sn != '':
-            next_sn = override_sn
-
-        override_ip = input('IP: ')
-        if override_ip != '':
-            next_ip = override_ip
-
-        override_mac = input('MAC: ')
-        if override_mac != '':
-            next_mac = override_mac
-
-    print('Testing -> Ip: {} MAC: {} SN: {}'.format(next_ip, next_mac, next_sn))
-    uc = RFFEuC_Test((next_ip, '255.255.255.0', ip_base+'1', next_mac), '/dev/ttyUSB0', op_name, 'RFFEuC:1.2', next_sn, manuf_sn)
-    result = uc.run()
-    print('\nResult: '+('PASS!' if result else 'FAIL!')+'\n')
-
-    open_mode = 'r+' if ip_sn_table_path.is_file() else 'w+'
-    with ip_sn_table_path.open(open_mode) as ip_sn_table_f:
-        ip_sn_table_str = ip_sn_table_f.read()
-        if (ip_sn_table_str):
-            ip_sn_table = json.loads(ip_sn_table_str, object_pairs_hook=OrderedDict)
+registry_path = pathlib.Path('boards.db')
+
+def open_registry(registry_path=registry_path, table_path=ip_sn_table_path):
+    registry = BoardRegistry(registry_path)
+    if len(registry) == 0 and table_path.is_file():
+        print('Importing "'+str(table_path)+'" into "'+str(registry_path)+'"')
+        registry.import_json(table_path)
+    return registry
+
+def read_manifest(path):
+    """ manufacturer SNs of a batch, one per line, blank lines and # comments are skipped """
+    with open(path) as manifest_f:
+        return [ln.strip() for ln in manifest_f if ln.strip() and not ln.strip().startswith('#')]
+
+def print_results(jobs):
+    client = rffe_daemon.BenchClient(rffe_daemon.SOCKET_PATH)
+    for job in iter(jobs.get, None):
+        done = client.call('wait', id=job['id'])['job']
+        print('\n[{}] {}: {}'.format(done['sn'], done['manufSN'], ('PASS!' if done['result'] else 'FAIL!') if done['state'] == 'done' else done['state'].upper()))
+    client.close()
+
+def print_stages(status):
+    print('{:>8} {:>6} {:>9} {:>9} {:>9} {:>6} {:>6} {:>6}'.format('stage', 'boards', 'busy [s]', 'idle [s]', 'block [s]', 'depth', 'max', 'errors'))
+    for name, st in status['stages'].items():
+        print('{:>8} {:6d} {:9.1f} {:9.1f} {:9.1f} {:6.2f} {:6d} {:6d}'.format(name, st['items'], st['busy'], st['idle'], st['blocked'], st['meanDepth'], st['maxDepth'], st.get('errors', 0)))
+    print('Line limited by: '+status['bottleneck'])
+
+def pipelined(client, op_name, manifest=None):
+    #The next board is scanned while the previous ones are still being tested and recorded, results are printed as they come
+    jobs = queue.Queue()
+    printer = threading.Thread(target=print_results, args=(jobs,), daemon=True)
+    printer.start()
+    scans = iter(read_manifest(manifest)) if manifest else iter(lambda: input('QRCode Scan (empty to finish): '), '')
+    for manuf_sn in scans:
+        job = client.call('start', manufSN=manuf_sn, operator=op_name)['job']
+        print('Queued {} -> Ip: {} MAC: {} SN: {}'.format(manuf_sn, job['ip'], job['mac'], job['sn']))
+        jobs.put(job)
+    jobs.put(None)
+    printer.join()
+    print_stages(client.call('status'))
+
+def main():
+    parser = argparse.ArgumentParser(description='RFFEuC test bench operator console')
+    parser.add_argument('--pipeline', action='store_true', help='Scan the next board while the previous one is still being tested')
+    parser.add_argument('--manifest', help='File with the manufacturer SNs of a batch, one per line (implies --pipeline)')
+    args = parser.parse_args()
+
+    #The bench keeps its ports, firmware and masks loaded, it's started here unless rffe_daemon.py is already running
+    client, daemon = rffe_daemon.connect(rffe_daemon.SOCKET_PATH)
+    next_info = client.call('next')['next']
+    next_sn, next_ip, next_mac = next_info['sn'], next_info['ip'], next_info['mac']
+
+    op_name = input('Operator name: ')
+
+    if args.pipeline or args.manifest:
+        pipelined(client, op_name, args.manifest)
+        client.close()
+        if daemon is not None:
+            daemon.drain()
+            daemon.stop()
+        return
+
+    seq = input('Should the test run [c]ontinuously or just [o]ne time? (default: "c"): ')
+    if seq == '':
+        #Default to continuous
+        seq = 'c'
+
+    manuf_sn = ''
+    repeat = None
+    while True:
+        while not manuf_sn:
+            manuf_sn = input('QRCode Scan: ')
+        overrides = {}
+        override = input('Override initial board informations? (default: SN:"'+next_sn+'" IP:"'+next_ip+'" MAC"'+next_mac+'"): [y/N] ')
+        if override.lower() == 'y':
+            override_sn = input('SN: ')
+            if override_sn != '':
+                overrides['sn'] = override_sn
+
+            override_ip = input('IP: ')
+            if override_ip != '':
+                overrides['ip'] = override_ip
+
+            override_mac = input('MAC: ')
+            if override_mac != '':
+                overrides['mac'] = override_mac
+
+        #The daemon leases the identity, a repeated board gets its previous one back
+        job = client.call('start', manufSN=manuf_sn, operator=op_name, repeat=repeat, **overrides)['job']
+        print('Testing -> Ip: {} MAC: {} SN: {}'.format(job['ip'], job['mac'], job['sn']))
+        result = client.call('wait', id=job['id'])['job']['result']
+        print('\nResult: '+('PASS!' if result else 'FAIL!')+'\n')
+
+        if seq == 'o':
+            break
+        next_info = client.call('next')['next']
+        next_sn, next_ip, next_mac = next_info['sn'], next_info['ip'], next_info['mac']
+        i = input('Start next test? (IP:{} MAC:{} SN:{}) [Y/n][r]epeat: '.format(next_ip, next_mac, next_sn))
+        if i.lower() == 'n':
+            break
+
+        if i.lower() == 'r':
+            repeat = job['id']
+            next_sn, next_ip, next_mac = job['sn'], job['ip'], job['mac']
         else:
-            ip_sn_table = OrderedDict()
-        ip_sn_table[next_sn] = OrderedDict([('ip',uc.test_results['ethernet']['deployIP']),('mac',uc.test_results['ethernet']['mac']),('result','pass' if result else 'fail'),('manufSN', manuf_sn)])
-        ip_sn_table_f.seek(0)
-        json.dump(ip_sn_table, ip_sn_table_f, indent=4, ensure_ascii=True)
-        ip_sn_table_f.truncate()
-
-    if seq == 'o':
-        break
-    i = input('Start next test? (IP:{} MAC:{} SN:{}) [Y/n][r]epeat: '.format(increment_ip(next_ip),increment_mac(next_mac),increment(next_sn)))
-    if i.lower() == 'n':
-        break
-
-    if i.lower() != 'r':
-        next_ip = increment_ip(next_ip)
-        next_mac = increment_mac(next_mac)
-        next_sn = increment(next_sn)
+            repeat = None
+
+    client.close()
+    if daemon is not None:
+        daemon.drain()
+        daemon.stop()
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 #!/usr/bin/python3
-import socket
 import time
 import serial
-import re
+import copy
+import functools
 import json
 import datetime
 import subprocess
@@ -11,261 +11,325 @@ import pathlib
 from collections import OrderedDict
 from lpclink2_py.lpclink import LPCLink2
 
-from report import RFFEuC_Report
+import masks
+from expect import Expect, Phase, ExpectTimeout
+from eth_probe import EthProbe, EthTestConf
+from serial_archive import SerialCapture
+from transport import LineTransport
+from log_parser import RFFEuC_LogParser
+from deploy_image import deploy_image_builder
+from programmer import FirmwareImage, firmware_cache, programmer_session
+
+@functools.lru_cache(maxsize=None)
+def sw_commit():
+    #Resolved once per process, a running station doesn't change its own code
+    return subprocess.check_output(['git', 'describe', '--always']).strip().decode('ascii').upper()
 
 class RFFEuC_Test(object):
 
     TEST_FW = '../rffe-uc-test-fw/rffe-uc-test-fw.bin'
+    PROGRAMMER = LPCLink2
+    #Report renderer used when no report queue is given, see report.report_backends
+    REPORT_BACKEND = 'fast'
     DEPLOY_FW_PATH = '../rffe-uc-deploy-fw/'
 
-    def __init__(self, eth_conf, serial_port, operator, board_pn, board_sn, manuf_sn, test_mask_path='mask.json'):
+    #Serial read timeout, only bounds how often the phase deadlines are checked
+    SERIAL_POLL = 0.05
+    #RTS low time to reset the LPC and time given to the firmware to set up its UART
+    RESET_PULSE = 0.1
+    BOOT_DELAY = 0.1
+    #Maximum duration of each phase of the serial dialogue [s], may be overridden by the "deadlines" entry in the mask
+    PHASE_DEADLINES = {'boot': 3.0, 'test': 30.0, 'eth_init': 10.0, 'eth_test': 10.0, 'feram': 10.0}
+    #Subtests that end the session right away in fail-fast mode, may be overridden by the "fatal" entry in the mask
+    FATAL_TESTS = ('led', 'gpio', 'powerSupply', 'feram')
+    #TCP port of the test firmware server
+    ETH_PORT = 6791
+    #Timing entry each dialogue phase is accounted to
+    PHASE_TIMERS = {'boot': 'selfTest', 'test': 'selfTest', 'eth_init': 'ethTest', 'eth_test': 'ethTest', 'feram': 'feramStore'}
+
+    def __init__(self, eth_conf, serial_port, operator, board_pn, board_sn, manuf_sn, test_mask_path='mask.json', probe_id=None, test_board_sn=None, fail_fast=False, fatal_tests=None, report_queue=None, capture_archive=None, eth_test=None):
         self.log = []
+        self.parser = None
+        self.session = None
+        self.aborted = False
+        self.eth_probe = None
+        self.eth_link = None
+        #Set once the SN/MAC may have been written to FeRAM, the identity is then taken for good
+        self.stored = False
+        #A port name, or an already open serial.Serial which is then left open after the test
         self.serial_port = serial_port
+        self.probe_id = probe_id
+        self.fail_fast = fail_fast
+        self.report_queue = report_queue
+        self.capture_archive = capture_archive
+        self.capture = None
         self.eth_ip = eth_conf[0]
         self.eth_mask = eth_conf[1]
         self.eth_gateway = eth_conf[2]
         self.eth_mac = str(eth_conf[3]).replace(':','')
 
-        with open(test_mask_path) as mask_f:
-            self.test_mask = json.loads(mask_f.read())
+        #Masks are loaded and compiled once per process, each test gets its own copy of the settings
+        self.mask = masks.select(test_mask_path, board_pn, test_board_sn)
+        self.test_mask = copy.deepcopy(self.mask.data)
+
+        if fatal_tests is None:
+            fatal_tests = self.test_mask.get('fatal', self.FATAL_TESTS)
+        self.fatal_tests = set(fatal_tests)
+        #Address the board is tested at and the station interface it is reached through, the mask's testIP is the default
+        eth = self.test_mask['ethernet']
+        self.eth_test = (eth_test if eth_test is not None else EthTestConf()).merged(eth['testIP'], eth['testMask'], eth['testGateway'])
 
         self.test_results = OrderedDict()
         self.test_results['operator'] = operator
         self.test_results['date'] = str(datetime.datetime.today())
-        self.test_results['testBoardSN'] = self.test_mask['testBoardSN']
+        self.test_results['testBoardSN'] = self.test_mask['testBoardSN'] if test_board_sn is None else str(test_board_sn)
         self.test_results['testBoardPN'] = self.test_mask['testBoardPN']
-        self.test_results['testSWCommit'] = subprocess.check_output(['git', 'describe', '--always']).strip().decode('ascii').upper()
+        self.test_results['testSWCommit'] = sw_commit()
+        self.test_results['testMaskVersion'] = self.mask.version
         self.test_results['boardSN'] = str(board_sn)
         self.test_results['boardPN'] = str(board_pn)
         self.test_results['manufSN'] = str(manuf_sn)
 
-    def eth_connect(self):
-        self.eth_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #3sec timeout
-        self.eth_sock.settimeout(3.0)
+    def open_serial(self):
+        if isinstance(self.serial_port, str):
+            ser = serial.Serial(self.serial_port, 115200, timeout=self.SERIAL_POLL)
+            ser.flush()
+            return ser, True
+        self.serial_port.timeout = self.SERIAL_POLL
+        self.serial_port.reset_input_buffer()
+        return self.serial_port, False
+
+    def abort(self):
+        """ stop the self tests of a running board from another thread, the board is then graded as failed """
+        self.aborted = True
+        self.test_results['aborted'] = True
+        if self.session is not None:
+            self.session.stop()
+
+    def program_fw(self, fw):
+        #The probe session is kept open for the whole station and images are read from disk only once
+        session = programmer_session(self.PROGRAMMER, self.probe_id)
         try:
-            print('Connecting to {}'.format(self.test_mask['ethernet']['testIP']))
-            self.eth_sock.connect((self.test_mask['ethernet']['testIP'], 6791))
-            return True
-        except:
-            print ('Fail to connect!')
+            image = fw if isinstance(fw, FirmwareImage) else firmware_cache.get(fw)
+        except OSError as e:
+            print('[ERROR] Could not read firmware '+str(fw)+': '+str(e))
             return False
+        return session.program(image, target=self.test_results['manufSN'])
+
+    def reset(self, ser):
+        #Reset RFFEuC
+        ser.setDTR(True)
+        ser.setRTS(False)
+        time.sleep(self.RESET_PULSE)
+        ser.setRTS(True)
+        time.sleep(self.BOOT_DELAY)
 
-    def eth_test(self):
-        if self.eth_connect():
-            self.eth_sock.send(b'Test msg!\0')
-            self.eth_sock.shutdown(socket.SHUT_RDWR)
-            self.eth_sock.close()
-            return True
+    def deadline(self, phase):
+        return self.test_mask.get('deadlines', {}).get(phase, self.PHASE_DEADLINES[phase])
+
+    def eth_respond(self, ln):
+        #Connect in the background so the serial log is still read, the session is stopped if the board can't be reached
+        eth = self.test_mask['ethernet']
+        print('Connecting to {}'.format(self.eth_test.ip))
+        self.eth_probe = EthProbe(self.eth_test.ip, self.ETH_PORT, eth['message'].encode('ascii')+b'\0', self.deadline('eth_test'),
+                                  eth.get('link', {}).get('payload', 0), on_fail=self.session.stop, interface=self.eth_test.interface,
+                                  source=self.eth_test.source, mac=':'.join([self.eth_mac[i:i+2] for i in range(0, len(self.eth_mac), 2)]).lower()).start()
+
+    def deploy_info(self, result):
+        if result:
+            self.test_results['ethernet']['deployIP'] = self.eth_ip
+            self.test_results['ethernet']['deployMask'] = self.eth_mask
+            self.test_results['ethernet']['deployGateway'] = self.eth_gateway
         else:
-            return False
+            self.test_results['ethernet']['deployIP'] = self.test_mask['ethernet']['genericIP']
+            self.test_results['ethernet']['deployMask'] = self.test_mask['ethernet']['genericMask']
+            self.test_results['ethernet']['deployGateway'] = self.test_mask['ethernet']['genericGateway']
 
-    def program_fw(self, fw):
-        programmer = LPCLink2()
-        print('Programming firmware '+fw+' to LPC...')
-        return programmer.program(fw)
+    def line_received(self, ln):
+        self.parser.feed(ln)
+        if self.fail_fast:
+            fatal = [t for t in self.parser.failed if t in self.fatal_tests]
+            if fatal:
+                #No need to wait for the remaining tests, the board will be deployed as a spare part
+                print('[FAIL-FAST] {} failed, stopping the tests'.format(fatal[0]))
+                self.test_results['failFast'] = fatal[0]
+                return False
+
+    def deploy_image(self):
+        eth = self.test_results['ethernet']
+        conf = self.test_mask.get('deploy')
+        if conf is not None:
+            #Patch the network configuration into the template image, in memory
+            try:
+                return deploy_image_builder(conf).build(eth['deployIP'], eth['deployMask'], eth['deployGateway'])
+            except (OSError, ValueError) as e:
+                print('[WARNING] Could not build the deploy image from the template: '+str(e))
+        return self.DEPLOY_FW_PATH+'/'+eth['deployIP']+'/V2_0_0.bin'
+
+    def mark(self, phase):
+        #Time since the previous mark is added to the phase, so split phases accumulate
+        now = time.monotonic()
+        timing = self.test_results['timing']
+        timing[phase] = timing.get(phase, 0.0) + (now - self.last_mark)
+        self.last_mark = now
+
+    def session_phase(self, name):
+        self.mark(self.PHASE_TIMERS[name])
 
     def run(self, report_path='./reports/'):
-        if not self.program_fw(self.TEST_FW):
+        self.test_results['timing'] = OrderedDict()
+        self.run_start = self.last_mark = time.monotonic()
+
+        flashed = self.program_fw(self.TEST_FW)
+        self.mark('testFlash')
+        if not flashed:
             print('[ERROR] Could not program the test firmware!')
             return False
 
         print('Starting tests...')
         self.log = []
-        ser = serial.Serial(self.serial_port, 115200, timeout=3)
-        ser.flush()
-
-        #Reset RFFEuC
-        ser.setDTR(True)
-        ser.setRTS(False)
-        time.sleep(0.1)
-        ser.setRTS(True)
-        time.sleep(0.1)
+        self.eth_probe = None
+        self.eth_link = None
+        self.parser = self.log_parser()
+        self.parser.begin()
+        ser, own_port = self.open_serial()
+        if self.capture_archive is not None:
+            #Both directions of the whole dialogue are kept for the capture archive
+            ser = self.capture = SerialCapture(ser)
+        #One receive buffer for both sessions of the board
+        transport = LineTransport(ser)
+
+        self.reset(ser)
+        self.mark('reset')
 
         #Start tests
+        listening = 'Listening on port: {}'.format(self.ETH_PORT)
         ser.write(b's')
-        ln = ser.read(50)
-
-        while True:
-            ln = ser.readline().decode('ascii')
-            if not ln:
-                continue
-            self.log.append(ln)
-            if (ln.find('Insert MAC:') > -1):
-                ser.write(bytes(self.eth_mac+'\r\n','ascii'))
-            elif (ln.find('Insert IP:') > -1):
-                ser.write(bytes(self.test_mask['ethernet']['testIP']+'\n','ascii'))
-            elif (ln.find('Insert Mask:') > -1):
-                ser.write(bytes(self.test_mask['ethernet']['testMask']+'\n','ascii'))
-            elif (ln.find('Insert Gateway:') > -1):
-                ser.write(bytes(self.test_mask['ethernet']['testGateway']+'\n','ascii'))
-            elif (ln.find('Initializing ETH stack') > -1):
-                ln = ser.read(150).decode('ascii')
-                self.log.append(ln)
-                if (ln.find('Listening on port: 6791') > -1):
-                    if not self.eth_test():
-                        break
-                else:
-                    break
-            elif (ln.find('End of tests!') > -1):
-                break
+        self.session = Expect(ser, [
+                ('Insert MAC:', self.eth_mac+'\r\n'),
+                ('Insert IP:', self.eth_test.ip+'\n'),
+                ('Insert Mask:', self.eth_test.mask+'\n'),
+                ('Insert Gateway:', self.eth_test.gateway+'\n'),
+                (listening, self.eth_respond),
+            ], [
+                Phase('boot', r'\S', self.deadline('boot')),
+                Phase('test', 'Initializing ETH stack', self.deadline('test')),
+                Phase('eth_init', listening, self.deadline('eth_init')),
+                Phase('eth_test', 'End of tests!', self.deadline('eth_test')),
+            ], end='End of tests!', log=self.log, on_line=self.line_received, on_phase=self.session_phase, transport=transport)
+        if self.aborted:
+            #Aborted while flashing, the board is still reset and deployed as a spare part
+            self.session.stop()
+        try:
+            self.session.run()
+        except ExpectTimeout as e:
+            print('[ERROR] '+str(e))
+            self.test_results['timeout'] = e.phase
+        if self.eth_probe is not None:
+            self.eth_link = self.eth_probe.join()
+            self.parser.set_link(self.eth_link)
 
         result = self.parse_results()
+        self.mark('parse')
 
-        #Reset RFFEuC
-        ser.setDTR(True)
-        ser.setRTS(False)
-        time.sleep(0.1)
-        ser.setRTS(True)
-        time.sleep(0.1)
+        self.reset(ser)
+        #Drop whatever is left from an interrupted test session
+        ser.reset_input_buffer()
+        transport.clear()
+        self.mark('reset')
 
         #Store ETH information on FERAM
+        self.stored = True
         ser.write(b'r')
-        ln = ser.read(50)
 
-        if result:
-            self.test_results['ethernet']['deployIP'] = self.eth_ip
-            self.test_results['ethernet']['deployMask'] = self.eth_mask
-            self.test_results['ethernet']['deployGateway'] = self.eth_gateway
-        else:
-            self.test_results['ethernet']['deployIP'] = self.test_mask['ethernet']['genericIP']
-            self.test_results['ethernet']['deployMask'] = self.test_mask['ethernet']['genericMask']
-            self.test_results['ethernet']['deployGateway'] = self.test_mask['ethernet']['genericGateway']
-
-        while True:
-            ln = ser.readline().decode('ascii')
-            self.log.append(ln)
-            if (ln.find('Insert MAC:') > -1):
-                ser.write(bytes(self.eth_mac+'\r\n','ascii'))
-            elif (ln.find('Insert IP:') > -1):
-                ser.write(bytes(self.test_results['ethernet']['deployIP']+'\n','ascii'))
-            elif (ln.find('Insert Mask:') > -1):
-                ser.write(bytes(self.test_results['ethernet']['deployMask']+'\n','ascii'))
-            elif (ln.find('Insert Gateway:') > -1):
-                ser.write(bytes(self.test_results['ethernet']['deployGateway']+'\n','ascii'))
-            elif (ln.find('End of tests!') > -1):
-                break
-
-        if result:
-            if self.program_fw(self.DEPLOY_FW_PATH+'/'+self.eth_ip+'/V2_0_0.bin'):
-                print('Deploy firmware programmed!')
-            else:
-                print('Failed to program deploy firmware!')
+        self.deploy_info(result)
+
+        store_session = Expect(ser, [
+                ('Insert MAC:', self.eth_mac+'\r\n'),
+                ('Insert IP:', self.test_results['ethernet']['deployIP']+'\n'),
+                ('Insert Mask:', self.test_results['ethernet']['deployMask']+'\n'),
+                ('Insert Gateway:', self.test_results['ethernet']['deployGateway']+'\n'),
+            ], [
+                Phase('boot', r'\S', self.deadline('boot')),
+                Phase('feram', 'End of tests!', self.deadline('feram')),
+            ], end='End of tests!', log=self.log, on_phase=self.session_phase, transport=transport)
+        try:
+            store_session.run()
+        except ExpectTimeout as e:
+            print('[ERROR] '+str(e))
+            self.test_results['timeout'] = e.phase
+            result = self.test_results['result'] = 0
+            self.deploy_info(result)
+        if own_port:
+            ser.close()
+        if self.capture is not None:
+            self.capture_archive.add(self.capture, self.test_results['boardSN'], self.test_results['manufSN'], self.eth_mac)
+
+        if self.program_fw(self.deploy_image()):
+            print('Deploy firmware programmed!')
         else:
-            if self.program_fw(self.DEPLOY_FW_PATH+'/'+self.test_mask['ethernet']['genericIP']+'/V2_0_0.bin'):
-                print('Deploy firmware programmed!')
-            else:
-                print('Failed to program deploy firmware!')
-
-        self.report(report_path, self.test_results['boardSN'])
+            print('Failed to program deploy firmware!')
+        self.mark('deployFlash')
+        self.test_results['timing']['total'] = self.last_mark - self.run_start
+
+        if report_path is not None:
+            self.report(report_path, self.test_results['boardSN'])
+            self.mark('report')
+            self.test_results['timing']['total'] = self.last_mark - self.run_start
         return result
 
+    def log_parser(self):
+        eth_info = OrderedDict()
+        eth_info['mac'] = ':'.join([self.eth_mac[i:i+2] for i in range(0, len(self.eth_mac), 2)])
+        eth_info['targetIP'] = self.eth_ip
+        eth_info['targetGateway'] = self.eth_gateway
+        eth_info['targetMask'] = self.eth_mask
+        eth_info['testIP'] = self.eth_test.ip
+        eth_info['testGateway'] = self.eth_test.gateway
+        eth_info['testMask'] = self.eth_test.mask
+        if self.eth_link is not None:
+            eth_info['link'] = self.eth_link
+        return RFFEuC_LogParser(self.test_results, self.mask, eth_info)
+
+    def section_parse(self, section):
+        self.log_parser().parse(self.log, (section,))
+
     def LED_parse(self):
-        ind = [i for i, elem in enumerate(self.log) if '[LED]' in elem]
-        self.test_results['led'] = OrderedDict()
-        for i in ind:
-            regex = re.findall(r'\d*\.?\d+', self.log[i])
-            if len(regex) > 0:
-                self.test_results['led'][regex[0]] = {'value':float(regex[1])}
-                self.test_results['led'][regex[0]]['result'] = (1 if self.test_results['led'][regex[0]]['value'] < self.test_mask['led']['mask'] else 0)
-        #Set the general result to 1 if all the tests passed
-        res = 1
-        for k,v in self.test_results['led'].items():
-            for k1,v1 in v.items():
-                if (k1 == 'result'):
-                    res &= v1
-        self.test_results['led']['result'] = res
+        self.section_parse('led')
 
     def GPIOLoopback_parse(self):
-        self.test_results['gpio'] = OrderedDict()
-        ind = [i for i, elem in enumerate(self.log) if 'Loopback' in elem]
-        result = []
-        for t, i in enumerate(ind):
-            loop_pair = re.findall(r'\[([^]]+)\]', self.log[i])
-            loop_res = re.findall('(Pass|Fail)', self.log[i])
-            if len(loop_pair) > 0:
-                result.append([loop_pair, (1 if loop_res[0] == 'Pass' else 0)])
-                self.test_results['gpio'][t] = {'pin1':loop_pair[0],'pin2':loop_pair[1],'result':(1 if loop_res[0] == 'Pass' else 0)}
-        #Set the general result to 1 if all the tests passed
-        res = 1
-        for k,v in self.test_results['gpio'].items():
-            for k1,v1 in v.items():
-                if (k1 == 'result'):
-                    res &= v1
-        self.test_results['gpio']['result'] = res
+        self.section_parse('gpio')
 
     def PowerSupply_parse(self):
-        ind = [i for i, elem in enumerate(self.log) if 'Power Supply' in elem]
-        self.test_results['powerSupply'] = OrderedDict()
-        for i in ind:
-            regex = re.findall(r'\d*\.?\d+', self.log[i])
-            if len(regex) > 0:
-                self.test_results['powerSupply'][regex[0]] = {'value':float(regex[1])}
-                low = self.test_mask['powerSupply'][regex[0]]['nominal'] - self.test_mask['powerSupply'][regex[0]]['tolerance']
-                high = self.test_mask['powerSupply'][regex[0]]['nominal'] + self.test_mask['powerSupply'][regex[0]]['tolerance']
-                self.test_results['powerSupply'][regex[0]]['result'] = (1 if (low <= float(regex[1]) <= high) else 0)
-        #Set the general result to 1 if all the tests passed
-        res = 1
-        for k,v in self.test_results['powerSupply'].items():
-            for k1,v1 in v.items():
-                if (k1 == 'result'):
-                    res &= v1
-        self.test_results['powerSupply']['result'] = res
+        self.section_parse('powerSupply')
 
     def FeRAM_parse(self):
-        ind = [i for i, elem in enumerate(self.log) if '[RANDOM]' in elem]
-        rand = []
-        for i in ind:
-            regex = re.findall(r'[0-9a-fA-F][0-9a-fA-F]', self.log[i])
-            if len(regex) > 0:
-                rand.extend(regex)
-
-        ind = [i for i, elem in enumerate(self.log) if '[FERAM]' in elem]
-        result = []
-        for i in ind:
-            regex = re.findall('(Pass|Fail)', self.log[i])
-            if len(regex) > 0:
-                result.append(1 if regex[0] == 'Pass' else 0)
-        self.test_results['feram'] = {'pattern': ''.join(rand), 'result': result[0]}
+        self.section_parse('feram')
 
     def Ethernet_parse(self):
-        self.test_results['ethernet'] = OrderedDict()
-        ind = [i for i, elem in enumerate(self.log) if 'Received:' in elem]
-        for i in ind:
-            regex = re.findall(r'"(.*?)"', self.log[i])
-            if len(regex) > 0:
-                self.test_results['ethernet']['message'] = regex[0]
-
-        if 'message' not in self.test_results['ethernet'].keys():
-            self.test_results['ethernet']['message'] = ''
-
-        self.test_results['ethernet']['result'] = 1 if self.test_results['ethernet']['message'] == self.test_mask['ethernet']['message'] else 0
-        self.test_results['ethernet']['mac'] = ':'.join([self.eth_mac[i:i+2] for i in range(0, len(self.eth_mac), 2)])
-        self.test_results['ethernet']['targetIP'] = self.eth_ip
-        self.test_results['ethernet']['targetGateway'] = self.eth_gateway
-        self.test_results['ethernet']['targetMask'] = self.eth_mask
-        self.test_results['ethernet']['testIP'] = self.test_mask['ethernet']['testIP']
-        self.test_results['ethernet']['testGateway'] = self.test_mask['ethernet']['testGateway']
-        self.test_results['ethernet']['testMask'] = self.test_mask['ethernet']['testMask']
+        self.section_parse('ethernet')
 
     def parse_results(self):
-        self.LED_parse()
-        self.GPIOLoopback_parse()
-        self.PowerSupply_parse()
-        self.Ethernet_parse()
-        self.FeRAM_parse()
-
-        res = 1
-        for k,v in self.test_results.items():
-            if isinstance(v, dict):
-                for k1,v1 in v.items():
-                    if (k1 == 'result'):
-                        res &= v1
+        #Lines are parsed as they arrive during run(), only re-parse when the log didn't go through the parser
+        if self.parser is None or self.parser.lines != len(self.log):
+            self.parser = self.log_parser()
+            res = self.parser.parse(self.log)
+        else:
+            res = self.parser.grade()
+        #A board that stopped answering during any phase, or whose test was aborted, is always a failure
+        if 'timeout' in self.test_results or self.aborted:
+            res = 0
         self.test_results['result'] = res
         return res
 
     def report(self, file_dir, file_name):
-        rep = RFFEuC_Report(self.test_results)
+        if self.report_queue is not None:
+            #Rendered in the background, the station can go on with the next board
+            self.report_queue.submit(self, file_dir, file_name)
+            return
+        #pylatex is only imported by processes that render reports themselves
+        from report import report_backends
+        rep = report_backends[self.REPORT_BACKEND](self.test_results)
         rep.generate(file_dir, file_name)
 
     def dump(self, path):
@@ -275,6 +339,7 @@ class RFFEuC_Test(object):
             json.dump(self.test_results, dump_f, indent=4, ensure_ascii=True)
 
 if __name__ == '__main__':
+    from report import RFFEuC_Report
     uc = RFFEuC_Test(('10.0.18.111', '255.255.255.0', '10.0.18.1', 'DE:AD:BE:EF:12:34'), '/dev/ttyUSB0', 'Henrique Silva', 'CN00001','CN00001','0')
     if uc.run():
         rep = RFFEuC_Report(uc.test_results)
@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import fcntl
+import mmap
+import os
+import pathlib
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+RX = 0
+TX = 1
+
+class SerialCapture(object):
+    """ serial port wrapper keeping every byte read from and written to it
+
+    chunks is a list of (seconds since the capture started, RX/TX, bytes).
+    Everything else is passed to the wrapped port.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.start = time.monotonic()
+        self.date = time.time()
+        self.chunks = []
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if data:
+            self.chunks.append((time.monotonic() - self.start, RX, bytes(data)))
+        return data
+
+    def readinto(self, b):
+        n = self.port.readinto(b)
+        if n:
+            self.chunks.append((time.monotonic() - self.start, RX, bytes(b[:n])))
+        return n
+
+    def write(self, data):
+        self.chunks.append((time.monotonic() - self.start, TX, bytes(data)))
+        return self.port.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+Entry = namedtuple('Entry', ('sn', 'manufSN', 'mac', 'date', 'segment', 'offset', 'length', 'crc'))
+
+def key_field(value, width):
+    #Keys are stored NUL padded, longer values are truncated the same way on write and lookup
+    return str(value or '').encode('utf-8')[:width].ljust(width, b'\0')
+
+def norm_mac(mac):
+    return str(mac or '').replace(':', '').upper()
+
+def epoch(date):
+    if isinstance(date, (int, float)):
+        return int(date)
+    return int(datetime.datetime.fromisoformat(str(date)).timestamp())
+
+class CaptureArchive(object):
+    """ compressed, segmented archive of the raw serial captures of the tested boards
+
+    Each capture is compressed on its own and appended to the current segment
+    file (captures-NNNNNN.seg, a new one is started past segment_size bytes),
+    and a fixed size record with the board SN, manufacturer SN, MAC, date and
+    capture location is appended to index.bin. Lookups memory map the index,
+    so finding and reading one board's capture doesn't depend on the archive
+    size.
+
+    add() only queues the capture, a writer thread compresses and writes
+    whatever is queued every batch_delay seconds with a single flush, under
+    an exclusive lock of the index so several stations may share the archive.
+    """
+
+    INDEX = struct.Struct('<16s32s12sqIQII')
+    KEYS = OrderedDict([('sn', (0, 16)), ('manufSN', (16, 32)), ('mac', (48, 12))])
+    CHUNK = struct.Struct('<dBI')
+
+    def __init__(self, archive_dir='./captures/', segment_size=64*1024*1024, batch_delay=1.0, level=6):
+        self.archive_dir = pathlib.Path(os.path.abspath(os.path.expanduser(str(archive_dir))))
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.archive_dir / 'index.bin'
+        self.segment_size = segment_size
+        self.batch_delay = batch_delay
+        self.level = level
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.writer, name='capture-archive', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def add(self, capture, sn, manuf_sn, mac):
+        """ queue a SerialCapture for archiving, returns at once """
+        item = (sn, manuf_sn, norm_mac(mac), capture.date, list(capture.chunks))
+        if self.thread is None:
+            self.write_batch([item])
+        else:
+            self.queue.put(item)
+
+    def flush(self):
+        """ wait until every queued capture is written """
+        self.queue.join()
+
+    def writer(self):
+        while True:
+            item = self.queue.get()
+            batch = [item]
+            if item is not None:
+                #Let the captures of the next boards pile up, they are written together
+                deadline = time.monotonic() + self.batch_delay
+                while batch[-1] is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+            items = [i for i in batch if i is not None]
+            try:
+                if items:
+                    self.write_batch(items)
+            except OSError as e:
+                print('[ERROR] Could not archive {} serial captures: {}'.format(len(items), e))
+            finally:
+                for i in batch:
+                    self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    def encode(self, chunks):
+        return zlib.compress(b''.join(self.CHUNK.pack(t, d, len(data)) + data for t, d, data in chunks), self.level)
+
+    def segment_path(self, n):
+        return self.archive_dir / 'captures-{:06d}.seg'.format(n)
+
+    def current_segment(self):
+        segments = sorted(self.archive_dir.glob('captures-*.seg'))
+        if not segments:
+            return 0
+        n = int(segments[-1].stem.split('-')[1])
+        return n + 1 if segments[-1].stat().st_size >= self.segment_size else n
+
+    def write_batch(self, items):
+        blobs = [self.encode(chunks) for sn, manuf_sn, mac, date, chunks in items]
+        with open(str(self.index_path), 'ab') as index_f:
+            fcntl.flock(index_f, fcntl.LOCK_EX)
+            try:
+                #A record left half written by a crash is dropped
+                size = index_f.seek(0, os.SEEK_END)
+                if size % self.INDEX.size:
+                    index_f.truncate(size - size % self.INDEX.size)
+                records = []
+                n = self.current_segment()
+                seg_f = open(str(self.segment_path(n)), 'ab')
+                try:
+                    for (sn, manuf_sn, mac, date, chunks), blob in zip(items, blobs):
+                        offset = seg_f.seek(0, os.SEEK_END)
+                        if offset and offset + len(blob) > self.segment_size:
+                            seg_f.flush()
+                            os.fsync(seg_f.fileno())
+                            seg_f.close()
+                            n += 1
+                            seg_f = open(str(self.segment_path(n)), 'ab')
+                            offset = 0
+                        seg_f.write(blob)
+                        records.append(self.INDEX.pack(key_field(sn, 16), key_field(manuf_sn, 32), key_field(mac, 12), int(date),
+                                                       n, offset, len(blob), zlib.crc32(blob)))
+                    #Captures are on disk before the index points to them
+                    seg_f.flush()
+                    os.fsync(seg_f.fileno())
+                finally:
+                    seg_f.close()
+                index_f.write(b''.join(records))
+                index_f.flush()
+                os.fsync(index_f.fileno())
+            finally:
+                fcntl.flock(index_f, fcntl.LOCK_UN)
+
+    def entry(self, raw):
+        sn, manuf_sn, mac, date, segment, offset, length, crc = self.INDEX.unpack(raw)
+        return Entry(sn.rstrip(b'\0').decode('utf-8', 'replace'), manuf_sn.rstrip(b'\0').decode('utf-8', 'replace'), mac.rstrip(b'\0').decode('ascii', 'replace'),
+                     date, segment, offset, length, crc)
+
+    def index_map(self):
+        try:
+            index_f = open(str(self.index_path), 'rb')
+        except FileNotFoundError:
+            return None
+        with index_f:
+            size = os.fstat(index_f.fileno()).st_size // self.INDEX.size * self.INDEX.size
+            if not size:
+                return None
+            return mmap.mmap(index_f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        try:
+            return self.index_path.stat().st_size // self.INDEX.size
+        except FileNotFoundError:
+            return 0
+
+    def find(self, sn=None, manufSN=None, mac=None, since=None, until=None):
+        """ index entries of the captures matching every given key, oldest first
+
+        since/until are ISO dates or epoch seconds, until is exclusive.
+        """
+        mm = self.index_map()
+        if mm is None:
+            return []
+        with mm:
+            keys = [(k, v) for k, v in (('sn', sn), ('manufSN', manufSN), ('mac', norm_mac(mac) if mac else None)) if v]
+            if keys:
+                #The first key is searched for directly in the mapped index, only the records holding it are decoded
+                name, value = keys[0]
+                field_offset, width = self.KEYS[name]
+                needle = key_field(value, width)
+                positions = []
+                pos = mm.find(needle)
+                while pos > -1:
+                    if pos % self.INDEX.size == field_offset:
+                        positions.append(pos - field_offset)
+                    pos = mm.find(needle, pos + 1)
+            else:
+                positions = range(0, len(mm), self.INDEX.size)
+            since = epoch(since) if since is not None else None
+            until = epoch(until) if until is not None else None
+            res = []
+            for pos in positions:
+                e = self.entry(mm[pos:pos+self.INDEX.size])
+                if any(getattr(e, k) != key_field(v, self.KEYS[k][1]).rstrip(b'\0').decode('utf-8', 'replace') for k, v in keys[1:]):
+                    continue
+                if (since is not None and e.date < since) or (until is not None and e.date >= until):
+                    continue
+                res.append(e)
+            return res
+
+    def read(self, entry):
+        """ [(seconds since the capture started, RX/TX, bytes)] of an index entry """
+        with open(str(self.segment_path(entry.segment)), 'rb') as seg_f:
+            with mmap.mmap(seg_f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                blob = mm[entry.offset:entry.offset+entry.length]
+        if zlib.crc32(blob) != entry.crc:
+            raise ValueError('corrupted capture of {} in {}'.format(entry.sn, self.segment_path(entry.segment)))
+        data = memoryview(zlib.decompress(blob))
+        chunks = []
+        pos = 0
+        while pos < len(data):
+            t, d, n = self.CHUNK.unpack_from(data, pos)
+            pos += self.CHUNK.size
+            chunks.append((t, d, data[pos:pos+n].tobytes()))
+            pos += n
+        return chunks
+
+def transcript(chunks, encoding='ascii'):
+    """ the capture as text lines, each one with the time of its first byte and its direction """
+    lines = []
+    pending = {RX: None}
+    for t, d, data in chunks:
+        text = data.decode(encoding, 'replace')
+        if d == TX:
+            #Each write is a command or an answer of its own
+            lines.extend((t, d, ln) for ln in text.splitlines() or [''])
+            continue
+        while text:
+            if pending[d] is None:
+                pending[d] = [t, '']
+            nl = text.find('\n')
+            if nl < 0:
+                pending[d][1] += text
+                break
+            pending[d][1] += text[:nl]
+            lines.append((pending[d][0], d, pending[d][1].rstrip('\r')))
+            pending[d] = None
+            text = text[nl+1:]
+    lines.extend((p[0], d, p[1]) for d, p in pending.items() if p is not None and p[1])
+    lines.sort(key=lambda l: l[0])
+    return ['[{:9.3f}] {} {}'.format(t, '<' if d == RX else '>', text) for t, d, text in lines]
+
+def main():
+    parser = argparse.ArgumentParser(description='Look up the archived serial captures of the tested boards')
+    parser.add_argument('--dir', default='./captures/', help='Capture archive directory')
+    parser.add_argument('--sn', help='Board SN')
+    parser.add_argument('--manuf-sn', help='Manufacturer SN')
+    parser.add_argument('--mac', help='Board MAC')
+    parser.add_argument('--since', help='First test date (YYYY-MM-DD)')
+    parser.add_argument('--until', help='Last test date, exclusive (YYYY-MM-DD)')
+    parser.add_argument('--show', action='store_true', help='Print the transcript of the latest matching capture')
+    args = parser.parse_args()
+
+    archive = CaptureArchive(args.dir)
+    entries = archive.find(args.sn, args.manuf_sn, args.mac, args.since, args.until)
+    if not entries:
+        print('No capture found')
+        sys.exit(1)
+    if args.show:
+        for ln in transcript(archive.read(entries[-1])):
+            print(ln)
+        return
+    for e in entries:
+        print('{:>16} {:>32} {:>12} {} {:8d} bytes'.format(e.sn, e.manufSN, e.mac, datetime.datetime.fromtimestamp(e.date).strftime('%Y-%m-%d %H:%M:%S'), e.length))
+
+if __name__ == '__main__':
+    main()
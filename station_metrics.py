@@ -0,0 +1,110 @@
+import csv
+import os
+import pathlib
+import threading
+import time
+from collections import OrderedDict, deque
+
+class PhaseStats(object):
+
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.values:
+            return float('nan')
+        v = sorted(self.values)
+        return v[min(len(v)-1, int(q*len(v)))]
+
+    def summary(self):
+        return OrderedDict([('count', self.count), ('p50', self.quantile(0.5)), ('p95', self.quantile(0.95)),
+                            ('max', max(self.values) if self.values else float('nan'))])
+
+class StationMetrics(object):
+    """ rolling statistics of the per-phase durations recorded by RFFEuC_Test.run()
+
+    Percentiles and maxima are computed over the last 'window' boards,
+    counters and sums over the whole life of the station.
+    """
+
+    def __init__(self, station='default', window=200):
+        self.station = str(station)
+        self.window = window
+        self.phases = OrderedDict()
+        self.results = OrderedDict([('pass', 0), ('fail', 0)])
+        self.last_update = None
+        self.lock = threading.Lock()
+
+    def add(self, timing, result):
+        with self.lock:
+            for phase, value in (timing or {}).items():
+                if phase not in self.phases:
+                    self.phases[phase] = PhaseStats(self.window)
+                self.phases[phase].add(value)
+            self.results['pass' if result else 'fail'] += 1
+            self.last_update = time.time()
+
+    def summary(self):
+        with self.lock:
+            return OrderedDict((phase, st.summary()) for phase, st in self.phases.items())
+
+    def prometheus(self):
+        lines = []
+        label = 'station="{}"'.format(self.station)
+        with self.lock:
+            for phase, st in self.phases.items():
+                s = st.summary()
+                for q, key in (('0.5', 'p50'), ('0.95', 'p95')):
+                    lines.append('rffe_phase_seconds{{{},phase="{}",quantile="{}"}} {:.6f}'.format(label, phase, q, s[key]))
+                lines.append('rffe_phase_seconds_sum{{{},phase="{}"}} {:.6f}'.format(label, phase, st.sum))
+                lines.append('rffe_phase_seconds_count{{{},phase="{}"}} {}'.format(label, phase, st.count))
+                lines.append('rffe_phase_seconds_max{{{},phase="{}"}} {:.6f}'.format(label, phase, s['max']))
+            for res, n in self.results.items():
+                lines.append('rffe_boards_total{{{},result="{}"}} {}'.format(label, res, n))
+            if self.last_update is not None:
+                lines.append('rffe_last_board_timestamp_seconds{{{}}} {:.3f}'.format(label, self.last_update))
+        return lines
+
+    def csv_rows(self):
+        return [[self.station, phase]+list(s.values()) for phase, s in self.summary().items()]
+
+def write_prometheus(path, metrics):
+    """ write the metrics of all stations to a node_exporter textfile, atomically """
+    lines = ['# HELP rffe_phase_seconds Duration of each RFFEuC test phase.',
+             '# TYPE rffe_phase_seconds summary',
+             '# HELP rffe_phase_seconds_max Longest duration of each test phase in the rolling window.',
+             '# TYPE rffe_phase_seconds_max gauge',
+             '# HELP rffe_boards_total Boards tested by result.',
+             '# TYPE rffe_boards_total counter',
+             '# HELP rffe_last_board_timestamp_seconds Unix time the last board of each station was recorded.',
+             '# TYPE rffe_last_board_timestamp_seconds gauge']
+    for m in metrics:
+        lines.extend(m.prometheus())
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.'+path.name+'.tmp')
+    with tmp.open('w') as prom_f:
+        prom_f.write('\n'.join(lines)+'\n')
+    os.replace(str(tmp), str(path))
+
+def write_csv(path, metrics):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.'+path.name+'.tmp')
+    with tmp.open('w', newline='') as csv_f:
+        w = csv.writer(csv_f)
+        w.writerow(['station', 'phase', 'count', 'p50', 'p95', 'max'])
+        for m in metrics:
+            w.writerows(m.csv_rows())
+    os.replace(str(tmp), str(path))
+
+def export(metrics, metrics_dir='./metrics/'):
+    write_prometheus(os.path.join(metrics_dir, 'rffe_station.prom'), metrics)
+    write_csv(os.path.join(metrics_dir, 'rffe_station.csv'), metrics)
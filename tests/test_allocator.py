@@ -0,0 +1,112 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from allocator import AllocatorError, IdentityAllocator
+from registry import BoardRegistry
+
+IP_POOL = ['192.168.2.{}'.format(201 + i) for i in range(4)]
+
+def identity(lease):
+    return (lease['sn'], lease['ip'], lease['mac'])
+
+class IdentityAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.reg = BoardRegistry(os.path.join(self.dir, 'boards.db'))
+        self.alloc = IdentityAllocator(self.reg, IP_POOL, block_size=4)
+
+    def tearDown(self):
+        self.reg.close()
+        shutil.rmtree(self.dir)
+
+    def test_first_identity(self):
+        lease = self.alloc.lease('1')
+        self.assertEqual(identity(lease), ('CN00001', '192.168.2.201', '020000000001'))
+        self.assertEqual(lease['station'], '1')
+
+    def test_distinct_identities(self):
+        leases = [self.alloc.lease('1') for i in range(3)] + [self.alloc.lease('2')]
+        for key in ('sn', 'ip', 'mac'):
+            self.assertEqual(len(set(lease[key] for lease in leases)), 4)
+        #Each station draws from its own block
+        self.assertEqual(leases[-1]['sn'], 'CN00005')
+
+    def test_repeat_after_confirm(self):
+        lease = self.alloc.lease('1')
+        self.assertTrue(self.alloc.confirm(lease['id']))
+        again = self.alloc.lease('1', repeat=lease['id'])
+        self.assertEqual(again['id'], lease['id'])
+        self.assertEqual(identity(again), identity(lease))
+
+    def test_repeat_after_release(self):
+        lease = self.alloc.lease('1')
+        self.assertTrue(self.alloc.release(lease['id']))
+        again = self.alloc.lease('1', repeat=lease['id'])
+        self.assertEqual(identity(again), identity(lease))
+
+    def test_released_identity_reused(self):
+        first = self.alloc.lease('1')
+        second = self.alloc.lease('1')
+        self.alloc.release(first['id'])
+        #The free list comes before the block of the station, whichever station leases next
+        self.assertEqual(self.alloc.lease('2')['sn'], first['sn'])
+        self.assertEqual(self.alloc.lease('1')['sn'], 'CN00003')
+        self.assertNotEqual(second['sn'], first['sn'])
+
+    def test_used_dropped_by_next_board(self):
+        lease = self.alloc.lease('1')
+        self.alloc.confirm(lease['id'])
+        self.assertEqual(self.alloc.status()['used'], 1)
+        nxt = self.alloc.lease('1')
+        self.assertNotEqual(nxt['sn'], lease['sn'])
+        self.assertNotIn('used', self.alloc.status())
+        #Confirmed identities are never handed out again
+        again = self.alloc.lease('1', repeat=lease['id'])
+        self.assertNotIn(again['sn'], (lease['sn'], nxt['sn']))
+
+    def test_repeat_of_another_station(self):
+        lease = self.alloc.lease('1')
+        other = self.alloc.lease('2', repeat=lease['id'])
+        self.assertNotEqual(other['sn'], lease['sn'])
+        self.assertNotEqual(other['ip'], lease['ip'])
+
+    def test_settle_once(self):
+        lease = self.alloc.lease('1')
+        self.assertTrue(self.alloc.confirm(lease['id']))
+        self.assertFalse(self.alloc.release(lease['id']))
+        self.assertFalse(self.alloc.confirm(lease['id']))
+
+    def test_expired_lease_reclaimed(self):
+        lease = self.alloc.lease('1')
+        self.assertEqual(self.alloc.reclaim(now=time.time() + 2*self.alloc.lease_time), 1)
+        self.assertFalse(self.alloc.confirm(lease['id']))
+        self.assertEqual(self.alloc.lease('2')['sn'], lease['sn'])
+
+    def test_unused_block_reclaimed(self):
+        self.alloc.lease('1')
+        self.assertEqual(self.alloc.reclaim(now=time.time() + 2*self.alloc.block_time), 4)
+        self.assertEqual(self.alloc.status()['free'], 4)
+
+    def test_ip_pool_exhausted(self):
+        leases = [self.alloc.lease('1') for ip in IP_POOL]
+        with self.assertRaises(AllocatorError):
+            self.alloc.lease('1')
+        self.alloc.release(leases[1]['id'])
+        self.assertEqual(self.alloc.lease('2')['ip'], leases[1]['ip'])
+
+    def test_peek(self):
+        peek = self.alloc.peek('1')
+        self.assertEqual(self.alloc.status()['stations'], {})
+        lease = self.alloc.lease('1')
+        self.assertEqual(identity(peek), identity(lease))
+        self.assertEqual(self.alloc.peek('1')['sn'], 'CN00002')
+
+if __name__ == '__main__':
+    unittest.main()
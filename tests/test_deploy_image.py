@@ -0,0 +1,140 @@
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import deploy_image
+from deploy_image import DeployImageBuilder
+
+CONF = {'ip': '192.168.2.200', 'mask': '255.255.255.0', 'gateway': '192.168.2.1'}
+#Initial SP, reset handler and the other vectors covered by the checksum
+VECTORS = (0x10008000, 0x000000C1, 0x000000C5, 0x000000C7, 0x000000C9, 0x000000CB, 0x000000CD)
+
+def vector_table(words=VECTORS):
+    return struct.pack('<8I', *(list(words) + [(-sum(words)) & 0xFFFFFFFF]))
+
+def vector_sum(data):
+    return sum(struct.unpack_from('<8I', data, 0)) & 0xFFFFFFFF
+
+def ascii_template():
+    buf = bytearray(vector_table() + bytes(224))
+    for offset, field in ((64, 'ip'), (96, 'mask'), (128, 'gateway')):
+        value = CONF[field].encode('ascii')
+        buf[offset:offset+len(value)] = value
+    return bytes(buf)
+
+def binary_template():
+    #The IP sits in a reserved vector, as a linker script may place it
+    words = list(VECTORS)
+    words[4] = struct.unpack('<I', socket.inet_aton(CONF['ip']))[0]
+    buf = bytearray(vector_table(words) + bytes(224))
+    buf[96:100] = socket.inet_aton(CONF['mask'])
+    buf[128:132] = socket.inet_aton(CONF['gateway'])
+    return bytes(buf)
+
+class DeployImageBuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def template(self, data, name='template.bin'):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as fw_f:
+            fw_f.write(data)
+        return path
+
+    def test_ascii_patch(self):
+        builder = DeployImageBuilder(self.template(ascii_template()), CONF)
+        data = builder.build('10.0.18.5', '255.255.0.0', '10.0.18.1').data
+        self.assertEqual(data[64:80], b'10.0.18.5' + bytes(7))
+        self.assertEqual(data[96:112], b'255.255.0.0' + bytes(5))
+        self.assertEqual(data[128:144], b'10.0.18.1' + bytes(7))
+        #Only the fields change, the vector table is left alone
+        template = ascii_template()
+        outside = [i for i in range(len(data)) if not (64 <= i < 80 or 96 <= i < 112 or 128 <= i < 144)]
+        self.assertEqual(bytes(data[i] for i in outside), bytes(template[i] for i in outside))
+
+    def test_longest_address_fits(self):
+        builder = DeployImageBuilder(self.template(ascii_template()), CONF)
+        data = builder.build('192.168.222.200', '255.255.255.0', '192.168.2.1').data
+        self.assertEqual(data[64:80], b'192.168.222.200\0')
+        self.assertEqual(data[80], 0)
+
+    def test_address_too_long(self):
+        template = bytearray(ascii_template())
+        template[78] = 0xFF
+        builder = DeployImageBuilder(self.template(bytes(template)), CONF)
+        with self.assertRaises(ValueError):
+            builder.build('192.168.222.200', '255.255.255.0', '192.168.2.1')
+
+    def test_vector_checksum(self):
+        template = binary_template()
+        self.assertEqual(vector_sum(template), 0)
+        builder = DeployImageBuilder(self.template(template), CONF, encoding='binary')
+        data = builder.build('10.0.18.5', '255.255.0.0', '10.0.18.1').data
+        self.assertEqual(data[16:20], socket.inet_aton('10.0.18.5'))
+        self.assertEqual(data[96:100], socket.inet_aton('255.255.0.0'))
+        self.assertEqual(data[128:132], socket.inet_aton('10.0.18.1'))
+        #Words 0-6 other than the patched one are kept and word 7 makes the sum zero again
+        self.assertEqual(data[:16], template[:16])
+        self.assertEqual(data[20:28], template[20:28])
+        self.assertNotEqual(data[28:32], template[28:32])
+        self.assertEqual(vector_sum(data), 0)
+
+    def test_template_value_not_unique(self):
+        template = bytearray(ascii_template())
+        template[160:174] = b'192.168.2.200\0'
+        with self.assertRaises(ValueError):
+            DeployImageBuilder(self.template(bytes(template)), CONF)
+
+    def test_template_value_missing(self):
+        with self.assertRaises(ValueError):
+            DeployImageBuilder(self.template(ascii_template()), dict(CONF, gateway='192.168.2.254'))
+
+    def test_images_cached_and_rebuilt(self):
+        path = self.template(ascii_template())
+        builder = DeployImageBuilder(path, CONF)
+        img = builder.build('10.0.18.5', '255.255.0.0', '10.0.18.1')
+        self.assertIs(builder.build('10.0.18.5', '255.255.0.0', '10.0.18.1'), img)
+        #A new template is picked up on the next build
+        with open(path, 'wb') as fw_f:
+            fw_f.write(ascii_template() + bytes(16))
+        new = builder.build('10.0.18.5', '255.255.0.0', '10.0.18.1')
+        self.assertIsNot(new, img)
+        self.assertEqual(new.size, img.size + 16)
+
+class DeployImageBuilderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.conf = {'template': os.path.join(self.dir, 'template.bin'), 'templateIP': CONF['ip'], 'templateMask': CONF['mask'],
+                     'templateGateway': CONF['gateway']}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared_builder(self):
+        with open(self.conf['template'], 'wb') as fw_f:
+            fw_f.write(ascii_template())
+        self.assertIs(deploy_image.deploy_image_builder(self.conf), deploy_image.deploy_image_builder(dict(self.conf)))
+
+    def test_failure_cached_until_template_changes(self):
+        with self.assertRaises(OSError) as first:
+            deploy_image.deploy_image_builder(self.conf)
+        with self.assertRaises(OSError) as second:
+            deploy_image.deploy_image_builder(self.conf)
+        self.assertIs(second.exception, first.exception)
+        with open(self.conf['template'], 'wb') as fw_f:
+            fw_f.write(ascii_template())
+        self.assertIsInstance(deploy_image.deploy_image_builder(self.conf), DeployImageBuilder)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from report_queue import ReportQueue
+
+class DumpTest(object):
+    """ stand-in for RFFEuC_Test, only dump() is used by the queue """
+
+    def __init__(self, sn):
+        self.sn = sn
+
+    def dump(self, path):
+        with open(path, 'w') as dump_f:
+            json.dump({'boardSN': self.sn}, dump_f)
+
+class RecordingQueue(ReportQueue):
+    """ renders nothing, records the boards and fails the ones in 'fail' """
+
+    def __init__(self, *args, **kwargs):
+        self.rendered = []
+        self.fail = set()
+        ReportQueue.__init__(self, *args, **kwargs)
+
+    def render(self, job):
+        with open(job['dump']) as dump_f:
+            sn = json.loads(dump_f.read())['boardSN']
+        if sn in self.fail:
+            raise RuntimeError('pdflatex failed')
+        self.rendered.append(sn)
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return proc.pid
+
+def drain(q):
+    while q.process_one():
+        pass
+
+class ReportQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.dir, 'queue')
+        self.out_dir = os.path.join(self.dir, 'reports')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def queue(self, **kwargs):
+        kwargs.setdefault('retry_delay', 3600.0)
+        kwargs.setdefault('poll', 0.01)
+        return RecordingQueue(self.queue_dir, **kwargs)
+
+    def files(self, state):
+        return sorted(os.listdir(os.path.join(self.queue_dir, state)))
+
+    def test_submit_and_render(self):
+        q = self.queue()
+        job_id = q.submit(DumpTest('SN1'), self.out_dir, 'SN1')
+        self.assertEqual(self.files('pending'), [job_id])
+        self.assertTrue(os.path.isfile(os.path.join(self.queue_dir, 'dumps', job_id)))
+        self.assertTrue(q.process_one())
+        self.assertFalse(q.process_one())
+        self.assertEqual(q.rendered, ['SN1'])
+        self.assertEqual(self.files('done'), [job_id])
+        self.assertEqual(self.files('running'), [])
+        self.assertEqual(q.outstanding(), 0)
+
+    def test_claim_by_rename(self):
+        q = self.queue()
+        other = self.queue()
+        job_id = q.submit(DumpTest('SN1'), self.out_dir, 'SN1')
+        name, running, job = q.claim()
+        self.assertEqual(name, job_id)
+        self.assertEqual(self.files('running'), [job_id+'.'+str(os.getpid())])
+        self.assertEqual(self.files('pending'), [])
+        #A claimed job is invisible to every other worker
+        self.assertIsNone(other.claim())
+        self.assertEqual(q.outstanding(), 1)
+
+    def test_concurrent_claims(self):
+        q = self.queue()
+        for i in range(20):
+            q.submit(DumpTest('SN{}'.format(i)), self.out_dir, 'SN{}'.format(i))
+        queues = [self.queue() for i in range(4)]
+        threads = [threading.Thread(target=drain, args=(w,)) for w in queues]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        rendered = [sn for w in queues for sn in w.rendered]
+        self.assertEqual(sorted(rendered), sorted('SN{}'.format(i) for i in range(20)))
+        self.assertEqual(len(self.files('done')), 20)
+
+    def test_orphan_recovered(self):
+        q = self.queue()
+        job_id = q.submit(DumpTest('SN1'), self.out_dir, 'SN1')
+        #Claimed by a station that crashed before rendering it
+        os.rename(os.path.join(self.queue_dir, 'pending', job_id), os.path.join(self.queue_dir, 'running', job_id+'.'+str(dead_pid())))
+        self.assertIsNone(q.claim())
+        q = self.queue()
+        self.assertEqual(self.files('pending'), [job_id])
+        self.assertEqual(self.files('running'), [])
+        self.assertTrue(q.process_one())
+        self.assertEqual(q.rendered, ['SN1'])
+
+    def test_running_job_of_live_process_kept(self):
+        q = self.queue()
+        job_id = q.submit(DumpTest('SN1'), self.out_dir, 'SN1')
+        q.claim()
+        self.queue()
+        self.assertEqual(self.files('running'), [job_id+'.'+str(os.getpid())])
+        self.assertEqual(self.files('pending'), [])
+
+    def test_retry_then_failed(self):
+        q = self.queue(retries=2)
+        q.fail.add('SN1')
+        job_id = q.submit(DumpTest('SN1'), self.out_dir, 'SN1')
+        self.assertTrue(q.process_one())
+        self.assertEqual(self.files('pending'), [job_id])
+        #Held back by the retry delay
+        self.assertFalse(q.process_one())
+        self.assertEqual(q.flush(), 1)
+        self.assertEqual(self.files('failed'), [job_id])
+        with open(os.path.join(self.queue_dir, 'failed', job_id)) as job_f:
+            job = json.loads(job_f.read())
+        self.assertEqual(job['attempts'], 2)
+        self.assertEqual(job['errors'], ['pdflatex failed', 'pdflatex failed'])
+        q.fail.clear()
+        q.retry_failed()
+        self.assertEqual(q.flush(), 0)
+        self.assertEqual(q.rendered, ['SN1'])
+
+    def test_workers(self):
+        q = self.queue(workers=2).start()
+        for i in range(5):
+            q.submit(DumpTest('SN{}'.format(i)), self.out_dir, 'SN{}'.format(i))
+        self.assertTrue(q.wait(10.0))
+        q.stop()
+        self.assertEqual(sorted(q.rendered), ['SN{}'.format(i) for i in range(5)])
+
+    def test_wait_without_workers(self):
+        q = self.queue()
+        self.assertTrue(q.wait(1.0))
+        q.submit(DumpTest('SN1'), self.out_dir, 'SN1')
+        self.assertFalse(q.wait())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import results
+
+def board_results(sn='SIM0001', result=1):
+    """ a dump() dict laid out as RFFEuC_Test builds it, GPIO keys are ints as the parser leaves them """
+    d = OrderedDict()
+    d['operator'] = 'S'
+    d['date'] = '2026-10-18 07:32:11.029881'
+    d['testBoardSN'] = 'CN00001'
+    d['testBoardPN'] = 'RFFEuC_Tester:1.1'
+    d['testSWCommit'] = '99E6F1C'
+    d['testMaskVersion'] = '1'
+    d['boardSN'] = sn
+    d['boardPN'] = 'RFFEuC:1.2'
+    d['manufSN'] = 'M1'
+    d['timing'] = OrderedDict([('reset', 0.2), ('selfTest', 0.33), ('total', 0.75)])
+    d['led'] = OrderedDict([('0', OrderedDict([('value', 0.87), ('result', 1)])),
+                            ('1', OrderedDict([('value', 1.126), ('result', 1)])), ('result', 1)])
+    d['gpio'] = OrderedDict([(0, OrderedDict([('pin1', 'P0_4'), ('pin2', 'P0_5'), ('result', 1)])),
+                             (1, OrderedDict([('pin1', 'P0_6'), ('pin2', 'P0_7'), ('result', 0)])), ('result', 0)])
+    d['powerSupply'] = OrderedDict([('3.3', OrderedDict([('value', 3.303), ('result', 1)])),
+                                    ('5.0', OrderedDict([('value', 5.034), ('result', 1)])), ('result', 1)])
+    link = OrderedDict([('connected', True), ('attempts', 1),
+                        ('rtt', OrderedDict([('value', 0.041), ('limit', {'max': 5.0}), ('result', 1)])), ('result', 1)])
+    d['ethernet'] = OrderedDict([('message', 'Test msg!'), ('result', 1), ('mac', '02:00:00:00:00:01'), ('targetIP', '192.168.2.201'),
+                                 ('targetGateway', '192.168.2.1'), ('targetMask', '255.255.255.0'), ('testIP', '127.0.1.9'),
+                                 ('testGateway', '192.168.0.1'), ('testMask', '255.255.255.0'), ('link', link),
+                                 ('deployIP', '192.168.2.201'), ('deployMask', '255.255.255.0'), ('deployGateway', '192.168.2.1')])
+    d['feram'] = OrderedDict([('pattern', '1028C2F5970A4DC7'), ('result', 1)])
+    d['result'] = result
+    return d
+
+def canonical(d):
+    #Keys are strings once dumped
+    return json.dumps(json.loads(json.dumps(d)))
+
+class EncodingTest(unittest.TestCase):
+
+    def round_trip(self, d):
+        r = results.TestResults.from_json(d)
+        out = results.decode(results.encode(r)).to_json()
+        self.assertEqual(json.dumps(out), canonical(d))
+        return out
+
+    def test_round_trip(self):
+        self.round_trip(board_results())
+
+    def test_round_trip_of_dict(self):
+        d = board_results()
+        self.assertEqual(json.dumps(results.decode(results.encode(d)).to_json()), canonical(d))
+
+    def test_round_trip_typed_fields(self):
+        d = board_results()
+        r = results.decode(results.encode(d))
+        self.assertEqual(r.info.board_sn, 'SIM0001')
+        self.assertEqual([m.value for m in r.power_supply.items], [3.303, 5.034])
+        self.assertEqual([(lb.name, lb.result) for lb in r.gpio.items], [('0', 1), ('1', 0)])
+        self.assertEqual(r.feram.pattern, bytes.fromhex('1028C2F5970A4DC7'))
+        self.assertEqual(r.deploy.gateway, '192.168.2.1')
+        self.assertEqual(r.failed(), ['gpio'])
+
+    def test_lowercase_pattern(self):
+        d = board_results()
+        d['feram']['pattern'] = d['feram']['pattern'].lower()
+        self.assertEqual(self.round_trip(d)['feram']['pattern'], '1028c2f5970a4dc7')
+
+    def test_extra_and_trailer(self):
+        d = board_results(result=0)
+        d['ethernet']['arp'] = 'incomplete'
+        result = d.pop('result')
+        d['shortCircuit'] = None
+        d['timeout'] = 'selfTest'
+        d['result'] = result
+        d['aborted'] = True
+        r = results.decode(results.encode(d))
+        self.assertEqual(list(r.extra), ['shortCircuit', 'timeout'])
+        self.assertEqual(list(r.trailer), ['aborted'])
+        self.round_trip(d)
+
+    def test_sections_kept_as_they_are(self):
+        d = board_results()
+        d['led'] = OrderedDict([('0', OrderedDict([('value', 'n/a'), ('result', 0)])), ('result', 0)])
+        del d['gpio']
+        d['feram'] = OrderedDict([('pattern', 'not hex'), ('result', 0)])
+        r = results.TestResults.from_json(d)
+        self.assertIsNone(r.led)
+        self.assertIsNone(r.gpio)
+        self.assertIsNone(r.feram)
+        #Sections kept in extra come after the typed ones, only the order changes
+        out = results.decode(results.encode(r)).to_json()
+        self.assertEqual(json.loads(json.dumps(out)), json.loads(canonical(d)))
+
+    def test_bad_magic(self):
+        data = results.encode(board_results())
+        with self.assertRaises(ValueError):
+            results.decode(b'XYZ' + data[3:])
+
+    def test_bad_version(self):
+        data = bytearray(results.encode(board_results()))
+        data[3] = results.VERSION + 1
+        with self.assertRaises(ValueError):
+            results.decode(bytes(data))
+
+class ResultLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'results.rfr')
+        self.boards = [board_results('SIM{:04d}'.format(i), i % 2) for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sns(self, it):
+        return [r.info.board_sn for r in it]
+
+    def test_extend_and_read(self):
+        log = results.ResultLog(self.path)
+        self.assertEqual(log.extend(self.boards[:3]), 3)
+        self.assertEqual(log.append(self.boards[3]), 1)
+        self.assertEqual(self.sns(log), ['SIM0000', 'SIM0001', 'SIM0002', 'SIM0003'])
+        self.assertEqual([json.dumps(r.to_json()) for r in log], [canonical(d) for d in self.boards[:4]])
+
+    def test_records(self):
+        log = results.ResultLog(self.path)
+        log.extend(self.boards)
+        recs = log.records()
+        self.assertEqual(len(recs), 5)
+        self.assertEqual(recs[0][0], results.RECORD.size)
+        self.assertEqual(recs[-1][0] + recs[-1][1], os.path.getsize(self.path))
+
+    def test_read_range(self):
+        log = results.ResultLog(self.path)
+        log.extend(self.boards)
+        self.assertEqual(self.sns(log.read(1, 3)), ['SIM0001', 'SIM0002'])
+        self.assertEqual(self.sns(log.read(4)), ['SIM0004'])
+        self.assertEqual(self.sns(log.read(5, 10)), [])
+
+    def test_half_written_record_ignored(self):
+        log = results.ResultLog(self.path)
+        log.extend(self.boards[:2])
+        data = results.encode(self.boards[2])
+        with open(self.path, 'ab') as log_f:
+            log_f.write(results.RECORD.pack(len(data)) + data[:len(data)//2])
+        self.assertEqual(len(log.records()), 2)
+        self.assertEqual(self.sns(log), ['SIM0000', 'SIM0001'])
+
+    def test_missing_and_empty_log(self):
+        log = results.ResultLog(self.path)
+        self.assertEqual(log.records(), [])
+        self.assertEqual(list(log), [])
+        open(self.path, 'wb').close()
+        self.assertEqual(list(log), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from transport import LineTransport
+
+class ChunkPort(object):
+    """ serial port stand-in delivering 'chunks' one read at a time """
+
+    def __init__(self, chunks):
+        self.chunks = [bytes(c) for c in chunks]
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size):
+        if not self.chunks:
+            return b''
+        data, rest = self.chunks[0][:size], self.chunks[0][size:]
+        if rest:
+            self.chunks[0] = rest
+        else:
+            self.chunks.pop(0)
+        return data
+
+class IntoPort(ChunkPort):
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def read_lines(transport, fills):
+    lines = []
+    for i in range(fills):
+        transport.fill()
+        while True:
+            ln = transport.next_line()
+            if ln is None:
+                break
+            lines.append(bytes(ln))
+    return lines
+
+class LineTransportTest(unittest.TestCase):
+
+    def test_line_split_across_fills(self):
+        t = LineTransport(ChunkPort([b'Power Sup', b'ply 3.3V: 3.301\r', b'\nEnd of tests!\r\n']))
+        self.assertEqual(read_lines(t, 3), [b'Power Supply 3.3V: 3.301\r\n', b'End of tests!\r\n'])
+
+    def test_several_lines_in_one_fill(self):
+        t = LineTransport(IntoPort([b'a\nb\nc']))
+        self.assertEqual(read_lines(t, 1), [b'a\n', b'b\n'])
+        self.assertEqual(bytes(t.pending()), b'c')
+        self.assertEqual(bytes(t.take_pending()), b'c')
+        self.assertEqual(bytes(t.pending()), b'')
+
+    def test_byte_at_a_time(self):
+        data = b'[LED] LED 0: 0.912\r\n[LED] LED 1: 1.020\r\n'
+        t = LineTransport(ChunkPort([data[i:i+1] for i in range(len(data))]))
+        self.assertEqual(read_lines(t, len(data)), [b'[LED] LED 0: 0.912\r\n', b'[LED] LED 1: 1.020\r\n'])
+        self.assertEqual(t.reads, len(data))
+        self.assertEqual(t.received, len(data))
+
+    def test_buffer_compacted_and_grown(self):
+        lines = [b'x'*5+b'\n', b'y'*40+b'\n', b'z'*3+b'\n']
+        data = b''.join(lines)
+        t = LineTransport(ChunkPort([data[i:i+7] for i in range(0, len(data), 7)]), size=8)
+        self.assertEqual(read_lines(t, len(data)), lines)
+        self.assertGreaterEqual(len(t.buf), 41)
+
+    def test_empty_read(self):
+        t = LineTransport(ChunkPort([]))
+        self.assertEqual(t.fill(), 0)
+        self.assertIsNone(t.next_line())
+
+    def test_clear(self):
+        t = LineTransport(ChunkPort([b'partial', b' line\nnext\n']))
+        t.fill()
+        t.clear()
+        self.assertEqual(read_lines(t, 1), [b' line\n', b'next\n'])
+
+    def test_stamp_of_first_byte(self):
+        t = LineTransport(ChunkPort([b'ab', b'c\nd\n']))
+        t.fill()
+        first = t.chunks[0][1]
+        t.fill()
+        second = t.chunks[1][1]
+        self.assertEqual(bytes(t.next_line()), b'abc\n')
+        self.assertEqual(t.stamp, first)
+        self.assertEqual(bytes(t.next_line()), b'd\n')
+        self.assertEqual(t.stamp, second)
+
+if __name__ == '__main__':
+    unittest.main()
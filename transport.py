@@ -0,0 +1,98 @@
+import time
+from collections import deque
+
+class LineTransport(object):
+    """ buffered line framing between a serial port and the expect engine
+
+    Whatever the port has waiting is read with a single call into one
+    preallocated bytearray, and lines are cut out of it as memoryview slices,
+    without copying. Unread bytes are moved back to the start of the buffer
+    only when it runs out of room, and the buffer doubles when a single line
+    doesn't fit. A returned line is only valid until the next fill().
+
+    Each chunk read keeps its monotonic receive time, stamp is the time the
+    first byte of the last returned line was received.
+    """
+
+    def __init__(self, port, size=4096):
+        self.port = port
+        self.readinto = getattr(port, 'readinto', None)
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        #Unread data is buf[start:end], the newline search resumes at scan
+        self.start = 0
+        self.scan = 0
+        self.end = 0
+        #Stream position of buf[0], chunks are (stream position of their end, receive time)
+        self.offset = 0
+        self.chunks = deque()
+        self.stamp = None
+        self.reads = 0
+        self.received = 0
+
+    def room(self):
+        n = self.end - self.start
+        if self.start:
+            self.buf[:n] = bytes(self.view[self.start:self.end])
+        else:
+            #A line longer than the buffer, earlier lines may still hold views of the old one
+            buf = bytearray(2*len(self.buf))
+            buf[:n] = self.view[:n]
+            self.buf = buf
+            self.view = memoryview(buf)
+        self.offset += self.start
+        self.scan -= self.start
+        self.start = 0
+        self.end = n
+
+    def fill(self):
+        """ read what the port has waiting, or wait for one byte up to the port timeout, returns the number of bytes read """
+        if self.end == len(self.buf):
+            self.room()
+        size = min(self.port.in_waiting or 1, len(self.buf) - self.end)
+        if self.readinto is not None:
+            n = self.readinto(self.view[self.end:self.end+size]) or 0
+        else:
+            data = self.port.read(size)
+            n = len(data)
+            self.buf[self.end:self.end+n] = data
+        if n:
+            self.end += n
+            self.chunks.append((self.offset + self.end, time.monotonic()))
+            self.reads += 1
+            self.received += n
+        return n
+
+    def consume(self, upto):
+        #Stamp the data being returned with the time of the chunk its first byte came in
+        start = self.start
+        pos = self.offset + start
+        chunks = self.chunks
+        while chunks and chunks[0][0] <= pos:
+            chunks.popleft()
+        self.stamp = chunks[0][1] if chunks else None
+        self.start = upto
+        if upto > self.scan:
+            self.scan = upto
+        return self.view[start:upto]
+
+    def next_line(self):
+        """ the next complete line, newline included, or None """
+        nl = self.buf.find(b'\n', self.scan, self.end)
+        if nl < 0:
+            self.scan = self.end
+            return None
+        return self.consume(nl+1)
+
+    def pending(self):
+        """ the partial line received so far """
+        return self.view[self.start:self.end]
+
+    def take_pending(self):
+        return self.consume(self.end)
+
+    def clear(self):
+        """ drop everything buffered """
+        self.offset += self.end
+        self.start = self.scan = self.end = 0
+        self.chunks.clear()